@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Stand-in for the fsl tools called by the pipeline (used by benchmarks/orchestration.py)
+#
+# Installed as symlinks named after each tool (topup, applytopup, bet, eddy_openmp, eddy_quad, imcp,
+# dtifit, bedpostx and its slice scripts) in a fake $FSLDIR/bin. Each stub sleeps $FSLSTUB_DELAY seconds and writes outputs
+# with the names and shapes the real tool would produce, so the pipeline runs end to end in seconds.
+# Images are written in the format set by $FSLOUTPUTTYPE (NIFTI or NIFTI_GZ) like the fsl tools.
+
+import os, sys, time, shutil
+import numpy as np
+import nibabel
+
+TOOLS = ('topup', 'applytopup', 'bet', 'eddy_openmp', 'eddy_quad', 'imcp', 'dtifit', 'bedpostx',
+         'bedpostx_single_slice.sh', 'bedpostx_postproc.sh')
+XFIBRES = ('th1samples', 'ph1samples', 'f1samples', 'mean_dsamples', 'mean_S0samples')
+DTIFIT = ('FA','MD','MO','S0','L1','L2','L3','V1','V2','V3')
+
+def options(argv):
+    """--key=value options and positional arguments"""
+    opts = {}; args = []
+    for a in argv:
+      if a.startswith('--') and '=' in a:
+        k, v = a[2:].split('=', 1)
+        opts[k] = v
+      else:
+        args.append(a)
+    return opts, args
+
+def image(name):
+    """fsl style image name (extension optional)"""
+    for ext in ('', '.nii.gz', '.nii'):
+      if os.path.exists(name + ext) and not os.path.isdir(name + ext):
+        return name + ext
+    raise Exception('fslstub: image not found ' + name)
+
+def outname(name):
+    ext = '.nii' if os.environ.get('FSLOUTPUTTYPE', 'NIFTI_GZ') == 'NIFTI' else '.nii.gz'
+    return name if name.endswith(('.nii', '.nii.gz')) else name + ext
+
+def copy(src, dst):
+    """Copy of an image in the output format (converted like fsl does when the formats differ)"""
+    if src.endswith('.nii.gz') == dst.endswith('.nii.gz'):
+      shutil.copy(src, dst)
+    else:
+      nibabel.save(nibabel.load(src), dst)
+
+def save(data, ref, out):
+    nibabel.save(nibabel.Nifti1Image(np.asarray(data, dtype=np.float32), ref.affine), outname(out))
+
+def first(img):
+    data = np.asanyarray(img.dataobj)
+    return data[..., 0] if data.ndim > 3 else data
+
+def lines(path, n, text):
+    with open(path, 'w') as fid:
+      fid.write(''.join(text + '\n' for i in range(n)))
+
+def main(tool, argv):
+    opts, args = options(argv)
+
+    if tool == 'topup':
+      img = nibabel.load(image(opts['imain']))
+      n = img.shape[3] if len(img.shape) > 3 else 1
+      save(np.zeros(img.shape[:3]), img, opts['out'] + '_fieldcoef')
+      lines(opts['out'] + '_movpar.txt', n, '  '.join(['0.000000'] * 6))
+      copy(image(opts['imain']), outname(opts['iout']))
+      save(np.zeros(img.shape[:3]), img, opts['fout'])
+
+    elif tool == 'applytopup':
+      img = nibabel.load(image(opts['imain']))
+      save(first(img), img, opts['out'])
+
+    elif tool == 'bet':
+      img = nibabel.load(image(args[0]))
+      save(first(img), img, args[1])
+      if '-m' in args:
+        save(np.ones(img.shape[:3]), img, args[1] + '_mask')
+
+    elif tool == 'eddy_openmp':
+      src = image(opts['imain'])
+      n = nibabel.load(src).shape[3]
+      out = opts['out']
+      copy(src, outname(out))
+      shutil.copy(opts['bvecs'], out + '.eddy_rotated_bvecs')
+      lines(out + '.eddy_parameters', n, '  '.join(['0'] * 16))
+      lines(out + '.eddy_movement_rms', n, '0.1  0.05')
+      lines(out + '.eddy_restricted_movement_rms', n, '0.08  0.04')
+      lines(out + '.eddy_outlier_map', n, ' '.join(['0'] * nibabel.load(src).shape[2]))
+      lines(out + '.eddy_outlier_report', 1, 'Slice 0 in scan 1 is an outlier with mean 4.1 standard deviations off, and mean squared 4.3 standard deviations off.')
+
+    elif tool == 'eddy_quad':
+      os.makedirs(args[0] + '.qc')
+      with open(args[0] + '.qc/qc.json', 'w') as fid:
+        fid.write('{}\n')
+
+    elif tool == 'imcp':
+      src = image(args[0])
+      dst = args[1] + '/' + os.path.basename(src) if os.path.isdir(args[1]) else outname(args[1])
+      copy(src, dst)
+
+    elif tool == 'dtifit':
+      img = nibabel.load(image(opts['data']))
+      inside = np.asanyarray(nibabel.load(image(opts['mask'])).dataobj).reshape(img.shape[:3]) > 0
+      for m in DTIFIT:
+        save(first(img) * inside if m == 'FA' else np.zeros(img.shape[:3] + ((3,) if m[0] == 'V' else ())), img, opts['out'] + '_' + m)
+
+    elif tool == 'bedpostx':
+      d = args[0].rstrip('/')
+      img = nibabel.load(image(d + '/data'))
+      os.makedirs(d + '.bedpostX', exist_ok=True)
+      for m in ('mean_f1samples', 'mean_th1samples', 'mean_ph1samples', 'dyads1'):
+        save(np.zeros(img.shape[:3]), img, d + '.bedpostX/' + m)
+
+    elif tool == 'bedpostx_single_slice.sh':
+      d = args[0].rstrip('/'); z = '%04d' % int(args[1])
+      img = nibabel.load(image(d + '/data_slice_' + z))
+      out = d + '.bedpostX/diff_slices/data_slice_' + z
+      os.makedirs(out, exist_ok=True)
+      for m in XFIBRES:
+        save(np.full(img.shape[:3], int(args[1]), dtype=np.float32), img, out + '/' + m)
+      open(d + '.bedpostX/logs/monitor/' + args[1], 'w').close()
+
+    elif tool == 'bedpostx_postproc.sh':
+      d = args[0].rstrip('/')
+      slices = sorted(os.listdir(d + '.bedpostX/diff_slices'))
+      for m in XFIBRES:
+        imgs = [nibabel.load(image(d + '.bedpostX/diff_slices/' + s + '/' + m)) for s in slices]
+        save(np.concatenate([np.asanyarray(i.dataobj) for i in imgs], axis=2), imgs[0], d + '.bedpostX/' + ('merged_' + m if m[0] != 'm' else m))
+      save(np.zeros(imgs[0].shape[:2] + (len(slices), 3)), imgs[0], d + '.bedpostX/dyads1')
+      shutil.rmtree(d + '.bedpostX/diff_slices')
+      for f in os.listdir(d):
+        if '_slice_' in f:
+          os.remove(d + '/' + f)
+
+    else:
+      raise Exception('fslstub: unknown tool ' + tool)
+
+if __name__ == "__main__":
+    time.sleep(float(os.environ.get('FSLSTUB_DELAY', 0)))
+    main(os.path.basename(sys.argv[0]), sys.argv[1:])
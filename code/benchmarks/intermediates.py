@@ -0,0 +1,120 @@
+# Benchmark of the intermediate image format: uncompressed .nii working directory (default) against
+# .nii.gz everywhere (--compress-intermediates), with the fsl tools replaced by stubs
+# usage: python benchmarks/intermediates.py [--subjects=N] [--runs=N] [--volumes=N] [--shape=X,Y,Z]
+#                                           [--n-cpus=N] [--concat] [--results=FILE] [--keep]
+#
+# The same synthetic dataset (see orchestration.py) is processed cold with both policies. The cpu time
+# (user + sys of every stage, from logs/metrics.jsonl) is summed per participant, so the time spent in
+# gzip by the stages shows up as the difference. The derivatives of both runs are compared voxel by voxel.
+# One json record per run is appended to the results file.
+
+import os, sys, json, time, shutil, getopt, tempfile, collections
+import numpy as np
+import nibabel
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from orchestration import make_dataset, install_stubs, run_pipeline, commit
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'intermediates.jsonl')
+
+def stage_cpu(wd):
+    """cpu time (user + sys) and bytes written of every stage of the latest run, per participant"""
+    from utils import metrics
+    cpu = collections.defaultdict(dict); written = collections.defaultdict(float)
+    for path in sorted(set(os.path.join(root, 'metrics.jsonl') for root, dirs, files in os.walk(wd) if 'metrics.jsonl' in files)):
+      recs = metrics.load(path)
+      runs = [i for i, r in enumerate(recs) if 'run' in r]
+      for r in recs[runs[-1] if runs else 0:]:
+        if 'user' in r and not r.get('skipped'):
+          pid, name = r['stage'].split('_', 1) if r['stage'].startswith('sub-') else ('sub-?', r['stage'])
+          cpu[pid][name] = r['user'] + r['sys']
+          written[pid] += r.get('write_bytes', 0)
+    return dict(cpu), dict(written)
+
+def images(root):
+    return sorted(os.path.relpath(os.path.join(b, f), root) for b, d, files in os.walk(root) for f in files if f.endswith('.nii.gz'))
+
+def same_derivatives(a,b):
+    """Derivative images of both runs hold the same voxels (the gzip streams differ)"""
+    if images(a) != images(b):
+      return False
+    return all(np.array_equal(np.asanyarray(nibabel.load(a + '/' + f).dataobj), np.asanyarray(nibabel.load(b + '/' + f).dataobj)) for f in images(a))
+
+def main(argv):
+    nsub = 2; nruns = 1; nvols = 40; shape = (64, 64, 32); ncpus = os.cpu_count(); concat = False
+    results = RESULTS; keep = False
+
+    opts, args = getopt.getopt(argv, "h", ["help","subjects=","runs=","volumes=","shape=","n-cpus=","concat","results=","keep"])
+    for opt, arg in opts:
+      if opt in ("-h", "--help"):
+        print('usage: python benchmarks/intermediates.py [--subjects=N] [--runs=N] [--volumes=N] [--shape=X,Y,Z] [--n-cpus=N] [--concat] [--results=FILE] [--keep]'); return
+      elif opt == "--subjects":
+        nsub = int(arg)
+      elif opt == "--runs":
+        nruns = int(arg)
+      elif opt == "--volumes":
+        nvols = int(arg)
+      elif opt == "--shape":
+        shape = tuple(int(n) for n in arg.split(','))
+      elif opt == "--n-cpus":
+        ncpus = int(arg)
+      elif opt == "--concat":
+        concat = True
+      elif opt == "--results":
+        results = arg
+      elif opt == "--keep":
+        keep = True
+
+    tmp = tempfile.mkdtemp(prefix='intermediates_benchmark_')
+    try:
+      fsldir = install_stubs(tmp + '/fsl')
+      env = dict(os.environ, FSLDIR=fsldir, PATH=fsldir + '/bin' + os.pathsep + os.environ.get('PATH', ''), FSLSTUB_DELAY='0')
+      inputs = make_dataset(tmp + '/bids', nsub, 1, nruns, nvols, shape)
+      config = {'subjects': nsub, 'runs': nruns, 'volumes': nvols, 'shape': list(shape), 'ncpus': ncpus, 'concat': concat}
+
+      rec = {'time': time.time(), 'commit': commit(), 'config': config}
+      for policy, flags in (('nii.gz', ['--compress-intermediates']), ('nii', [])):
+        base = tmp + '/' + policy.replace('.', '_')  # (sidecar names are derived by replacing nii.gz)
+        argv = ['--in=' + inputs, '--out=' + base + '/derivatives', '--work-dir=' + base + '/work',
+                '--participant-label=all', '--n-cpus=' + str(ncpus), '--run-tensor-fit', '--run-bedpostx',
+                '--concat-before-preproc=' + ('TRUE' if concat else 'FALSE')] + flags
+        wall, code = run_pipeline(argv, env)
+        cpu, written = stage_cpu(base + '/work')
+        rec[policy] = {'wall': wall, 'exitcode': code, 'cpu': cpu,
+                       'cpu_per_subject': sum(sum(c.values()) for c in cpu.values()) / max(len(cpu), 1),
+                       'written_mb_per_subject': sum(written.values()) / max(len(written), 1) / 2.**20}
+      rec['same_derivatives'] = same_derivatives(tmp + '/nii_gz/derivatives', tmp + '/nii/derivatives')
+
+      os.makedirs(os.path.dirname(results), exist_ok=True)
+      with open(results, 'a') as fid:
+        fid.write(json.dumps(rec) + '\n')
+
+      gz, raw = rec['nii.gz'], rec['nii']
+      print('%-26s %12s %12s' % ('per subject', '.nii.gz', '.nii'))
+      print('%-26s %12.2f %12.2f' % ('cpu time (s)', gz['cpu_per_subject'], raw['cpu_per_subject']))
+      print('%-26s %12.1f %12.1f' % ('written (MB)', gz['written_mb_per_subject'], raw['written_mb_per_subject']))
+      print('%-26s %12.2f %12.2f' % ('wall, all subjects (s)', gz['wall'], raw['wall']))
+      print('cpu time saved per subject: %.2f s (%.0f%%)' % (gz['cpu_per_subject'] - raw['cpu_per_subject'],
+            100 * (1 - raw['cpu_per_subject'] / gz['cpu_per_subject']) if gz['cpu_per_subject'] else 0))
+      print('same derivatives: ' + ('yes' if rec['same_derivatives'] else 'NO'))
+      if gz['exitcode'] or raw['exitcode']:
+        print('pipeline failed (exit code ' + str(gz['exitcode'] or raw['exitcode']) + ')')
+
+      # stages with the largest difference (summed over participants)
+      diff = collections.defaultdict(float)
+      for policy, sign in (('nii.gz', 1), ('nii', -1)):
+        for stages in rec[policy]['cpu'].values():
+          for name, t in stages.items():
+            diff[name] += sign * t
+      print('\ncpu time saved by stage (s), summed over participants:')
+      for name, t in sorted(diff.items(), key=lambda s: -abs(s[1]))[:10]:
+        print('  %-32s %8.2f' % (name, t))
+      print('\nresults: ' + results)
+    finally:
+      if keep:
+        print('kept: ' + tmp)
+      else:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
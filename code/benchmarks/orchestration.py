@@ -0,0 +1,182 @@
+# Benchmark of the pipeline orchestration overhead (bids indexing, planning, script generation,
+# process spawning, in-process image work, confounds) with the fsl tools replaced by stubs
+# usage: python benchmarks/orchestration.py [--subjects=1,4] [--sessions=N] [--runs=N] [--volumes=N]
+#                                           [--shape=X,Y,Z] [--delay=S] [--n-cpus=N] [--repeat=N]
+#                                           [--concat] [--results=FILE] [--keep]
+#
+# For every dataset size a synthetic bids dataset is generated (subjects x sessions x AP/PA runs,
+# with bval / bvec / json sidecars), the stub tools (benchmarks/fslstub.py) are put first on the PATH
+# as a fake $FSLDIR, and fdtpipeline.main is run end to end (cold: new work directory, and warm:
+# rerun with every stage up to date). Per stage times come from the stage metrics (logs/metrics.jsonl).
+# One json record per run is appended to the results file, so scaling regressions show up between commits.
+
+import os, sys, json, time, shutil, getopt, tempfile, subprocess, collections
+import numpy as np
+import nibabel
+
+CODE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, CODE)
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'orchestration.jsonl')
+
+def make_dataset(root,nsub,nses,nruns,nvols,shape,seed=0):
+    """Synthetic bids dataset: every session has nruns AP and nruns PA dwi scans (b0 + b=1000 shell)"""
+    rng = np.random.default_rng(seed)
+    os.makedirs(root)
+    with open(root + '/dataset_description.json', 'w') as fid:
+      json.dump({'Name': 'synthetic dwi', 'BIDSVersion': '1.1.1'}, fid)
+
+    bvals = np.where(np.arange(nvols) % 10 == 0, 0, 1000)
+    bvecs = rng.normal(size=(3, nvols))
+    bvecs /= np.linalg.norm(bvecs, axis=0)
+    bvecs[:, bvals == 0] = 0
+    data = (rng.random(tuple(shape) + (nvols,)) * 1000).astype(np.int16)
+    img = nibabel.Nifti1Image(data, np.diag([2., 2., 2., 1.]))
+
+    for s in range(1, nsub + 1):
+      for ses in range(1, nses + 1):
+        d = root + '/sub-%02d/ses-%d/dwi' % (s, ses)
+        os.makedirs(d)
+        for run in range(1, nruns + 1):
+          for pe, ped in (('AP', 'j-'), ('PA', 'j')):
+            base = d + '/sub-%02d_ses-%d_dir-%s_run-%d_dwi' % (s, ses, pe, run)
+            nibabel.save(img, base + '.nii.gz')
+            np.savetxt(base + '.bval', bvals[None], fmt='%d')
+            np.savetxt(base + '.bvec', bvecs, fmt='%.6f')
+            with open(base + '.json', 'w') as fid:
+              json.dump({'PhaseEncodingDirection': ped, 'TotalReadoutTime': 0.05, 'EffectiveEchoSpacing': 0.0005}, fid)
+    return root
+
+def install_stubs(fsldir):
+    """Fake $FSLDIR: bin/<tool> links to fslstub.py (run by this python interpreter)"""
+    os.makedirs(fsldir + '/bin'); os.makedirs(fsldir + '/etc')
+    with open(fsldir + '/etc/fslversion', 'w') as fid:
+      fid.write('stub\n')
+    stub = fsldir + '/bin/fslstub.py'
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fslstub.py')) as src:
+      code = src.read().split('\n', 1)[1]
+    with open(stub, 'w') as fid:
+      fid.write('#!' + sys.executable + '\n' + code)
+    os.chmod(stub, 0o775)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from fslstub import TOOLS
+    for tool in TOOLS:
+      os.symlink(stub, fsldir + '/bin/' + tool)
+    return fsldir
+
+def run_pipeline(argv,env):
+    """Runs fdtpipeline.main in a child python (clean module state), returns wall time and exit code"""
+    t = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', 'import sys, fdtpipeline; fdtpipeline.main(sys.argv[1:])'] + argv,
+                          cwd=CODE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - t
+    if proc.returncode != 0:
+      print(proc.stderr[-2000:])
+    return wall, proc.returncode
+
+def stage_times(wd):
+    """Wall time of every stage of the latest run, summed over participants (by stage name without the participant prefix)"""
+    from utils import metrics
+    stages = collections.defaultdict(float); skipped = 0
+    for path in sorted(set(os.path.join(root, 'metrics.jsonl') for root, dirs, files in os.walk(wd) if 'metrics.jsonl' in files)):
+      recs = metrics.load(path)
+      runs = [i for i, r in enumerate(recs) if 'run' in r]
+      for r in recs[runs[-1] if runs else 0:]:
+        if r.get('skipped'):
+          skipped += 1
+        elif 'wall' in r:
+          stages[r['stage'].split('_', 1)[1] if r['stage'].startswith('sub-') else r['stage']] += r['wall']
+    return dict(stages), skipped
+
+def commit():
+    try:
+      return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CODE, capture_output=True, universal_newlines=True).stdout.strip()
+    except OSError:
+      return 'unknown'
+
+def previous(results,config):
+    """Latest recorded result with the same configuration"""
+    if not os.path.exists(results):
+      return None
+    with open(results) as fid:
+      recs = [json.loads(l) for l in fid if l.strip()]
+    recs = [r for r in recs if r['config'] == config]
+    return recs[-1] if recs else None
+
+def main(argv):
+    subjects = [1, 4]; nses = 1; nruns = 1; nvols = 20; shape = (16, 16, 8)
+    delay = 0.; ncpus = os.cpu_count(); repeat = 1; concat = False; results = RESULTS; keep = False
+
+    opts, args = getopt.getopt(argv, "h", ["help","subjects=","sessions=","runs=","volumes=","shape=","delay=","n-cpus=","repeat=","concat","results=","keep"])
+    for opt, arg in opts:
+      if opt in ("-h", "--help"):
+        print('usage: python benchmarks/orchestration.py [--subjects=1,4] [--sessions=N] [--runs=N] [--volumes=N] [--shape=X,Y,Z] [--delay=S] [--n-cpus=N] [--repeat=N] [--concat] [--results=FILE] [--keep]'); return
+      elif opt == "--subjects":
+        subjects = [int(n) for n in arg.split(',')]
+      elif opt == "--sessions":
+        nses = int(arg)
+      elif opt == "--runs":
+        nruns = int(arg)
+      elif opt == "--volumes":
+        nvols = int(arg)
+      elif opt == "--shape":
+        shape = tuple(int(n) for n in arg.split(','))
+      elif opt == "--delay":
+        delay = float(arg)
+      elif opt == "--n-cpus":
+        ncpus = int(arg)
+      elif opt == "--repeat":
+        repeat = int(arg)
+      elif opt == "--concat":
+        concat = True
+      elif opt == "--results":
+        results = arg
+      elif opt == "--keep":
+        keep = True
+
+    tmp = tempfile.mkdtemp(prefix='orchestration_benchmark_')
+    try:
+      fsldir = install_stubs(tmp + '/fsl')
+      env = dict(os.environ, FSLDIR=fsldir, PATH=fsldir + '/bin' + os.pathsep + os.environ.get('PATH', ''), FSLSTUB_DELAY=str(delay), FSLOUTPUTTYPE='NIFTI_GZ')
+
+      print('%8s %8s %6s %10s %10s %10s %8s' % ('subjects', 'scans', 'stages', 'cold (s)', 'warm (s)', 'stages (s)', 'vs last'))
+      for nsub in subjects:
+        config = {'subjects': nsub, 'sessions': nses, 'runs': nruns, 'volumes': nvols, 'shape': list(shape),
+                  'delay': delay, 'ncpus': ncpus, 'concat': concat}
+        for r in range(repeat):
+          base = tmp + '/%d_%d' % (nsub, r)
+          inputs = make_dataset(base + '/bids', nsub, nses, nruns, nvols, shape)
+          argv = ['--in=' + inputs, '--out=' + base + '/derivatives', '--work-dir=' + base + '/work',
+                  '--participant-label=all', '--n-cpus=' + str(ncpus), '--run-tensor-fit',
+                  '--concat-before-preproc=' + ('TRUE' if concat else 'FALSE')]
+
+          cold, code = run_pipeline(argv, env)
+          stages, skipped = stage_times(base + '/work')
+          warm, code2 = run_pipeline(argv, env)  # every stage up to date: bids index, planning and manifest checks only
+          skipped = stage_times(base + '/work')[1]
+
+          rec = {'time': time.time(), 'commit': commit(), 'config': config, 'cold': cold, 'warm': warm,
+                 'exitcode': code or code2, 'stages': stages, 'warm_skipped': skipped}
+          last = previous(results, config)
+          os.makedirs(os.path.dirname(results), exist_ok=True)
+          with open(results, 'a') as fid:
+            fid.write(json.dumps(rec) + '\n')
+
+          change = ('%+7.0f%%' % (100 * (cold / last['cold'] - 1))) if last else '      -'
+          print('%8d %8d %6d %10.2f %10.2f %10.2f %8s' % (nsub, nsub * nses * nruns * 2, len(stages), cold, warm, sum(stages.values()), change))
+          if code or code2:
+            print('pipeline failed (exit code ' + str(code or code2) + ')')
+
+      # slowest stages of the largest run
+      print('\nstage wall time (s), summed over participants:')
+      for name, t in sorted(stages.items(), key=lambda s: -s[1])[:15]:
+        print('  %-32s %8.2f' % (name, t))
+      print('\nresults: ' + results)
+    finally:
+      if keep:
+        print('kept: ' + tmp)
+      else:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
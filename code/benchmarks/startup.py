@@ -0,0 +1,91 @@
+# Benchmark of the pipeline startup latency: --help, --plan-only and a no-op --resume run
+# usage: python benchmarks/startup.py [--subjects=N] [--repeat=N] [--results=FILE] [--keep]
+#
+# Each command is run in a fresh python (python fdtpipeline.py ...) so module imports are included,
+# the median of --repeat runs is reported. --plan-only and --resume use a synthetic dataset with the
+# stub fsl tools (see orchestration.py); the resume run follows a complete run, so every stage is
+# skipped from the journal. The slowest imports of the --help path (python -X importtime) are listed.
+# One json record per run is appended to the results file, so startup regressions show up between commits.
+
+import os, sys, json, time, shutil, getopt, tempfile, subprocess, statistics
+import orchestration
+
+CODE = orchestration.CODE
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'startup.jsonl')
+
+def timed(argv,env,repeat):
+    """Median wall time of python fdtpipeline.py <argv> (fresh interpreter each time)"""
+    times = []
+    for r in range(repeat):
+      t = time.perf_counter()
+      proc = subprocess.run([sys.executable, 'fdtpipeline.py'] + argv, cwd=CODE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+      times.append(time.perf_counter() - t)
+      if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        raise Exception('fdtpipeline.py ' + ' '.join(argv) + ' failed (exit code ' + str(proc.returncode) + ')')
+    return statistics.median(times)
+
+def imports(argv,env,n=10):
+    """Slowest modules (cumulative import time, s) imported by fdtpipeline.py <argv>"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', 'fdtpipeline.py'] + argv, cwd=CODE, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    mods = []
+    for line in proc.stderr.splitlines():
+      if line.startswith('import time:') and '|' in line:
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit() and not name.startswith('   '):  # top level imports only
+          mods.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(mods, reverse=True)[:n]
+
+def main(argv):
+    nsub = 1; repeat = 5; results = RESULTS; keep = False
+
+    opts, args = getopt.getopt(argv, "h", ["help","subjects=","repeat=","results=","keep"])
+    for opt, arg in opts:
+      if opt in ("-h", "--help"):
+        print('usage: python benchmarks/startup.py [--subjects=N] [--repeat=N] [--results=FILE] [--keep]'); return
+      elif opt == "--subjects":
+        nsub = int(arg)
+      elif opt == "--repeat":
+        repeat = int(arg)
+      elif opt == "--results":
+        results = arg
+      elif opt == "--keep":
+        keep = True
+
+    tmp = tempfile.mkdtemp(prefix='startup_benchmark_')
+    try:
+      fsldir = orchestration.install_stubs(tmp + '/fsl')
+      env = dict(os.environ, FSLDIR=fsldir, PATH=fsldir + '/bin' + os.pathsep + os.environ.get('PATH', ''), FSLOUTPUTTYPE='NIFTI_GZ')
+      inputs = orchestration.make_dataset(tmp + '/bids', nsub, 1, 1, 20, (16, 16, 8))
+      base = ['--in=' + inputs, '--out=' + tmp + '/derivatives', '--participant-label=all', '--run-tensor-fit']
+
+      rec = {'time': time.time(), 'commit': orchestration.commit(), 'config': {'subjects': nsub, 'repeat': repeat}}
+      rec['help'] = timed(['--help'], env, repeat)
+      rec['plan_only'] = timed(base + ['--work-dir=' + tmp + '/plan', '--plan-only'], env, repeat)
+      orchestration.run_pipeline(base + ['--work-dir=' + tmp + '/work'], env)  # complete run
+      rec['resume'] = timed(base + ['--work-dir=' + tmp + '/work', '--resume'], env, repeat)
+
+      last = orchestration.previous(results, rec['config'])
+      os.makedirs(os.path.dirname(results), exist_ok=True)
+      with open(results, 'a') as fid:
+        fid.write(json.dumps(rec) + '\n')
+
+      print('%-12s %10s %8s' % ('command', 'time (s)', 'vs last'))
+      for k in ('help', 'plan_only', 'resume'):
+        change = ('%+7.0f%%' % (100 * (rec[k] / last[k] - 1))) if last else '      -'
+        print('%-12s %10.3f %8s' % (k, rec[k], change))
+
+      print('\nslowest imports of --help (s):')
+      for t, name in imports(['--help'], env):
+        print('  %-32s %8.3f' % (name, t))
+      print('\nresults: ' + results)
+    finally:
+      if keep:
+        print('kept: ' + tmp)
+      else:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,119 @@
+# Benchmark of the native tensor fit (utils/tensor.py) against fsl dtifit on synthetic data
+# usage: python benchmarks/tensor_fit.py [--shape=X,Y,Z] [--ndirs=N] [--n-cpus=N] [--snr=S]
+#
+# A synthetic dwi series is simulated from known tensors (random orientations and anisotropy,
+# b0 + b=1000 shell, rician noise). The native fit is timed with 1 and --n-cpus processes and,
+# when dtifit is found on the PATH, dtifit is run on the same data. Agreement is reported for
+# FA / MD / L1 / S0 (max and median absolute difference) and V1 (median angle, sign invariant).
+
+import os, sys, time, shutil, getopt, tempfile, subprocess
+import numpy as np
+import nibabel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils import gradients, tensor
+
+def simulate(shape, ndirs, snr, seed=0):
+    """Synthetic dwi data, gradient table and ground truth tensors inside a spherical mask"""
+    rng = np.random.default_rng(seed)
+    nb0 = max(1, ndirs // 10)
+    bvecs = rng.normal(size=(3, ndirs))
+    bvecs /= np.linalg.norm(bvecs, axis=0)
+    gt = gradients.GradientTable(np.r_[np.zeros(nb0), np.full(ndirs, 1000.)], np.hstack([np.zeros((3, nb0)), bvecs]))
+
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij'), axis=-1)
+    mask = (grid ** 2).sum(-1) <= 1
+    nvox = int(mask.sum())
+
+    # random rotations (qr of gaussian matrices) and eigenvalues from isotropic to strongly anisotropic
+    R, _ = np.linalg.qr(rng.normal(size=(nvox, 3, 3)))
+    l1 = rng.uniform(0.8e-3, 2.0e-3, nvox)
+    l23 = np.sort(l1[:, None] * rng.uniform(0.1, 1.0, (nvox, 2)), axis=1)[:, ::-1]
+    evals = np.column_stack([l1, l23])
+    D = np.einsum('vij,vj,vkj->vik', R, evals, R)
+    S0 = rng.uniform(500, 1500, nvox)
+
+    X = tensor.design(gt)
+    beta = np.column_stack([np.log(S0), D[:, 0, 0], D[:, 1, 1], D[:, 2, 2], D[:, 0, 1], D[:, 0, 2], D[:, 1, 2]])
+    signal = np.exp(beta @ X.T)
+    sigma = S0[:, None] / snr
+    signal = np.sqrt((signal + rng.normal(size=signal.shape) * sigma) ** 2 + (rng.normal(size=signal.shape) * sigma) ** 2)
+
+    data = np.zeros(shape + (len(gt),), dtype=np.float32)
+    data[mask] = signal
+    md = evals.mean(1)
+    fa = np.sqrt(1.5 * ((evals - md[:, None]) ** 2).sum(1) / (evals ** 2).sum(1))
+    return data, mask, gt, fa
+
+def compare(a, b, mask):
+    out = {}
+    for m in ('FA', 'MD', 'L1', 'S0'):
+      x = nibabel.load(a + '_' + m + '.nii.gz').get_fdata()[mask]
+      y = nibabel.load(b + '_' + m + '.nii.gz').get_fdata()[mask]
+      d = np.abs(x - y) / (np.abs(y).mean() if m == 'S0' else 1)  # S0 relative
+      out[m] = (float(d.max()), float(np.median(d)))
+    x = nibabel.load(a + '_V1.nii.gz').get_fdata()[mask]
+    y = nibabel.load(b + '_V1.nii.gz').get_fdata()[mask]
+    angle = np.degrees(np.arccos(np.clip(np.abs((x * y).sum(-1)), 0, 1)))
+    out['V1 angle'] = (float(angle.max()), float(np.median(angle)))
+    return out
+
+def timed(fn, *args):
+    t = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t
+
+def main(argv):
+    shape = (64, 64, 40); ndirs = 64; ncpus = os.cpu_count(); snr = 30.
+    opts, args = getopt.getopt(argv, "h", ["help", "shape=", "ndirs=", "n-cpus=", "snr="])
+    for opt, arg in opts:
+      if opt in ("-h", "--help"):
+        print('usage: python benchmarks/tensor_fit.py [--shape=X,Y,Z] [--ndirs=N] [--n-cpus=N] [--snr=S]'); return
+      elif opt == "--shape":
+        shape = tuple(int(n) for n in arg.split(','))
+      elif opt == "--ndirs":
+        ndirs = int(arg)
+      elif opt == "--n-cpus":
+        ncpus = int(arg)
+      elif opt == "--snr":
+        snr = float(arg)
+
+    wd = tempfile.mkdtemp(prefix='tensor_benchmark_')
+    try:
+      data, mask, gt, fa = simulate(shape, ndirs, snr)
+      affine = np.diag([2., 2., 2., 1.])
+      dwi = wd + '/dwi.nii.gz'; bval = wd + '/dwi.bval'; bvec = wd + '/dwi.bvec'; brain = wd + '/dwi_brain-mask.nii.gz'
+      nibabel.save(nibabel.Nifti1Image(data, affine), dwi)
+      nibabel.save(nibabel.Nifti1Image(mask.astype(np.float32), affine), brain)
+      gt.save(bval, bvec)
+      print('Data:\t\t', shape, str(len(gt)) + ' volumes,', int(mask.sum()), 'voxels in mask, snr', snr)
+
+      results = {}
+      results['native (1 cpu)'] = timed(tensor.fit, dwi, bval, bvec, brain, wd + '/native1/dwi', 1)
+      results['native (' + str(ncpus) + ' cpus)'] = timed(tensor.fit, dwi, bval, bvec, brain, wd + '/native/dwi', ncpus)
+
+      dtifit = shutil.which('dtifit')
+      if dtifit:
+        os.makedirs(wd + '/fsl')
+        cmd = [dtifit, '--data=' + dwi, '--mask=' + brain, '--bvecs=' + bvec, '--bvals=' + bval, '--out=' + wd + '/fsl/dwi', '--wls']
+        results['dtifit --wls'] = timed(lambda: subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL))
+
+      nvox = int(mask.sum())
+      print('\n%-22s %10s %14s' % ('backend', 'time (s)', 'voxels / s'))
+      for name, t in results.items():
+        print('%-22s %10.2f %14.0f' % (name, t, nvox / t))
+
+      d = np.abs(nibabel.load(wd + '/native/dwi_FA.nii.gz').get_fdata()[mask] - fa)
+      print('\nnative FA vs ground truth: median absolute error %.3g (noise limited)' % np.median(d))
+
+      if dtifit:
+        print('\nnative vs dtifit --wls (max / median absolute difference, S0 relative to its mean)')
+        for m, (mx, md) in compare(wd + '/native/dwi', wd + '/fsl/dwi', mask).items():
+          print('  %-10s %12.3g %12.3g' % (m, mx, md))
+      else:
+        print('\ndtifit not found on the PATH, agreement with fsl not measured')
+    finally:
+      shutil.rmtree(wd)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -23,53 +23,130 @@
 
 import os
 import sys
-import subprocess
-import multiprocessing
-import glob
-import getopt
-import bids
-import json
-import subprocess
-from subprocess import PIPE
+import copy
+import time
 import re
-import warnings
-from utils import eddy, dtifit, topup, bedpostx, report, custombids
+import argparse
+
+# pipeline modules (numpy, nibabel, pybids, pandas) are imported by main once the arguments are
+# parsed, so --help and argument errors return straight away
 
 
 # ------------------------------------------------------------------------------
-#  Show usage information for this script
+#  Command line options for this script
 # ------------------------------------------------------------------------------
 
-def print_help():
-  print("""
-    Diffusion Preprocessing Pipeline
-        Usage: """ + """ --in=<bids-inputs> --out=<outputs> [OPTIONS]
-        OPTIONS
-          --help                      show this usage information and exit
-          --participant-label=        participant name for processing (pass only 1)
-          --work-dir=                 (Default: /scratch) directory path for working 
-                                        directory
-          --clean-work-dir=           (Default: TRUE) clean working directory 
-          --concat-before-preproc=    (Default: FALSE) boolean to select if input images
-                                        should be concatenated before preprocessing
-          --run-qc=                   (Default: TRUE) boolean to run automated quality 
-                                        control for eddy corrected images
-          --use-repol                 add flag correct outliers in eddy (see more: fsl/eddy 
-                                        user guide)
-          --ignore-preproc            add flag to ignore preprocessing steps, and skip to 
-                                        running tensor-fit or bedpostx. Only use if preprocessing
-                                        is already completed (e.g. qsiprep outputs)  
-          --run-tensor-fit            add flag to run tensor-fit processing on 
-                                        preprocessed images
-          --run-bedpostx              add flag to run bedpostx tractography processing on 
-                                        preprocessed images (default settings used for analysis)
+NOTES = """
     ** OpenMP used for parellelized execution of eddy. Multiple cores (CPUs) 
        are recommended (4 cpus for each dwi scan).
        
     ** see github repository for more information and to report issues: 
        https://github.com/amyhegarty/docker-fsl-fdt.git
-        
-        """)
+"""
+
+def boolean(arg):
+    if arg in ("TRUE", "True", "true"):
+      return True
+    elif arg in ("FALSE", "False", "false"):
+      return False
+    raise argparse.ArgumentTypeError("expected TRUE or FALSE")
+
+def positive(arg):
+    value = int(arg)
+    if value < 1:
+      raise argparse.ArgumentTypeError("must be a positive integer")
+    return value
+
+def minutes(arg):
+    value = float(arg) * 60
+    if value <= 0:
+      raise argparse.ArgumentTypeError("must be a positive number of minutes")
+    return value  # seconds
+
+def gigabytes(arg):
+    value = float(arg)
+    if value <= 0:
+      raise argparse.ArgumentTypeError("must be a positive number of GB")
+    return value
+
+def directory(arg):
+    if not os.path.exists(arg):
+      raise argparse.ArgumentTypeError("BIDS directory does not exist")
+    return arg
+
+def labels(arg):
+    return [p for p in re.split('[, ]+', arg) if p]
+
+def parser():
+    """Declarative description of the command line (entry attribute names as dest)"""
+    p = argparse.ArgumentParser(prog='fdtpipeline.py', description='Diffusion Preprocessing Pipeline',
+                                usage='%(prog)s --in=<bids-inputs> --out=<outputs> --participant-label=<ID> [OPTIONS]',
+                                epilog=NOTES, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('bids_dir', nargs='?', type=directory, help=argparse.SUPPRESS)  # bids app style: <bids_dir> <output_dir> [OPTIONS]
+    p.add_argument('output_dir', nargs='?', help=argparse.SUPPRESS)
+    p.add_argument('-i', '--in', dest='inputs', type=directory, metavar='PATH',
+                   help='(required) BIDS input directory')
+    p.add_argument('-o', '--out', dest='outputs', metavar='PATH',
+                   help='(required) BIDS output / derivatives directory')
+    p.add_argument('--participant-label', dest='pids', required=True, type=labels, metavar='ID',
+                   help='participant name(s) for processing, comma separated list or "all" (run in one batch sharing the cpus)')
+    p.add_argument('--work-dir', dest='wd', metavar='PATH',
+                   help='(Default: <out>/scratch) directory path for working directory')
+    p.add_argument('--scratch', metavar='PATH',
+                   help='node-local scratch or tmpfs directory (e.g. $TMPDIR, /dev/shm): inputs are copied there and all stages '
+                        'run there, derivatives are copied to --out in the background as stages finish')
+    p.add_argument('--clean-work-dir', dest='cleandir', type=boolean, default=False, metavar='{TRUE,FALSE}',
+                   help='(Default: FALSE) clean working directory')
+    p.add_argument('--concat-before-preproc', dest='concat', type=boolean, default=False, metavar='{TRUE,FALSE}',
+                   help='(Default: FALSE) boolean to select if input images should be concatenated before preprocessing')
+    p.add_argument('--run-qc', dest='eddy_QC', type=boolean, default=True, metavar='{TRUE,FALSE}',
+                   help='(Default: TRUE) boolean to run automated quality control for eddy corrected images')
+    p.add_argument('--use-repol', action='store_true',
+                   help='add flag correct outliers in eddy (see more: fsl/eddy user guide)')
+    p.add_argument('--ignore-preproc', action='store_true',
+                   help='add flag to ignore preprocessing steps, and skip to running tensor-fit or bedpostx. '
+                        'Only use if preprocessing is already completed (e.g. qsiprep outputs)')
+    p.add_argument('--run-tensor-fit', dest='rundtifit', action='store_true',
+                   help='add flag to run tensor-fit processing on preprocessed images')
+    p.add_argument('--tensor-backend', type=str.lower, choices=('fsl', 'fsl-slabs', 'native'), default='fsl',
+                   help='(Default: fsl) tensor fitting engine, fsl (dtifit), fsl-slabs (dtifit on z slabs using --n-cpus processes) '
+                        'or native (vectorized numpy fit using --n-cpus processes)')
+    p.add_argument('--run-bedpostx', dest='runbedpostx', action='store_true',
+                   help='add flag to run bedpostx tractography processing on preprocessed images (default settings used for analysis)')
+    p.add_argument('--n-cpus', dest='ncpus', type=positive, default=os.cpu_count(), metavar='N',
+                   help='(Default: all available) total number of cpus used by the pipeline, extra jobs are queued')
+    p.add_argument('--mem-gb', type=gigabytes, metavar='GB',
+                   help='(Default: 90%% of the cgroup memory limit, or of the physical memory) memory shared by the running jobs, '
+                        'jobs are queued until their estimated memory fits')
+    p.add_argument('--omp-nthreads', type=positive, metavar='N',
+                   help='(Default: 4 per dwi scan, or more if cpus are free) number of OpenMP threads for each eddy job')
+    p.add_argument('--stage-timeout', type=minutes, metavar='MIN',
+                   help='(Default: none) minutes after which a running stage is stopped (and counted as failed)')
+    p.add_argument('--resume', action='store_true',
+                   help='add flag to resume an interrupted run: stages recorded as completed in <work-dir>/journal.jsonl are not hashed again '
+                        '(unless an input changed size / time or the options changed), stages interrupted or failed are cleaned up and redone')
+    p.add_argument('--confounds-format', type=str.lower, choices=('tsv', 'parquet', 'feather'), default='tsv',
+                   help='(Default: tsv) extra columnar copy of the per-volume confounds table (written next to the tsv, needs pyarrow)')
+    p.add_argument('--compress-intermediates', action='store_true',
+                   help='add flag to write the working directory images as .nii.gz (default: uncompressed .nii, only the '
+                        'derivatives are compressed, in parallel over --n-cpus threads, when they are published)')
+    p.add_argument('--topup-cache', metavar='PATH',
+                   help='(Default: <out>/cache/topup, also with --scratch so jobs on every node share it) directory of the '
+                        'topup field cache shared by all runs, "none" to disable')
+    p.add_argument('--topup-cache-size', type=float, default=10., metavar='GB',
+                   help='(Default: 10) size of the topup cache, the least recently used fields are removed beyond it')
+    p.add_argument('--executor', type=str.lower, choices=('local', 'slurm', 'pbs'), default='local',
+                   help='(Default: local) where the stages run: local (this machine), slurm or pbs (job scripts written to '
+                        '<work-dir>/jobs and submitted with dependencies, per-scan stages as array jobs)')
+    p.add_argument('--plan-only', action='store_true',
+                   help='add flag to only write the job scripts (and plan.json) without running or submitting them. '
+                        'Run them locally with: python -m utils.cluster run <work-dir>/jobs')
+    p.add_argument('--reset-bids-db', dest='reset_db', action='store_true',
+                   help='add flag to rebuild the cached bids index (saved in <work-dir>/bids_db) even if the dataset is unchanged')
+    return p
+
+def print_help():
+    parser().print_help()
 
 # ------------------------------------------------------------------------------
 #  Parse arguements for this script
@@ -77,97 +154,47 @@ def print_help():
 
 def parse_arguments(argv):
 
-    #intialize arguements
+    p = parser()
+    entry = p.parse_args(argv)
+
     print("\nParsing User Inputs...")
-    cat = False
-    qc = True
-    cleandir = False
-    runfit = False
-    runbedpostx = False
-    use_repol = False
-    ignore_preproc = False
-
-
-    try:
-      opts, args = getopt.getopt(argv,"hi:o:",["in=","out=","help","participant-label=","work-dir=","clean-work-dir=","concat-before-preproc=","run-qc=","use-repol","ignore-preproc","run-tensor-fit","run-bedpostx"])
-    except getopt.GetoptError:
-      print_help()
-      sys.exit(2)
-    for opt, arg in opts:
-      if opt in ("-h", "--help"):
-         print_help()
-         sys.exit()
-      elif opt in ("-i", "--in"):
-         inputs = arg
-         if not os.path.exists(inputs):
-           raise Exception("BIDS directory does not exist")
-      elif opt in ("-o", "--out"):
-         outputs = arg
-      elif opt in ("--participant-label"):
-         pid = arg
-      elif opt in ("--work-dir"):
-         wd = arg
-      elif opt in ("--clean-work-dir"):
-         cleandir = arg
-      elif opt in ("--concat-before-preproc"):
-         cat = arg
-         if cat in ("TRUE", "True", "true"):
-            cat = True
-         elif cat in ("FALSE", "False", "false"):
-            cat = False
-         else:
-            raise Exception("Error: --concat-preproc= [TRUE / FALSE]")
-      elif opt in ("--run-qc"):
-         qc = arg
-         if qc in ("TRUE", "True", "true"):
-            qc = True
-         elif qc in ("FALSE", "False", "false"):
-            qc = False
-         else:
-            raise Exception("Error: --run-qc= [TRUE / FALSE]")
-      elif opt in ("--run-tensor-fit"):
-        runfit = True
-      elif opt in ("--run-bedpostx"):
-        runbedpostx = True       
-      elif opt in ("--use-repol"):
-        use_repol = True  
-      elif opt in ("--ignore-preproc"):
-        ignore_preproc = True  
-                                        
-    if 'inputs' not in locals():
-      print_help()
-      raise Exception("Missing required argument --in=")
-      sys.exit()
-    if 'outputs' not in locals():
-      print_help()
-      raise Exception("Missing required argument --out=")
-      sys.exit()
-    if 'pid' not in locals():
-      print_help()
-      raise Exception("Missing required argument --participant-label=")
-      sys.exit()
-    if 'wd' not in locals():
-      wd=outputs+'/scratch/sub-'+pid
-      
-    print('Input Bids directory:\t', inputs)
-    print('Derivatives path:\t', outputs)
-    print('Participant:\t\t', str(pid))
-
-    class args:
-      def __init__(self, wd, inputs, outputs, pid, cat, qc, cleandir, runfit, runbedpostx,use_repol,ignore_preproc):
-        self.wd = wd
-        self.inputs = inputs
-        self.outputs = outputs
-        self.pid = pid
-        self.concat= cat
-        self.eddy_QC=qc
-        self.cleandir=cleandir
-        self.rundtifit=runfit
-        self.runbedpostx=runbedpostx
-        self.use_repol=use_repol
-        self.ignore_preproc=ignore_preproc
-
-    entry = args(wd, inputs, outputs, pid, cat, qc, cleandir, runfit, runbedpostx, use_repol,ignore_preproc)
+    entry.inputs = entry.inputs or entry.bids_dir
+    entry.outputs = entry.outputs or entry.output_dir
+    if entry.inputs is None:
+      p.error("Missing required argument --in=")
+    if entry.outputs is None:
+      p.error("Missing required argument --out=")
+    if entry.confounds_format != 'tsv':
+      import importlib.util
+      if importlib.util.find_spec('pyarrow') is None:
+        p.error("--confounds-format=" + entry.confounds_format + " requires the pyarrow package")
+
+    if entry.scratch is not None and (entry.plan_only or entry.executor != 'local'):
+      p.error("--scratch can only be used with the local executor (batch jobs run on other nodes)")
+
+    entry.pid = None  # set for each participant (see subject_entry)
+    entry.scans = None  # scan metadata table of the participant (see utils/scans.py)
+    entry.final_outputs = entry.outputs  # output directory once staged derivatives are copied out (see staging.py)
+    if entry.topup_cache is None:
+      entry.topup_cache = os.path.abspath(entry.outputs) + '/cache/topup'
+    elif entry.topup_cache.lower() == 'none':
+      entry.topup_cache = None
+    else:
+      entry.topup_cache = os.path.abspath(entry.topup_cache)
+    if entry.wd is None:
+      if entry.scratch is not None:
+        from utils import staging
+        entry.wd = staging.root(entry.scratch, entry.outputs, entry.pids) + '/work'
+      else:
+        entry.wd = entry.outputs + '/scratch'
+      entry.subject_wd = True
+    else:
+      entry.subject_wd = (len(entry.pids) > 1 or entry.pids == ['all'])  # batch mode: one working directory per participant
+
+    print('Input Bids directory:\t', entry.inputs)
+    print('Derivatives path:\t', entry.outputs)
+    print('Participant:\t\t', ', '.join(entry.pids))
+    print('CPUs:\t\t\t', str(entry.ncpus))
 
     return entry
 
@@ -175,42 +202,122 @@ def parse_arguments(argv):
 #  Main Pipeline Starts Here...
 # ------------------------------------------------------------------------------
  
-def main(argv):
+def subject_entry(entry,pid):
+    """Copy of the user entry for a single participant (with its own working directory)"""
+    sub = copy.copy(entry)
+    sub.pid = pid
+    sub.scans = None
+    if entry.subject_wd:
+      sub.wd = entry.wd + '/sub-' + pid
+    return sub
 
-    # get user entry
-    entry = parse_arguments(argv)
+def plan_subject(graph,db,entry):
+    """Adds all pipeline stages of one participant to the graph"""
+    from utils import topup, eddy, dtifit, bedpostx, metrics, scans
 
     os.makedirs(entry.wd, exist_ok=True)
     logdir = entry.wd + '/logs'
     os.makedirs(logdir, exist_ok=True)
+    metrics.record(metrics.logfile(entry), {'run': time.time(), 'participant': entry.pid})  # start of this run in the metrics file
 
-    # get participant bids path:
-    db = custombids.data(entry)
+    deps = []
 
     if not entry.ignore_preproc:
       # pipeline: (1) topup, (2) eddy, (3) dtifit
-      if not os.path.exists(entry.wd + '/topup/topup_b0_iout.nii.gz'):
-          topup.run(db,entry)
+      # (stages are skipped when their manifest shows the outputs are up to date)
+      scans.table(db,entry)  # headers / sidecars / gradients of every dwi scan, read and checked once
+      deps = [topup.plan(graph,db,entry)]
       
       # two run options: 
       if entry.concat == False:
         # (1) distortion and eddy correct each aquisition seperately
-        eddy.run_eddy_opt1(db,entry)
+        deps, images = eddy.plan_eddy_opt1(graph,db,entry,deps)
 
       else:
         # (2) concatenate all aquisitions before preprocessing
-        eddy.run_eddy_opt2(db,entry)
+        deps, images = eddy.plan_eddy_opt2(graph,db,entry,deps)
 
-    db.add_derivatives(entry.outputs + '/FDT')
+    else:
+      images = [dwi.path for dwi in db.get(subject=entry.pid, scope='derivatives', extension='nii.gz', suffix='dwi')]
 
     if entry.rundtifit == True:
-      dtifit.run(db,entry)
+      dtifit.plan(graph,entry,images,deps)
     
     if entry.runbedpostx == True:
-      bedpost.run(db,entry)
+      bedpostx.plan(graph,entry,images,deps)
+
+def main(argv):
+
+    # get user entry
+    entry = parse_arguments(argv)
+
+    from utils import report, custombids, scheduler, metrics, cluster, staging
+
+    # node-local scratch: inputs copied there, derivatives copied back in the background as stages finish
+    copier = None
+    if entry.scratch is not None:
+      copier = staging.setup(entry)
+
+    # get bids layout (indexed once for all participants):
+    db = custombids.data(entry)
+
+    if entry.ignore_preproc:
+      custombids.add_derivatives(db,entry)
+
+    pids = entry.pids
+    if pids == ['all']:
+      pids = db.get_subjects()
+
+    # every stage of every participant is added to one dependency graph, a stage starts as soon as its inputs exist
+    graph = scheduler.Graph(entry.ncpus, timeout=entry.stage_timeout, on_done=copier.stage_done if copier else None, mem_gb=entry.mem_gb)
+    subjects = []; failed = []
+
+    for pid in pids:
+      sub = subject_entry(entry,pid)
+      subgraph = graph.subject(pid, metrics.logfile(sub))
+      try:
+        plan_subject(subgraph,db,sub)
+        subjects.append((sub, subgraph))
+      except Exception as err:
+        # one failing participant should not stop the rest of the batch
+        print('Participant ' + pid + ' failed: ' + str(err))
+        failed.append(pid)
+
+    # batch system: stages exported as job scripts, the jobs still need the working directories (no clean-up)
+    if entry.plan_only or entry.executor != 'local':
+      jobsdir = cluster.export(graph, entry.wd + '/jobs', entry.executor)
+      if not entry.plan_only:
+        cluster.submit(jobsdir, entry.executor)
+      if failed:
+        print('Failed participants: ' + ', '.join(failed))
+        sys.exit(1)
+      return
+
+    # a failing stage stops the rest of its participant straight away (sibling jobs cancelled)
+    failures = graph.run()
+    for sub, subgraph in subjects:
+      if subgraph.prefix in failures:
+        failed.append(sub.pid + ' (stage ' + failures[subgraph.prefix] + ')')
+
+    # outstanding copies of the derivatives (the only point where the pipeline waits for them)
+    if copier is not None:
+      copier.close(pids)
+
+    # per stage timeline (wall / cpu time, memory, i/o) for each participant
+    for sub, subgraph in subjects:
+      if os.path.exists(metrics.logfile(sub)):
+        print('Stage timeline: ' + metrics.export(metrics.logfile(sub)))
+    subjects = [sub for sub, subgraph in subjects if subgraph.prefix not in failures]
+
+    # clean-up (working directories of failed participants are kept for inspection / resubmission)
+    for sub in subjects:
+      report.cleanup(sub)
+    if entry.scratch is not None and entry.cleandir and not failed:
+      staging.cleanup(entry, pids)  # staged inputs and derivative copies (already copied out) on the scratch disk
 
-    # clean-up
-    report.cleanup(entry)
+    if failed:
+      print('Failed participants: ' + ', '.join(failed))
+      sys.exit(1)
     
 
 if __name__ == "__main__":
@@ -1,75 +1,119 @@
 # FDT utility functions for running bedpostx in fsl
 # inputs: layout --> BIDSLayout object loaded from study directory
-#         entry  --> structure with all the user defined inputs 
-
-import os, sys, subprocess, multiprocessing, glob, getopt, bids, json, re, warnings
-from subprocess import PIPE
-import pandas as pd
-
-def worker(name,cmdfile):
-    """Executes the bash script"""
-    process = subprocess.Popen(cmdfile.split(), stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    output, error = process.communicate()
-    print(error)
-    print('Worker: ' + name + ' finished')
-    return
-               
-# run tractography on preprocessed dwi
-def run(layout,entry):
+#         entry  --> structure with all the user defined inputs
+#
+# bedpostx fits every slice independently (xfibres), and without a cluster (FSLMACHINELIST / fsl_sub)
+# runs them one after the other on a single core. The pipeline does the split itself: a setup stage
+# lays out <work-dir>/bedpostx_dwi.bedpostX as bedpostx_preproc.sh would, --n-cpus slice stages each
+# fit the slices task, task + ntasks, ... (bedpostx_single_slice.sh), scheduled within the cpu budget
+# like any other stage, and a merge stage runs bedpostx_postproc.sh to build the standard .bedpostX
+# outputs. Finished slices are marked in logs/monitor (as bedpostx does), so an interrupted slice
+# stage only refits its unfinished slices. Progress is printed to the slice stage logs, the time of
+# every slice is written to <work-dir>/bedpostx_slices/task_<N>.json.
+
+import os, sys, json, time, subprocess
+from . import scheduler, metrics, manifest, memory
+
+# bedpostx defaults (fsl 6): 3 fibres, model 2, 1000 burn in jumps, 1250 jumps sampled every 25
+OPTIONS = '--nf=3 --fudge=1 --bi=1000 --nj=1250 --se=25 --model=2 --cnonlinear'
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# add tractography stages to the pipeline graph
+#   images --> preprocessed dwi derivatives (absolute paths), bval / bvec / brain-mask share the image name
+#   deps   --> stages producing the preprocessed images
+def plan(graph,entry,images,deps=()):
 
   # using the distortion corrected dti images, we will compute tractograpy
-  itr=0; s=', ';
-  nfiles = len(layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'))
   jobs=[];
-                                             
-  dwi=layout.get(subject=entry.pid, scope='derivatives', extension='nii.gz', suffix='dwi');
-  preproc_img = dwi.path
+
+  preproc_img = images[0]
   spath = preproc_img.replace("dwi.nii.gz","")
-  
-  if not os.path.exists(entry.outputs + '/FDT/' + spath + '.bedpostX'):                                        
-      bval = layout.get_bval(dwi.path)
-      bvec = layout.get_bvec(dwi.path)
-      mask = preproc_img.replace('.nii.gz','_brain-mask.nii.gz')
-
-      print("Running bedpostx: " + preproc_img)
-
-      # write bash script for execution
-      original_stdout = sys.stdout # Save a reference to the original standard output
-      sys.stdout.flush()
-
-      with open(entry.wd + '/cmd_bedpost_dwi.sh', 'w') as fid:
-        sys.stdout = fid # Change the standard output to the file we created.
-
-        print('#!/usr/bin/bash')
-        print('mkdir -p ' + entry.wd + '/bedpostx_dwi')
-        print('cd ' + entry.wd)
-        print('imcp ' + preproc_img + ' bedpostx_dwi/data.nii.gz')
-        print('imcp ' + mask + ' bedpostx_dwi/nodif_brain_mask.nii.gz')    
-        print('cp ' + bval + ' bedpostx_dwi/bvals')                                      
-        print('cp ' + bvec + ' bedpostx_dwi/bvecs')   
-        
-        # add commands here...
-                                             
-        print("bedpostx bedpostx_dwi")
-
-        #move outputs to derivative folder
-        spath = preproc_img.replace("dwi.nii.gz","")
-        print('mv bedpostx_dwi.bedpostX ' + entry.outputs + '/FDT/' + spath + '.bedpostX' )
-
-        sys.stdout = original_stdout # Reset the standard output to its original value
-
-      # change permissions to make sure file is executable 
-      os.chmod(entry.wd + '/cmd_bedpost_dwi.sh', 0o774)
-
-      # run script
-      cmd = 'bash ' + entry.wd + '/cmd_bedpost_dwi.sh'
-      name = 'bedpost' + str(itr)
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
-  for job in jobs:
-    job.join()  #wait for all eddy commands to finish
+
+  bval = preproc_img.replace('nii.gz','bval')
+  bvec = preproc_img.replace('nii.gz','bvec')
+  mask = preproc_img.replace('.nii.gz','_brain-mask.nii.gz')
+
+  print("Running bedpostx: " + preproc_img)
+
+  subjdir = entry.wd + '/bedpostx_dwi'
+  linked = [subjdir + f for f in ('/data.nii.gz', '/nodif_brain_mask.nii.gz', '/bvals', '/bvecs')]
+
+  # (1) inputs linked from the derivatives (read only, no copy of the image), empty .bedpostX layout
+  cmd = 'mkdir -p ' + subjdir + '\n'
+  cmd += 'cd ' + entry.wd + '\n'
+  cmd += scheduler.publish(preproc_img, 'bedpostx_dwi/data.nii.gz')
+  cmd += scheduler.publish(mask, 'bedpostx_dwi/nodif_brain_mask.nii.gz')
+  cmd += scheduler.publish(bval, 'bedpostx_dwi/bvals')
+  cmd += scheduler.publish(bvec, 'bedpostx_dwi/bvecs')
+  cmd += 'rm -rf bedpostx_dwi.bedpostX bedpostx_slices bedpostx_dwi/*_slice_*\n'
+  cmd += 'mkdir -p bedpostx_dwi.bedpostX/diff_slices bedpostx_dwi.bedpostX/logs/monitor bedpostx_dwi.bedpostX/xfms bedpostx_slices\n'
+  cmd += 'cp bedpostx_dwi/bvals bedpostx_dwi/bvecs bedpostx_dwi.bedpostX/\n'
+  cmd += 'if [ -f ${FSLDIR}/etc/flirtsch/ident.mat ]; then cp ${FSLDIR}/etc/flirtsch/ident.mat bedpostx_dwi.bedpostX/xfms/eye.mat; fi\n'
+  cmd += scheduler.publish('bedpostx_dwi/nodif_brain_mask.nii.gz', 'bedpostx_dwi.bedpostX/nodif_brain_mask.nii.gz')
+  setup = graph.add('bedpost_dwi_setup', scheduler.script(entry, 'bedpost_dwi_setup', cmd), deps,
+                    manifest=manifest.stage(entry, 'bedpost_dwi_setup', [preproc_img, bval, bvec, mask], linked, cmd))
+
+  # (2) slice fits, one single core stage per cpu (slices interleaved: the brain is not spread evenly over z)
+  ntasks = entry.ncpus
+  records = []
+  for task in range(ntasks):
+    name = 'bedpost_dwi_slices_' + str(task)
+    records.append(entry.wd + '/bedpostx_slices/task_' + str(task) + '.json')
+    cmd = 'cd ' + CODE + '\n'
+    cmd += sys.executable + ' -m utils.bedpostx ' + subjdir + ' ' + str(task) + ' ' + str(ntasks) + ' ' + records[-1] + ' ' + OPTIONS
+    jobs.append(graph.add(name, scheduler.script(entry, name, cmd), [setup], mem=memory.Model(linked[:1], memory.SLICES),
+                          manifest=manifest.stage(entry, name, linked, [records[-1]], cmd)))
+
+  # (3) merge the slices (standard .bedpostX outputs) and publish, hard linked: the fitted results stay in
+  # the working directory so a removed derivative is published again without refitting
+  cmd = 'cd ' + entry.wd + '\n'
+  cmd += 'if [ -d bedpostx_dwi.bedpostX/diff_slices ]; then bedpostx_postproc.sh bedpostx_dwi; fi\n'
+  cmd += scheduler.publish('bedpostx_dwi.bedpostX', spath + '.bedpostX', threads=entry.ncpus)
+
+  return [graph.add('bedpost_dwi', scheduler.script(entry, 'bedpost_dwi', cmd), jobs, ncpus=entry.ncpus,  # gzip threads
+                    manifest=manifest.stage(entry, 'bedpost_dwi', linked + records, [spath + '.bedpostX'], cmd))]
+
+  ## end plan
+
+def fit_slices(subjdir,task,ntasks,record,options=OPTIONS):
+  """Fits the slices task, task + ntasks, ... of subjdir (bedpostx_single_slice.sh), skipping slices
+  finished before. Slices are cut from the data in one pass, in the fsl output format. Writes the
+  time of every slice to record"""
+  from . import nifti
+  monitor = subjdir + '.bedpostX/logs/monitor/'
+  ext = '.nii' if os.environ.get('FSLOUTPUTTYPE') == 'NIFTI' else '.nii.gz'
+
+  nz = nifti.load(subjdir + '/data.nii.gz').shape[2]
+  mine = list(range(task, nz, ntasks))
+  todo = [z for z in mine if not (os.path.exists(monitor + str(z)) and os.path.isdir(subjdir + '.bedpostX/diff_slices/data_slice_%04d' % z))]
+  print('bedpostx slice task ' + str(task) + ' of ' + str(ntasks) + ': ' + str(len(mine)) + ' slices of ' + str(nz) +
+        ', ' + str(len(mine) - len(todo)) + ' finished before', flush=True)
+  for f in ('data', 'nodif_brain_mask'):
+    nifti.slices(subjdir + '/' + f + '.nii.gz', todo, [subjdir + '/' + f + '_slice_%04d' % z + ext for z in todo])
+
+  times = []
+  for z in todo:
+    start = time.time()
+    subprocess.run(['bedpostx_single_slice.sh', subjdir, str(z)] + options.split(), check=True)
+    times.append({'slice': z, 'start': start, 'wall': time.time() - start})
+    done = len(os.listdir(monitor))
+    print('slice %04d done in %.1f s (task: %d / %d, all: %d / %d slices)' % (z, times[-1]['wall'], len(times), len(todo), done, nz), flush=True)
+
+  with open(record + '.part', 'w') as fid:
+    json.dump({'task': task, 'ntasks': ntasks, 'nslices': nz, 'skipped': [z for z in mine if z not in todo], 'slices': times}, fid)
+  os.replace(record + '.part', record)
+
+# run tractography on preprocessed dwi
+def run(layout,entry):
+
+  images = [dwi.path for dwi in layout.get(subject=entry.pid, scope='derivatives', extension='nii.gz', suffix='dwi')]
+
+  graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+  plan(graph,entry,images)
+  graph.run(strict=True)  #wait for bedpostx to finish
 
   ## end run
+
+if __name__ == "__main__":
+  # slice stage: python -m utils.bedpostx <subjdir> <task> <ntasks> <record> [xfibres options]
+  fit_slices(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), sys.argv[4], ' '.join(sys.argv[5:]) or OPTIONS)
@@ -0,0 +1,120 @@
+# FDT utility functions for caching stage results by content (used for topup)
+# usage: python cache.py --cache=DIR [--size-gb=N] [--key=FILE ...] --output=FILE [--output=FILE ...] -- <command>
+#
+# The key is the sha1 of the key files (nifti images by their voxel data and geometry, so .nii and
+# .nii.gz copies of an image, or images written at another time, give the same key), of the command,
+# of the fsl version and of $FSLOUTPUTTYPE. A hit links the cached outputs into place (hard link,
+# reflink or copy, see publish.py) instead of running the command; a miss runs the command and links
+# its outputs into <cache>/<key>. Entries are used in least recently used order: once the cache holds
+# more than --size-gb, the entries used longest ago are removed.
+# Standalone (standard library only): called from the stage bash scripts, see topup.py.
+
+import os, sys, gzip, struct, getopt, hashlib, subprocess
+from publish import place, remove
+
+BLOCK = 1 << 20
+
+def image_hash(path,h):
+    """Adds the geometry (dims, voxel sizes, data type, scaling, qform / sform) and the voxel data of a nifti image"""
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as fid:
+      hdr = fid.read(348)
+      endian = '<' if struct.unpack('<i', hdr[:4])[0] == 348 else '>'
+      offset = int(struct.unpack(endian + 'f', hdr[108:112])[0])
+      for a, b in ((40, 108), (112, 120), (252, 348)):  # header fields without the description / offset
+        h.update(hdr[a:b])
+      fid.read(offset - 348)  # extensions
+      for block in iter(lambda: fid.read(BLOCK), b''):
+        h.update(block)
+
+def key(files,command):
+    h = hashlib.sha1()
+    for f in files:
+      name = os.path.basename(f)
+      h.update((name[:-len('.gz')] if name.endswith('.gz') else name).replace('.nii', '').encode() + b'\0')
+      if not os.path.exists(f):
+        h.update(b'missing\0')
+      elif f.endswith(('.nii', '.nii.gz')):
+        image_hash(f, h)
+      else:
+        with open(f, 'rb') as fid:
+          for block in iter(lambda: fid.read(BLOCK), b''):
+            h.update(block)
+    try:
+      with open(os.environ.get('FSLDIR', '') + '/etc/fslversion') as fid:
+        h.update(fid.read().strip().encode())
+    except OSError:
+      pass
+    h.update((' '.join(command) + '\0' + os.environ.get('FSLOUTPUTTYPE', 'NIFTI_GZ')).encode())
+    return h.hexdigest()
+
+def size(path):
+    return sum(os.path.getsize(os.path.join(b, f)) for b, d, files in os.walk(path) for f in files)
+
+def evict(cache,limit,keep):
+    """Removes the least recently used entries (but keep) until the cache holds at most limit bytes"""
+    entries = [os.path.join(cache, e) for e in os.listdir(cache) if len(e) == 40]
+    entries = sorted(entries, key=lambda e: os.stat(e).st_mtime)
+    total = sum(size(e) for e in entries)
+    for e in entries:
+      if total <= limit:
+        break
+      if e != keep:
+        total -= size(e)
+        remove(e)
+        print('Removed topup cache entry (least recently used): ' + e)
+
+def run(cache,limit,keyfiles,outputs,command):
+    """Materializes outputs from the cache, or runs the command and caches them. Returns the exit code"""
+    k = key(keyfiles, command)
+    entry = os.path.join(cache, k)
+    names = [os.path.basename(f) for f in outputs]
+
+    if os.path.isdir(entry) and all(os.path.exists(os.path.join(entry, n)) for n in names):
+      for f, n in zip(outputs, names):
+        remove(f)
+        place(os.path.join(entry, n), f)
+      os.utime(entry)  # most recently used
+      print('Cache hit ' + k + ': ' + ', '.join(names) + ' linked from ' + entry)
+      return 0
+
+    print('Cache miss ' + k + ', running: ' + ' '.join(command), flush=True)
+    code = subprocess.call(command)
+    if code != 0:
+      return code
+
+    # stored next to the entry then renamed (concurrent runs with the same key keep one copy)
+    os.makedirs(cache, exist_ok=True)
+    part = entry + '.part-' + str(os.getpid())
+    os.makedirs(part)
+    for f, n in zip(outputs, names):
+      place(f, os.path.join(part, n))
+    try:
+      os.rename(part, entry)
+    except OSError:
+      remove(part)
+    evict(cache, limit, entry)
+    return 0
+
+def main(argv):
+    cache = None; limit = 10.; keyfiles = []; outputs = []
+    if '--' not in argv:
+      argv = argv + ['--']
+    i = argv.index('--')
+    opts, args = getopt.getopt(argv[:i], "", ["cache=", "size-gb=", "key=", "output="])
+    for opt, arg in opts:
+      if opt == "--cache":
+        cache = arg
+      elif opt == "--size-gb":
+        limit = float(arg)
+      elif opt == "--key":
+        keyfiles.append(arg)
+      elif opt == "--output":
+        outputs.append(arg)
+    command = argv[i + 1:]
+    if cache is None or not outputs or not command:
+      print('usage: python cache.py --cache=DIR [--size-gb=N] [--key=FILE ...] --output=FILE [--output=FILE ...] -- <command>')
+      sys.exit(2)
+    sys.exit(run(cache, limit * 2.**30, keyfiles, outputs, command))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
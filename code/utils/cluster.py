@@ -0,0 +1,250 @@
+# FDT utility functions for exporting the pipeline graph as batch job scripts (slurm / pbs)
+# inputs: graph    --> scheduler.Graph with every planned stage
+#         jobsdir  --> directory receiving the job scripts (<work-dir>/jobs)
+#         executor --> slurm, pbs or local (plain bash scripts, no scheduler directives)
+#
+# Each stage becomes one job. Stages repeated for every dwi scan of a participant (same name apart
+# from the scan / iteration number, same resources) are merged into one array job with one task per
+# scan, e.g. topup -> eddy array -> concat -> dtifit / bedpostx. Jobs wait on the jobs of their
+# dependencies (afterok), stages already up to date (manifest) are left out. Stages are run through
+# "python -m utils.cluster stage <spec>" (json spec of the bash command or python function), which checks,
+# invalidates and commits the stage manifest and journal like the local scheduler, so the next local run or
+# export skips them and interrupted jobs have their partial outputs removed.
+# CPU requests are the stage cpus, memory requests come from the stage's previous runs (metrics file,
+# max rss + 50%) or from its memory model (at least MEM_MB). submit.sh submits the jobs in order, plan.json describes them for the
+# local stand-in executor: python -m utils.cluster run <jobsdir> [ncpus] (runs the same scripts).
+
+import os, re, sys, json, math, shutil, importlib, subprocess
+from . import scheduler, memory, manifest
+
+MEM_MB = 4096     # smallest memory request of stages without history
+SCAN = re.compile(r'(?<=iter)\d+|(?<=_)\d+(?=_|$)')  # scan number in stage names (eddy_opt1_iter00_eddy, tensor_dwi_0)
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def request_mb(node):
+    """Memory request (MB) of a stage: largest max rss of its previous runs + margin, otherwise its memory
+    model (nifti header sizes of its inputs, see memory.py) but at least MEM_MB (inputs written by earlier
+    jobs are not there yet when the jobs are exported)"""
+    mb = memory.history(node.metrics, node.name)
+    if mb is None:
+      mb = max(memory.estimate(node), MEM_MB)
+    return int(math.ceil(mb / 256.) * 256)
+
+def command(node,jobsdir):
+    """Command line running one stage: its bash script, or a json spec run by "python -m utils.cluster stage"
+    (python function, and / or the stage manifest checked and written around the stage as Graph.supervise does)"""
+    if node.target is None and node.manifest is None:
+      return node.cmd
+    spec = {'name': node.name}
+    if node.target is None:
+      spec['cmd'] = node.cmd
+    else:
+      spec.update({'module': node.target.__module__, 'function': node.target.__name__, 'args': list(node.args)})
+    m = node.manifest
+    if m is not None:
+      spec['manifest'] = {'path': m.path, 'inputs': m.inputs, 'outputs': m.outputs, 'options': m.options,
+                          'journal': m.journal.path if m.journal is not None else None, 'resume': m.resume}
+    path = jobsdir + '/stages/' + node.name + '.json'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+      with open(path, 'w') as fid:
+        json.dump(spec, fid, indent=1)
+    except TypeError as err:
+      raise Exception("Stage " + node.name + " can not be exported (arguments not serializable): " + str(err))
+    return 'cd ' + CODE + ' && ' + sys.executable + ' -m utils.cluster stage ' + path
+
+def call(s):
+    """Runs a stage described by a json spec (bash command or python function), returns its exit code"""
+    if 'cmd' in s:
+      code = subprocess.call(s['cmd'].split())
+      return code if code >= 0 else 128 - code  # killed by a signal: shell convention
+    getattr(importlib.import_module(s['module']), s['function'])(*s['args'])
+    return 0
+
+def stage(path):
+    """Runs one exported stage like the local scheduler: skipped when its manifest is current, otherwise
+    partial outputs of an interrupted run are removed, the stage runs and its manifest and journal entry
+    are written on success (so later local runs or re-exports skip it), a failure is journaled. Returns the exit code"""
+    with open(path) as fid:
+      s = json.load(fid)
+    m = None
+    if s.get('manifest') is not None:
+      r = s['manifest']
+      m = manifest.Manifest(r['path'], r['inputs'], r['outputs'], r['options'],
+                            manifest.Journal(r['journal']) if r['journal'] else None, r['resume'])
+      if m.current():
+        print('Stage outputs up to date...skipping: ' + s['name'])
+        return 0
+      m.invalidate()
+    try:
+      code = call(s)
+    except Exception:
+      if m is not None:
+        m.fail()
+      raise
+    if m is not None and code == 0:
+      m.commit()
+    elif m is not None:
+      m.fail()
+    return code
+
+def group(nodes):
+    """Merges the per-scan copies of a stage into array jobs: {job name: [stage names]}"""
+    keys = {}
+    for name, node in nodes.items():
+      prefix = node.group or ''
+      key = (prefix + SCAN.sub('N', name[len(prefix):]), node.target is None, node.ncpus, node.timeout)
+      keys.setdefault(key, []).append(name)
+
+    jobs = {}
+    for key, names in keys.items():
+      chained = any(d in names for n in names for d in nodes[n].deps)  # copies waiting on each other stay separate jobs
+      if len(names) > 1 and not chained:
+        jobs[key[0]] = names
+      else:
+        for n in names:
+          jobs[n] = [n]
+    return jobs
+
+def order(jobs,deps):
+    """Job names in dependency order (None if grouping created a cycle)"""
+    done = []; left = list(jobs)
+    while left:
+      ready = [j for j in left if deps[j] <= set(done)]
+      if not ready:
+        return None
+      done += ready
+      left = [j for j in left if j not in ready]
+    return done
+
+def directives(executor,name,ntasks,ncpus,mem,timeout,logdir):
+    """Resource request header of a job script"""
+    lines = []
+    if executor == 'slurm':
+      lines += ['#SBATCH --job-name=' + name, '#SBATCH --cpus-per-task=' + str(ncpus), '#SBATCH --mem=' + str(mem) + 'M']
+      if timeout:
+        lines.append('#SBATCH --time=' + str(int(math.ceil(timeout / 60.))))
+      if ntasks > 1:
+        lines += ['#SBATCH --array=0-' + str(ntasks - 1), '#SBATCH --output=' + logdir + '/' + name + '_%A_%a.log']
+      else:
+        lines.append('#SBATCH --output=' + logdir + '/' + name + '_%j.log')
+    elif executor == 'pbs':
+      lines += ['#PBS -N ' + name[:15], '#PBS -l select=1:ncpus=' + str(ncpus) + ':mem=' + str(mem) + 'mb', '#PBS -j oe', '#PBS -o ' + logdir + '/']
+      if timeout:
+        t = int(math.ceil(timeout))
+        lines.append('#PBS -l walltime=%d:%02d:%02d' % (t // 3600, t // 60 % 60, t % 60))
+      if ntasks > 1:
+        lines.append('#PBS -J 0-' + str(ntasks - 1))
+    return lines
+
+def submit_script(executor,jobs,deps):
+    """submit.sh: submits every job once the ids of its dependencies are known"""
+    ids = dict((j, 'j' + str(i)) for i, j in enumerate(jobs))
+    lines = ['#!/usr/bin/bash', '# submits the pipeline jobs in dependency order', 'set -e', 'cd "$(dirname "$0")"']
+    for j in jobs:
+      after = ':'.join('$' + ids[d] for d in sorted(deps[j], key=jobs.index))
+      if executor == 'slurm':
+        lines.append(ids[j] + '=$(sbatch --parsable ' + ('--dependency=afterok:' + after + ' ' if after else '') + j + '.sh)')
+        lines.append(ids[j] + '=${' + ids[j] + '%%;*}')
+      else:
+        lines.append(ids[j] + '=$(qsub ' + ('-W depend=afterok:' + after + ' ' if after else '') + j + '.sh)')
+      lines.append('echo "' + j + ': $' + ids[j] + '"')
+    return '\n'.join(lines) + '\n'
+
+def export(graph,jobsdir,executor='slurm'):
+    """Writes one job script per job (array jobs for the per-scan stages), submit.sh and plan.json.
+    Returns the jobs directory"""
+    if executor not in ('slurm', 'pbs', 'local'):
+      raise Exception("Unknown executor: " + executor)
+    logdir = jobsdir + '/logs'
+    os.makedirs(logdir, exist_ok=True)
+
+    # stages already up to date are not exported (their dependents do not wait on them)
+    nodes = {}
+    for name, node in graph.nodes.items():
+      if node.manifest is not None and node.manifest.current():
+        print('Stage outputs up to date...skipping: ' + name)
+      else:
+        nodes[name] = node
+
+    jobs = group(nodes)
+    job = dict((n, j) for j, names in jobs.items() for n in names)
+    deps = dict((j, set(job[d] for n in names for d in nodes[n].deps if d in job) - {j}) for j, names in jobs.items())
+    ordered = order(jobs, deps)
+    if ordered is None:  # merged stages depend on each other through other jobs: one job per stage
+      jobs = dict((n, [n]) for n in nodes)
+      deps = dict((n, set(d for d in nodes[n].deps if d in nodes)) for n in nodes)
+      ordered = order(jobs, deps)
+      if ordered is None:
+        raise Exception("Unable to export pipeline stages (circular dependency)")
+
+    plan = []
+    for j in ordered:
+      names = jobs[j]
+      node = nodes[names[0]]
+      mem = max(request_mb(nodes[n]) for n in names)
+      script = jobsdir + '/' + j + '.sh'
+      with open(script, 'w') as fid:
+        fid.write('#!/usr/bin/bash\n')
+        fid.write(''.join(l + '\n' for l in directives(executor, j, len(names), node.ncpus, mem, node.timeout, logdir)))
+        fid.write('set -e\n')
+        fid.write('export OMP_NUM_THREADS=' + str(node.ncpus) + '\n')
+        if len(names) == 1:
+          fid.write(command(node, jobsdir) + '\n')
+        else:
+          # array task id from the batch system (or the first argument when run by hand)
+          fid.write('task=${SLURM_ARRAY_TASK_ID:-${PBS_ARRAY_INDEX:-$1}}\n')
+          fid.write('case "$task" in\n')
+          for i, n in enumerate(names):
+            fid.write('  ' + str(i) + ') ' + command(nodes[n], jobsdir) + ' ;;\n')
+          fid.write('  *) echo "unknown array task: $task" >&2; exit 1 ;;\nesac\n')
+      os.chmod(script, 0o774)
+      plan.append({'job': j, 'script': script, 'stages': names, 'deps': sorted(deps[j], key=ordered.index),
+                   'ncpus': node.ncpus, 'mem_mb': mem, 'timeout': node.timeout})
+
+    with open(jobsdir + '/plan.json', 'w') as fid:
+      json.dump(plan, fid, indent=1)
+    if executor != 'local':
+      with open(jobsdir + '/submit.sh', 'w') as fid:
+        fid.write(submit_script(executor, ordered, deps))
+      os.chmod(jobsdir + '/submit.sh', 0o774)
+
+    print('Exported ' + str(len(plan)) + ' jobs (' + str(len(nodes)) + ' stages) to ' + jobsdir)
+    return jobsdir
+
+def submit(jobsdir,executor='slurm'):
+    """Submits the exported jobs to the batch system"""
+    tool = 'sbatch' if executor == 'slurm' else 'qsub'
+    if shutil.which(tool) is None:
+      raise Exception("Unable to submit jobs: " + tool + " not found (use --plan-only to only write the job scripts)")
+    subprocess.run(['bash', jobsdir + '/submit.sh'], check=True)
+
+def run(jobsdir,ncpus=None):
+    """Local stand-in executor: runs the exported job scripts (one process per array task) in
+    dependency order with the pipeline scheduler. Returns the failed jobs"""
+    with open(jobsdir + '/plan.json') as fid:
+      plan = json.load(fid)
+
+    graph = scheduler.Graph(ncpus, jobsdir + '/logs/metrics.jsonl')
+    tasks = {}
+    for job in plan:
+      deps = [t for d in job['deps'] for t in tasks[d]]
+      if len(job['stages']) == 1:
+        tasks[job['job']] = [graph.add(job['job'], 'bash ' + job['script'], deps, ncpus=job['ncpus'], timeout=job['timeout'])]
+      else:
+        tasks[job['job']] = [graph.add(job['job'] + '_' + str(i), 'bash ' + job['script'] + ' ' + str(i), deps, ncpus=job['ncpus'], timeout=job['timeout'])
+                             for i in range(len(job['stages']))]
+    return graph.run()
+
+if __name__ == "__main__":
+    # python -m utils.cluster stage <spec.json>  |  python -m utils.cluster run <jobsdir> [ncpus]
+    if len(sys.argv) > 2 and sys.argv[1] == 'stage':
+      sys.exit(stage(sys.argv[2]))
+    elif len(sys.argv) > 2 and sys.argv[1] == 'run':
+      failed = run(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+      if failed:
+        print('Failed jobs: ' + ', '.join(failed.values()))
+        sys.exit(1)
+    else:
+      print('usage: python -m utils.cluster stage <spec.json> | run <jobsdir> [ncpus]')
+      sys.exit(2)
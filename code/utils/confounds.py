@@ -0,0 +1,139 @@
+# FDT utility functions for building the confounds table from the eddy text outputs
+# inputs: bases   --> eddy output basenames (<dir>/eddy_unwarped_images), one per run, in acquisition order
+#         outbase --> derivatives basename (<outbase>_confounds.tsv, <outbase>_outlier_log.txt)
+#
+# Every eddy output of every run is read once with numpy (no per-file DataFrames): motion and eddy
+# current parameters (.eddy_parameters), movement rms (.eddy_movement_rms, .eddy_restricted_movement_rms)
+# and slice outliers (.eddy_outlier_map). One row per volume: run / volume index, trans_x-z (mm),
+# rot_x-z (rad), ec_1-N (eddy current terms), rms columns, outlier slice count and fraction.
+# Missing files (older eddy versions) give n/a columns. The table is written as tsv and optionally
+# as parquet / feather, which cohort() reads back for whole-dataset QC without re-parsing text files.
+# pandas is imported by the functions using it (not needed to plan the stage).
+
+import os, sys, glob
+import numpy as np
+
+# eddy outputs read for each run
+OUTPUTS = ('.eddy_parameters', '.eddy_movement_rms', '.eddy_restricted_movement_rms', '.eddy_outlier_map', '.eddy_outlier_report')
+FORMATS = ('tsv', 'parquet', 'feather')
+MOTION = ('trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z')
+RMS = {'.eddy_movement_rms': ('eddy_movement_rms_abs', 'eddy_movement_rms_disp'),
+       '.eddy_restricted_movement_rms': ('eddy_restricted_movement_rms_abs', 'eddy_restricted_movement_rms_disp')}
+
+def table(path):
+    """Numeric rows of an eddy text output (header lines skipped), None if the file does not exist"""
+    if not os.path.exists(path):
+      return None
+    with open(path) as fid:
+      rows = [l.split() for l in fid if l.strip()]
+    while rows:
+      try:
+        float(rows[0][0])
+        break
+      except ValueError:
+        rows = rows[1:]  # e.g. "One row per scan, one column per slice..." (outlier map)
+    return np.array(rows, dtype=float).reshape(len(rows), -1)
+
+def run_table(base):
+    """Per volume columns of one eddy run: {column: array}"""
+    tables = dict((s, table(base + s)) for s in OUTPUTS[:-1])
+    lengths = set(len(t) for t in tables.values() if t is not None)
+    if not lengths:
+      raise Exception("No eddy outputs found: " + base)
+    if len(lengths) > 1:
+      raise Exception("Eddy outputs with different numbers of volumes: " + base)
+    n = lengths.pop()
+    cols = {'volume': np.arange(n)}
+
+    par = tables['.eddy_parameters']
+    for i, c in enumerate(MOTION):
+      cols[c] = par[:, i] if par is not None else np.full(n, np.nan)
+    if par is not None:
+      for i in range(6, par.shape[1]):
+        cols['ec_' + str(i - 5)] = par[:, i]
+
+    for s, names in RMS.items():
+      for i, c in enumerate(names):
+        cols[c] = tables[s][:, i] if tables[s] is not None else np.full(n, np.nan)
+
+    omap = tables['.eddy_outlier_map']
+    cols['outlier_slices'] = omap.sum(axis=1) if omap is not None else np.full(n, np.nan)
+    cols['outlier_fraction'] = omap.mean(axis=1) if omap is not None else np.full(n, np.nan)
+    return cols
+
+def build(bases):
+    """Confounds table of all runs (one DataFrame built once from the concatenated columns)"""
+    import pandas as pd
+    runs = [run_table(b) for b in bases]
+    n = [len(r['volume']) for r in runs]
+    names = []
+    for r in runs:
+      names += [c for c in r if c not in names]
+    cols = {'run': np.repeat(np.arange(len(runs)), n),
+            'source': np.repeat([os.path.basename(os.path.dirname(b)) for b in bases], n)}
+    for c in names:  # e.g. ec terms missing from some runs: n/a
+      cols[c] = np.concatenate([r[c] if c in r else np.full(k, np.nan) for r, k in zip(runs, n)])
+    return pd.DataFrame(cols)
+
+def save(df,path):
+    """Writes a table as tsv, parquet or feather (by extension)"""
+    if path.endswith('.parquet'):
+      df.to_parquet(path, index=False)
+    elif path.endswith('.feather'):
+      df.to_feather(path)
+    else:
+      df.to_csv(path, sep='\t', index=False, na_rep='n/a')
+    return path
+
+def load(path):
+    import pandas as pd
+    if path.endswith('.parquet'):
+      return pd.read_parquet(path)
+    elif path.endswith('.feather'):
+      return pd.read_feather(path)
+    return pd.read_csv(path, sep='\t', na_values='n/a')
+
+def generate(bases,outbase,fmt='tsv'):
+    """Writes <outbase>_confounds.tsv (and .parquet / .feather) and <outbase>_outlier_log.txt"""
+    df = build(bases)
+    outputs = [save(df, outbase + '_confounds.tsv')]
+    if fmt != 'tsv':
+      outputs.append(save(df, outbase + '_confounds.' + fmt))
+
+    # eddy outlier reports of all runs, one section per run
+    with open(outbase + '_outlier_log.txt', 'w') as out:
+      for b in bases:
+        if os.path.exists(b + '.eddy_outlier_report'):
+          with open(b + '.eddy_outlier_report') as fid:
+            out.write('# ' + b + '.eddy_outlier_report\n' + fid.read())
+    outputs.append(outbase + '_outlier_log.txt')
+    return outputs
+
+def outputs(outbase,fmt='tsv'):
+    """Files written by generate"""
+    return [outbase + '_confounds.tsv'] + ([outbase + '_confounds.' + fmt] if fmt != 'tsv' else []) + [outbase + '_outlier_log.txt']
+
+def cohort(derivatives,out=None):
+    """Confounds of every participant in a derivatives directory as one table (columnar files are
+    preferred over the tsv of the same run), with a file column. Written to out if given"""
+    files = {}
+    for f in sorted(glob.glob(derivatives + '/**/*_confounds.*', recursive=True)):
+      base, ext = f.rsplit('_confounds.', 1)
+      if ext in FORMATS and (base not in files or files[base].endswith('.tsv')):
+        files[base] = f
+    if not files:
+      raise Exception("No confounds tables found in " + derivatives)
+    import pandas as pd
+    tables = [load(f) for f in files.values()]
+    df = pd.concat(tables, ignore_index=True)  # one concatenation of all tables
+    df.insert(0, 'file', np.repeat([os.path.basename(b) for b in files], [len(t) for t in tables]))
+    if out is not None:
+      save(df, out)
+    return df
+
+if __name__ == "__main__":
+    # python -m utils.confounds <derivatives> <out.tsv|.parquet|.feather>: cohort confounds table
+    if len(sys.argv) != 3:
+      print('usage: python -m utils.confounds <derivatives> <out.tsv|.parquet|.feather>')
+      sys.exit(2)
+    print(str(len(cohort(sys.argv[1], sys.argv[2]))) + ' volumes: ' + sys.argv[2])
@@ -1,20 +1,70 @@
 # FDT utility functions generate bids layout
 # inputs: layout --> BIDSLayout object loaded from study directory
 #         entry  --> structure with all the user defined inputs 
-import os, sys, subprocess, multiprocessing, glob, getopt, bids, json, re, warnings
-from subprocess import PIPE
-import pandas as pd
+import os, json, hashlib
+
+# folders never indexed by pybids (see bids.layout defaults), so they do not change the fingerprint
+IGNORE = ('code', 'derivatives', 'models', 'sourcedata', 'stimuli')
+
+# ------------------------------------------------------------------------------
+#  Cached layout index (sqlite database saved with the working directory)
+# ------------------------------------------------------------------------------
+def fingerprint(path):
+    """Hash of the file list, sizes and modification times of a bids directory tree"""
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not (root == path and d in IGNORE))
+        for f in sorted(files):
+            st = os.stat(os.path.join(root, f))
+            h.update((os.path.relpath(os.path.join(root, f), path) + ' ' + str(st.st_size) + ' ' + str(st.st_mtime_ns) + '\n').encode())
+    return h.hexdigest()
+
+def database(path,dbpath,reset=False):
+    """Returns the keyword arguments to load a bids layout from its cached database.
+    The database is rebuilt when the directory fingerprint changed or reset is requested"""
+    fp = fingerprint(path)
+    fpfile = dbpath + '/fingerprint.txt'
+
+    if not reset and os.path.exists(fpfile):
+      with open(fpfile) as fid:
+        reset = fid.read().strip() != fp
+    else:
+      reset = True
+
+    if reset:
+      print('Indexing bids directory: ' + path)
+      os.makedirs(dbpath, exist_ok=True)
+      if os.path.exists(fpfile):
+        os.remove(fpfile)  # only valid once the new index is written (see save_fingerprint)
+    else:
+      print('Using cached bids index: ' + dbpath)
+
+    return {'database_path': dbpath, 'reset_database': reset}, fp
+
+def save_fingerprint(dbpath,fp):
+    with open(dbpath + '/fingerprint.txt', 'w') as fid:
+      fid.write(fp + '\n')
+
+def add_derivatives(layout,entry):
+    """Adds the FDT derivatives to the layout, reusing the cached index of the derivatives folder"""
+    kwargs, fp = database(entry.outputs + '/FDT', entry.wd + '/bids_db/derivatives', entry.reset_db)
+    layout.add_derivatives(entry.outputs + '/FDT', **kwargs)
+    save_fingerprint(kwargs['database_path'], fp)
+    return layout
 
 # ------------------------------------------------------------------------------
 #  Parse Bids inputs for this script
 # ------------------------------------------------------------------------------
 def data(entry):
+    import bids  # slow import (sqlalchemy, pandas), only needed once the arguments are parsed
 
     bids.config.set_option('extension_initial_dot', True)
 
-    layout = bids.BIDSLayout(entry.inputs, derivatives=False, absolute_paths=True)
+    kwargs, fp = database(entry.inputs, entry.wd + '/bids_db/inputs', entry.reset_db)
+    layout = bids.BIDSLayout(entry.inputs, derivatives=False, absolute_paths=True, **kwargs)
+    save_fingerprint(kwargs['database_path'], fp)
 
-    if not os.path.exists(entry.outputs + '/FDT') or os.path.exists(entry.outputs + '/FDT/' + 'dataset_description.json'):
+    if not os.path.exists(entry.outputs + '/FDT/' + 'dataset_description.json'):
       os.makedirs(entry.outputs,exist_ok=True)
       os.makedirs(entry.outputs + '/FDT', exist_ok=True)
 
@@ -1,78 +1,161 @@
 # FDT utility functions for running eddy in fsl
 # inputs: layout --> BIDSLayout object loaded from study directory
-#         entry  --> structure with all the user defined inputs 
-
-import os, sys, subprocess, multiprocessing, glob, getopt, bids, json, re, warnings
-from subprocess import PIPE
-import pandas as pd
-
-def worker(name,cmdfile):
-    """Executes the bash script"""
-    process = subprocess.Popen(cmdfile.split(), stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    output, error = process.communicate()
-    print(error)
-    print('Worker: ' + name + ' finished')
-    return
-                                               
-# run tensor fitting on preprocessed image
-def run(layout,entry):
+#         entry  --> structure with all the user defined inputs
+#
+# --tensor-backend=fsl-slabs: dtifit is single threaded and fits every voxel independently, so the
+# image is cut into z slabs holding about the same number of brain voxels, dtifit runs on the slabs
+# in parallel (--n-cpus processes) and the slab outputs are stitched into the usual derivatives.
+# The number of slabs is chosen when the stage runs: one per cpu, more when the slabs fitted at the
+# same time would not fit in the available memory.
+
+import os, sys, math, time, shutil, subprocess, concurrent.futures
+import numpy as np
+from . import scheduler, metrics, manifest, tensor, memory
+
+# dtifit outputs (--out=dwi)
+MAPS = ('FA', 'MD', 'MO', 'S0', 'L1', 'L2', 'L3', 'V1', 'V2', 'V3')
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLAB_BYTES = 16  # dtifit memory per voxel and volume (float input and working copies)
+SLAB_MEMORY = 0.5  # fraction of the available memory used by the slabs fitted at the same time
+
+# add tensor fitting stages to the pipeline graph
+#   images --> preprocessed dwi derivatives (absolute paths), bval / bvec / brain-mask share the image name
+#   deps   --> stages producing the preprocessed images
+def plan(graph,entry,images,deps=()):
 
   # using the distortion corrected dti images, we will compute tensor values
   itr=0; s=', ';
-  nfiles = len(layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'))
   jobs=[];
 
-  for dwi in layout.get(subject=entry.pid, scope='derivatives', extension='nii.gz', suffix='dwi'):
-  
-      preproc_img = dwi.path
-      FAfile = preproc_img.replace("dwi.nii.gz","dwi_FA.nii.gz")
-    
-      if os.path.exists(entry.outputs + '/FDT/' + FAfile):
-        continue
+  for preproc_img in images:
+
+      spath = preproc_img.replace("dwi.nii.gz","")
+      outputs = [spath.replace("desc-preproc","desc-dtifit") + 'dwi_' + m + '.nii.gz' for m in MAPS]
 
-      preproc_img = dwi.path
-      bval = layout.get_bval(dwi.path)
-      bvec = layout.get_bvec(dwi.path)
+      bval = preproc_img.replace('nii.gz','bval')
+      bvec = preproc_img.replace('nii.gz','bvec')
       mask = preproc_img.replace('.nii.gz','_brain-mask.nii.gz')
 
-      print("Running dtifit: " + preproc_img)
+      name = 'tensor_dwi_' + str(itr)
 
-      # write bash script for execution
-      original_stdout = sys.stdout # Save a reference to the original standard output
-      sys.stdout.flush()
+      if entry.tensor_backend == 'native':
+        # vectorized numpy fit, written straight to the derivative folder
+        print("Running native tensor fit: " + preproc_img)
+        out = spath.replace("desc-preproc","desc-dtifit") + 'dwi'
+        jobs.append(graph.add(name, target=tensor.fit, args=(preproc_img, bval, bvec, mask, out, entry.ncpus), deps=deps, ncpus=entry.ncpus,
+                              mem=memory.Model([preproc_img], memory.TENSOR), manifest=manifest.stage(entry, name, [preproc_img, bval, bvec, mask], outputs, 'native ' + out)))
+        itr = itr+1
+        continue
 
-      with open(entry.wd + '/cmd_tensor_dwi_' + str(itr) + '.sh', 'w') as fid:
-        sys.stdout = fid # Change the standard output to the file we created.
+      if entry.tensor_backend == 'fsl-slabs':
+        print("Running dtifit on slabs: " + preproc_img)
+        out = spath.replace("desc-preproc","desc-dtifit") + 'dwi'
+        cmd = 'cd ' + CODE + '\n'
+        cmd += sys.executable + ' -m utils.dtifit ' + ' '.join([preproc_img, bval, bvec, mask, out, entry.wd + '/' + name, str(entry.ncpus)])
+        jobs.append(graph.add(name, scheduler.script(entry, name, cmd), deps, ncpus=entry.ncpus,
+                              mem=memory.Model([preproc_img], memory.TENSOR), manifest=manifest.stage(entry, name, [preproc_img, bval, bvec, mask], outputs, cmd)))
+        itr = itr+1
+        continue
 
-        print('#!/usr/bin/bash')
-        print('mkdir -p ' + entry.wd + '/tensor_dwi_' + str(itr))
-        print('cd ' + entry.wd + '/tensor_dwi_' + str(itr))
-        # add commands here...
-        print("""dtifit --data=""" + preproc_img + """ \
+      print("Running dtifit: " + preproc_img)
+
+      cmd = 'mkdir -p ' + entry.wd + '/tensor_dwi_' + str(itr) + '\n'
+      cmd += 'cd ' + entry.wd + '/tensor_dwi_' + str(itr) + '\n'
+      # add commands here...
+      cmd += """dtifit --data=""" + preproc_img + """ \
           --mask=""" + mask + """ \
           --bvecs=""" + bvec + """ \
           --bvals="""+ bval + """ \
-          --out=dwi """)
+          --out=dwi \n"""
 
-        #move outputs to derivative folder
-        spath = preproc_img.replace("dwi.nii.gz","")
-        print('for i in *.nii.gz; do ${FSLDIR}/bin/imcp $i ' + spath.replace("preproc","dtifit") + '$i ; done')
+      #move outputs to derivative folder (compressed on the way when uncompressed, one thread: the stage
+      # holds a single cpu for dtifit and the maps are small)
+      cmd += 'for i in dwi_*.nii*; do\n' + scheduler.publish('$i', spath.replace("desc-preproc","desc-dtifit") + '${i%.gz}.gz', 'move') + 'done'
 
-        sys.stdout = original_stdout # Reset the standard output to its original value
+      jobs.append(graph.add(name, scheduler.script(entry, name, cmd), deps, mem=memory.Model([preproc_img], memory.TENSOR),
+                            manifest=manifest.stage(entry, name, [preproc_img, bval, bvec, mask], outputs, cmd)))
 
-      # change permissions to make sure file is executable 
-      os.chmod(entry.wd + '/cmd_tensor_dwi_' + str(itr) + '.sh', 0o774)
+      itr = itr+1
 
-      # run script
-      cmd = 'bash ' + entry.wd + '/cmd_tensor_dwi_' + str(itr) + '.sh'
-      name = 'dtifit' + str(itr)
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
+  return jobs
 
-      itr = itr+1
-      print(p)
-  for job in jobs:
-    job.join()  #wait for all eddy commands to finish
+  ## end plan
+
+def available_memory():
+    """Memory available to new processes (bytes)"""
+    try:
+      with open('/proc/meminfo') as fid:
+        for line in fid:
+          if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024
+    except OSError:
+      pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+def slab_bounds(weights,n):
+    """z ranges [(z0, z1), ...] splitting the slices into at most n slabs of about the same weight (brain voxels)"""
+    nz = len(weights)
+    total = np.cumsum(weights, dtype=float)
+    if total[-1] == 0:
+      total = np.arange(1, nz + 1, dtype=float)
+    edges = np.unique(np.r_[0, np.searchsorted(total, total[-1] * np.arange(1, n) / n, side='left') + 1, nz].clip(0, nz))
+    return [(int(z0), int(z1)) for z0, z1 in zip(edges[:-1], edges[1:])]
+
+def fit_slabs(data,bval,bvec,mask,out,wd,ncpus):
+    """dtifit on z slabs of data (ncpus at a time), outputs stitched to <out>_FA.nii.gz, ... (same as dtifit --out)"""
+    from . import nifti
+    os.makedirs(wd, exist_ok=True)
+    img = nifti.load(data)
+    nx, ny, nz = img.shape[:3]
+    weights = (np.asanyarray(nifti.load(mask).dataobj).reshape(nx, ny, nz) > 0).sum(axis=(0, 1))
+
+    # slab count: one per cpu, more if ncpus slabs do not fit in memory together
+    need = float(nx * ny * nz * nifti.nvols(img) * SLAB_BYTES)
+    n = min(nz, max(ncpus, int(math.ceil(ncpus * need / (SLAB_MEMORY * available_memory())))))
+    bounds = slab_bounds(weights, n)
+    print('dtifit on ' + str(len(bounds)) + ' slabs of ' + str(nz) + ' slices (' + str(ncpus) + ' at a time): ' +
+          ', '.join('%d-%d' % (z0, z1 - 1) for z0, z1 in bounds), flush=True)
+
+    # slabs cut from a memory map of the uncompressed image
+    dirs = [wd + '/slab_%03d' % k for k in range(len(bounds))]
+    for d in dirs:
+      os.makedirs(d, exist_ok=True)
+    unpacked = wd + '/data.nii'
+    nifti.write(unpacked, img, nifti.nvols(img), nifti.volumes(img), nifti.output_dtype([img]))
+    nifti.slabs(unpacked, bounds, [d + '/data.nii' for d in dirs])
+    os.remove(unpacked)
+    nifti.write(wd + '/mask.nii', nifti.load(mask), 1, [np.asanyarray(nifti.load(mask).dataobj).reshape(nx, ny, nz)])
+    nifti.slabs(wd + '/mask.nii', bounds, [d + '/nodif_brain_mask.nii' for d in dirs])
+
+    def fit(d):
+      start = time.time()
+      subprocess.run(['dtifit', '--data=' + d + '/data', '--mask=' + d + '/nodif_brain_mask', '--bvecs=' + bvec, '--bvals=' + bval,
+                      '--out=' + d + '/dwi'], check=True, env=dict(os.environ, FSLOUTPUTTYPE='NIFTI'))
+      print('slab ' + os.path.basename(d) + ' done in %.1f s' % (time.time() - start), flush=True)
+
+    with concurrent.futures.ThreadPoolExecutor(ncpus) as pool:
+      list(pool.map(fit, dirs))
+
+    # stitch the slabs along z, written compressed over ncpus threads
+    outputs = []
+    for m in MAPS:
+      parts = [nifti.load(d + '/dwi_' + m + '.nii') for d in dirs]
+      vols = (np.concatenate([nifti.volume(p, c).reshape(nx, ny, -1) for p in parts], axis=2) for c in range(nifti.nvols(parts[0])))
+      outputs.append(nifti.write(out + '_' + m + '.nii.gz', img, nifti.nvols(parts[0]), vols, np.float32, ncpus))
+    shutil.rmtree(wd)
+    return outputs
+
+# run tensor fitting on preprocessed image
+def run(layout,entry):
+
+  images = [dwi.path for dwi in layout.get(subject=entry.pid, scope='derivatives', extension='nii.gz', suffix='dwi')]
+
+  graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+  plan(graph,entry,images)
+  graph.run(strict=True)  #wait for all dtifit commands to finish
 
   ## end run
+
+if __name__ == "__main__":
+  # slab stage: python -m utils.dtifit <data> <bval> <bvec> <mask> <out> <work-dir> <ncpus>
+  fit_slabs(*sys.argv[1:7], int(sys.argv[7]))
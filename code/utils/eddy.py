@@ -1,26 +1,28 @@
 # FDT utility functions for running eddy in fsl
 # inputs: layout --> BIDSLayout object loaded from study directory
-#         entry  --> structure with all the user defined inputs 
+#         entry  --> structure with all the user defined inputs
 
-import os, sys, subprocess, multiprocessing, glob, getopt, bids, json, re, warnings
-from subprocess import PIPE
-import pandas as pd
+import os
+from . import scheduler, metrics, manifest, gradients, nifti, confounds, memory, scans
 
+# topup outputs used by applytopup / eddy / eddy_quad
+def topup_outputs(entry):
+  x = scheduler.ext(entry)
+  return [entry.wd + f for f in ('/acqparams.txt', '/topup/topup_b0_fieldcoef' + x, '/topup/topup_b0_movpar.txt', '/topup/topup_b0_fout' + x)]
 
-def worker(name,cmdfile):
-    """Executes the bash script"""
-    process = subprocess.Popen(cmdfile.split(), stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    output, error = process.communicate()
-    print(error)
-    print('Worker: ' + name + ' finished')
-    return
+# eddy outputs used by later stages (base: eddy --out)
+def eddy_outputs(entry,base):
+  return [base + f for f in (scheduler.ext(entry), '.eddy_rotated_bvecs', '.eddy_movement_rms', '.eddy_outlier_report')]
 
 
 # (Option 1) run eddy on each input scan seperately (no multi-scan concatination)
-def run_eddy_opt1(layout,entry):
-    
-    itr=0;
-    nfiles = len(layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'))
+#   each scan is its own chain of stages: reference b0 -> applytopup -> bet -> eddy -> eddy_quad -> publish
+#   returns the stage names that produce the preprocessed derivative images, and the image paths
+def plan_eddy_opt1(graph,layout,entry,deps=()):
+
+    itr=0; x = scheduler.ext(entry);
+    table = scans.table(layout, entry)
+    nfiles = len(table)
     jobs=[];
 
     if entry.use_repol:
@@ -28,10 +30,10 @@ def run_eddy_opt1(layout,entry):
     else:
       use_repol=""
 
-    for dwi in layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'):
-        
-        img = dwi.path
-        
+    for scan in table:
+
+        img = scan.path
+
         # output filename...
         ent = layout.parse_file_entities(img)
 
@@ -47,15 +49,9 @@ def run_eddy_opt1(layout,entry):
         outbvec = outfile.replace('nii.gz','bvec')
         outmask = outfile.replace('.nii.gz','_brain-mask.nii.gz')
         outqc   = outfile.replace('.nii.gz','.qc')
-        
-        if os.path.exists(entry.wd + '/eddy_dwi_' + str(itr) + '/eddy_unwarped_images.nii.gz'):
-            itr=itr+1
-            print("Eddy output exists...skipping: " + outfile)
-            continue
-            print(" ")
-
-        bval = layout.get_bval(dwi.path)
-        bvec = layout.get_bvec(dwi.path)
+
+        bval = scan.bval
+        bvec = scan.bvec
         s=', '
         print('Using: ' + img)
         print('Using: ' + bval)
@@ -63,51 +59,46 @@ def run_eddy_opt1(layout,entry):
 
         print("corrected image: " + outfile)
 
-        # write bash script for execution
-        original_stdout = sys.stdout # Save a reference to the original standard output
-        sys.stdout.flush()
-
-        with open(entry.wd + '/cmd_eddy_opt1_iter0' + str(itr) + '.sh', 'w') as fid:
-          sys.stdout = fid # Change the standard output to the file we created.
-
-          print('#!/usr/bin/bash')
-          print('mkdir -p ' + entry.wd + '/eddy_dwi_' + str(itr))
-          print('cd ' + entry.wd + '/eddy_dwi_' + str(itr))
-          
-          # add commands here...
-          print('cp '+bval+' bval')
-          print('cp '+bvec+' bvec')
-          print('bvalfile=' + bval)
-          print('n="$(grep -n "0" $bvalfile | cut -f1 -d":" )"')
-          print('frame=`echo $n | cut -d" " -f1`')
-          print('vol="$(($frame-1))"')
-          print('echo "Using dwi volume : " $vol " for reference"')
-          print('\n')
-          print('fslroi ' + img + ' b0 $vol 1')
-          topup_img = '../topup/topup_b0'
-          acqparams = '../acqparams.txt'
-
-          if 'AP' in img:
-            inindex=1  # dwi images collected with acqparameters in row 1
-          elif 'PA' in img: 
-            inindex=2  # dwi images collected with acqparameters in row 1
-          else:
-            raise CustomError("Unable to determine if dwi image collected A->P or P->A")
-          print('fslroi ' + img + ' b0 0 1') 
-          print("""applytopup --imain=b0 \
+        name = 'eddy_opt1_iter0' + str(itr)
+        d = entry.wd + '/eddy_dwi_' + str(itr)
+        cd = 'cd ' + d + '\n'
+        topup_files = topup_outputs(entry)
+        eddy_files = eddy_outputs(entry, d + '/eddy_unwarped_images')
+        topup_img = '../topup/topup_b0'
+        acqparams = '../acqparams.txt'
+
+        inindex = table.row(scan)  # acqparams row of the phase encoding direction (AP: 1, PA: 2)
+
+        # gradient table and eddy index file (checked against the header when the table was read)
+        gt = scan.gradients
+        os.makedirs(d, exist_ok=True)
+        gt.save(d + '/bval', d + '/bvec')
+        gradients.write_index(d + '/index.txt', [inindex] * len(gt))
+
+        # (1) reference b0: average of all b0 volumes
+        vols = gt.b0s()
+        print('Using dwi volumes : ' + ','.join(str(v) for v in vols) + ' for reference')
+        vols = [int(v) for v in vols]
+        last = graph.add(name + '_b0', target=nifti.extract, args=(img,d + '/b0' + x,vols,True),
+                         manifest=manifest.stage(entry, name + '_b0', [img], [d + '/b0' + x], str(vols)))
+
+        # (2) distortion corrected reference
+        cmd = cd + """applytopup --imain=b0 \
                  --topup=""" + topup_img + """ \
                  --datain=""" + acqparams + """ \
                  --inindex=""" + str(inindex) + """ \
                  --method=jac \
-                 --out=ref""")
-
-          print('bet ref ref_brain -m -f 0.2')
-
-          print('imglen=`fslval ' + img + ' dim4`')
+                 --out=ref"""
+        last = graph.add(name + '_applytopup', scheduler.script(entry, name + '_applytopup', cmd), [last] + list(deps),
+                         manifest=manifest.stage(entry, name + '_applytopup', [d + '/b0' + x] + topup_files, [d + '/ref' + x], cmd))
 
-          print('for c in $(seq 1 $imglen); do echo ' + str(inindex) + ' ; done > index.txt')
+        # (3) brain mask
+        cmd = cd + 'bet ref ref_brain -m -f 0.2'
+        last = graph.add(name + '_bet', scheduler.script(entry, name + '_bet', cmd), [last],
+                         manifest=manifest.stage(entry, name + '_bet', [d + '/ref' + x], [d + '/ref_brain' + x, d + '/ref_brain_mask' + x], cmd))
 
-          print("""eddy_openmp --imain=""" + img + """ \
+        # (4) eddy current and motion correction
+        cmd = cd + """eddy_openmp --imain=""" + img + """ \
             --mask=ref_brain_mask \
             --index=index.txt \
             --acqp=""" + acqparams + """ \
@@ -119,50 +110,52 @@ def run_eddy_opt1(layout,entry):
             --out=eddy_unwarped_images \
             """ + use_repol + """ \
             --cnr_maps   \
-            --data_is_shelled""")
+            --data_is_shelled"""
+        last = graph.add(name + '_eddy', scheduler.script(entry, name + '_eddy', cmd), [last], ncpus=scheduler.eddy_threads(entry,nfiles),
+                         mem=memory.Model([scan.nvols * table.volume_mb()], memory.EDDY), manifest=manifest.stage(entry, name + '_eddy', [img, bval, bvec, d + '/index.txt', d + '/ref_brain_mask' + x] + topup_files, eddy_files, cmd))
+        jobs.append(last)
 
-          if entry.eddy_QC == True:
-            print("""eddy_quad eddy_unwarped_images  \
+        if entry.eddy_QC == True:
+          # (5) quality control
+          cmd = cd + 'rm -rf eddy_unwarped_images.qc\n'  # eddy_quad fails if the report folder exists
+          cmd += """eddy_quad eddy_unwarped_images  \
               -idx index.txt \
               -par """ + acqparams + """ \
               -m ref_brain_mask \
               -b """ + bval + """ \
               -g """ + bvec + """ \
-              -f """ + topup_img + '_fout')
+              -f """ + topup_img + '_fout'
+          last = graph.add(name + '_quad', scheduler.script(entry, name + '_quad', cmd), [last],
+                           manifest=manifest.stage(entry, name + '_quad', eddy_files + [d + '/ref_brain_mask' + x], [d + '/eddy_unwarped_images.qc'], cmd))
 
-          print('mkdir -p $(dirname "' + entry.outputs + '/FDT/' + outfile + '")' )
-          print('cp -rp eddy_unwarped_images.qc/ ' + entry.outputs + '/FDT/' + outqc)
+          # (6) publish qc report
+          cmd = cd + 'mkdir -p $(dirname "' + entry.outputs + '/FDT/' + outfile + '")\n'
+          cmd += scheduler.publish('eddy_unwarped_images.qc', entry.outputs + '/FDT/' + outqc)
+          last = graph.add(name + '_publish', scheduler.script(entry, name + '_publish', cmd), [last],
+                           manifest=manifest.stage(entry, name + '_publish', [d + '/eddy_unwarped_images.qc'], [entry.outputs + '/FDT/' + outqc], cmd))
 
-          sys.stdout = original_stdout # Reset the standard output to its original value
+        itr = itr+1
 
-        # change permissions to make sure file is executable 
-        os.chmod(entry.wd + '/cmd_eddy_opt1_iter0' + str(itr) + '.sh', 0o774)
+    # concatinate scans after all eddy runs complete (qc reports do not need to be finished)...
+    return plan_concat_eddy_results(graph,layout,entry,jobs)
 
-        # run script
-        cmd = 'bash ' + entry.wd + '/cmd_eddy_opt1_iter0' + str(itr) + '.sh'
-        name = 'eddy' + str(itr)
-        p = multiprocessing.Process(target=worker, args=(name,cmd))
-        jobs.append(p)
-        p.start()
+    ## end plan_eddy_opt1
 
-        itr = itr+1
-        print(p)
-    for job in jobs:
-      job.join()  #wait for all eddy commands to finish
+def run_eddy_opt1(layout,entry):
 
-    # concatinate scans after all runs complete...
-    concat_eddy_results(layout,entry)
+    graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+    plan_eddy_opt1(graph,layout,entry)
+    graph.run(strict=True)
 
     ## end run_eddy_opt1
 
-def concat_eddy_results(layout,entry):
+def plan_concat_eddy_results(graph,layout,entry,deps=()):
 
-  itr=0; s=', ';
-  nfiles = len(layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'))
+  itr=0; s=', '; x = scheduler.ext(entry);
+  nfiles = len(scans.table(layout, entry))
 
   # output filename...
-  dwi = layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi')[0]
-  ent = layout.parse_file_entities(dwi.path)
+  ent = layout.parse_file_entities(scans.table(layout, entry)[0].path)
 
   # Define the pattern to build out of the components passed in the dictionary
   pattern = "sub-{subject}/[ses-{session}/]sub-{subject}[_ses-{session}][_task-{task}][_acq-{acquisition}][_rec-{reconstruction}][_run-{run}][_echo-{echo}][_dir-{direction}][_space-{space}][_desc-{desc}]_{suffix}.nii.gz",
@@ -179,177 +172,154 @@ def concat_eddy_results(layout,entry):
   outref  = outfile.replace('.nii.gz','ref.nii.gz')
   outqc   = outfile.replace('.nii.gz','.qc')
   outbase   = outfile.replace('_dwi.nii.gz','')
-  
-  if not os.path.exists(entry.outputs + '/FDT/' + outref):
 
-    print('Concatenating dwi images...')
-  
-    # get links to all input data...
-    imglist=[]; bvallist=[]; bveclist=[]; indexlist=[]; masklist=[]; 
-   
-    # join bvals and bvecs from all scans
-    cmd = ''
-    cmd += 'mkdir -p ' + entry.wd + '/dwi_concat ; \n '
-    cmd += 'cd ' + entry.wd + '/dwi_concat ; \n '
-    cc=0
-
-    for d in sorted(glob.glob(entry.wd + '/eddy_dwi*[0-9]*')):
-      bvallist.append(d+'/bval')
-      bveclist.append(d+'/eddy_unwarped_images.eddy_rotated_bvecs')
-      imglist.append(d+'/eddy_unwarped_images.nii.gz')
-      indexlist.append(d+'/index.txt')
-      masklist.append(d+'/ref_brain_mask.nii.gz')
-    s=" "
-    cmd += 'touch bvecs; touch bvals; touch index.txt \n '
-    cmd += 'paste -d " " '+s.join(bvallist)+' > bvals; \n '  # use to horizontally concatenate bval files
-    cmd += 'paste -d " " '+s.join(bveclist)+' > bvecs; \n '  # use to horizontally concatenate bvec files
-    cmd += 'for i in "'+s.join(indexlist)+'"; do cat $i ; done > index.txt; \n '
-
-    # merge all raw images...
-    cmd += 'fslmerge -t dataout '+s.join(imglist)+' ; \n '
-
-    # get mask, order doesnt matter...
-    cmd += 'images=$(ls ../eddy_dwi_?/ref_brain_mask.nii.gz); \n '
-    cmd += 'nscans=$(ls -1 ../eddy_dwi_?/ref_brain_mask.nii.gz | wc -l); \n'
-
-
-    # do some fancy bash tricks to get a single line fslmaths command to get average mask
-    cmd += 'echo "fslmaths ">tmp ; for i in $images; do echo "$i -add"; done >> tmp ; \n'  # print all individual masks to command
-    cmd += "sed -i '$ s/.....$//' tmp; \n"                                                 # remove extra -add tag
-    cmd += 'echo "-div $nscans avg_brain_mask" >> tmp; \n'                                 # add rest of command
-    cmd += "a=`sed ':a;N;$!ba;s/" + "\\" + "n" + "/ /g' tmp`; \n"                          # make command single line
-    cmd += "$a ; \n"                                                                       # run command
-    cmd += 'fslmaths avg_brain_mask -thr 0.5 -bin brain_mask ; \n '
-    cmd += 'rm avg_brain_mask.nii.gz ; \n'
-
-    # grab the first reference image
-    cmd += 'cp ../eddy_dwi_0/ref_brain.nii.gz ref_brain.nii.gz ; \n'
-
-    # save outputs...
-    cmd += 'mkdir -p $(dirname "' + entry.outputs + '/FDT/' + outfile + '") \n'
-    cmd += '${FSLDIR}/bin/imcp dataout.nii.gz ' + entry.outputs + '/FDT/' + outfile + ' \n'
-    cmd += 'cp -p bvals ' + entry.outputs + '/FDT/' + outbval + ' \n'
-    cmd += 'cp -p bvecs ' + entry.outputs + '/FDT/' + outbvec + ' \n'
-    cmd += 'cp -p brain_mask.nii.gz ' + entry.outputs + '/FDT/' + outmask + ' \n'
-    cmd += 'cp -p ref_brain.nii.gz ' + entry.outputs + '/FDT/' + outref + ' \n'
-
-    original_stdout = sys.stdout # Save a reference to the original standard output
-    sys.stdout.flush()
-
-    with open(entry.wd + '/cmd_eddy1_concat.sh', 'w') as fid:
-      sys.stdout = fid # Change the standard output to the file we created.
-
-      print('#!/usr/bin/bash')
-      print(cmd)
-
-      sys.stdout = original_stdout # Reset the standard output to its original value
-
-    # change permissions to make sure file is executable 
-    os.chmod(entry.wd + '/cmd_eddy1_concat.sh', 0o774)
-
-    # run script
-    cmd = "bash " + entry.wd + "/cmd_eddy1_concat.sh"
-    name = 'eddy'
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    p.start()
-
-    generate_confounds_file(entry,entry.outputs + '/FDT/' + outbase)
+  print('Concatenating dwi images...')
 
-  #END concat_eddy1_results
-
-# (Option 2) run eddy on concatenated dwi scans (consistent to MRN, HCP pipelines (pairs))
-def run_concat_inputs(layout,entry):
   # get links to all input data...
-  if not os.path.exists(entry.wd + '/eddy_dwi_concat/brain_mask.nii.gz'):
-    imglist=[]; bvallist=[]; bveclsit=[];
-
-    # join bvals and bvecs from all scans
-    cmd = ''
-    cmd += 'mkdir -p ' + entry.wd + '/eddy_dwi_concat ; \n '
-    cmd += 'cd ' + entry.wd + '/eddy_dwi_concat ; \n '
-    cc=0
-    for dwi in layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'):
-      img = dwi.path
-      print(img)
-      cmd += 'ln -sf ' + dwi.path + ' dwi_' + str(cc) + '.nii.gz ; \n'
-      cmd += 'ln -sf ' + layout.get_bval(dwi.path) + ' bval_' + str(cc) + ' ; \n' 
-      cmd += 'ln -sf ' + layout.get_bvec(dwi.path) + ' bvec_' + str(cc) + ' ; \n' 
-
-      topup_img = '../topup/topup_b0'
-      acqparams = '../acqparams.txt'
-
-      if 'AP' in img:
-        inindex=1  # dwi images collected with acqparameters in row 1
-      elif 'PA' in img: 
-        inindex=2  # dwi images collected with acqparameters in row 1
-      else:
-        raise CustomError("Unable to determine if dwi image collected A->P or P->A")
-
-      cmd += 'imglen=`fslval ' + img + ' dim4` ; \n'
-      cmd += 'for c in $(seq 1 $imglen); do echo ' + str(inindex) + ' ; done > index_' + str(cc) + '.txt ; \n'
-
-      cmd += 'fslroi ' + img + ' b0 0 1 ; \n'
-      cmd += 'applytopup --imain=b0 --topup=' + topup_img + ' --datain=' + acqparams + ' --inindex=' + str(inindex) + ' --method=jac --out=ref ; \n'
-
-      cmd += 'bet ref ref_brain -m -f 0.2 ; \n'
-      cmd += 'mv ref_brain_mask.nii.gz ref_brain_mask_' + str(cc) + '.nii.gz ; \n'
-      cmd += 'mv ref_brain.nii.gz ref_brain_' + str(cc) + '.nii.gz ; \n'
-
-      cc=cc+1
-
-    cmd += 'touch bvecs; touch bvals; touch index_all.txt \n '
-    cmd += 'paste -d " " $(ls bval_?) > bvals; \n '  # use to horizontally concatenate bval files
-    cmd += 'paste -d " " $(ls bvec_?) > bvecs; \n '  # use to horizontally concatenate bvec files
-    cmd += 'for i in $(ls index_?.txt); do cat $i ; done > index_all.txt; \n '
-
-    # merge all raw images...
-    cmd += 'images=$(ls dwi_?.nii.gz); \n '
-    cmd += 'fslmerge -t data $images ; \n '
-
-    # get mask...
-    cmd += 'images=$(ls ref_brain_mask_?.nii.gz); \n '
-    cmd += 'nscans=$(ls -1 ref_brain_mask_?.nii.gz | wc -l); \n'
-
+  imglist=[]; bvallist=[]; bveclist=[]; indexlist=[]; masklist=[]; eddylist=[];
+
+  # join bvals and bvecs from all scans
+  cmd = ''
+  cmd += 'mkdir -p ' + entry.wd + '/dwi_concat ; \n '
+  cmd += 'cd ' + entry.wd + '/dwi_concat ; \n '
+  cc=0
+
+  for i in range(nfiles):
+    d = entry.wd + '/eddy_dwi_' + str(i)
+    bvallist.append(d+'/bval')
+    bveclist.append(d+'/eddy_unwarped_images.eddy_rotated_bvecs')
+    imglist.append(d+'/eddy_unwarped_images' + x)
+    indexlist.append(d+'/index.txt')
+    masklist.append(d+'/ref_brain_mask' + x)
+    eddylist.append(d+'/eddy_unwarped_images')
+  s=" "
+
+  # join bvals, (rotated) bvecs and index files once eddy has finished
+  outputs = [entry.wd + '/dwi_concat/' + f for f in ('bvals', 'bvecs', 'index.txt')]
+  gradient_stage = graph.add('eddy1_concat_gradients', deps=deps, target=concat_gradients, args=(bvallist,bveclist,indexlist,entry.wd + '/dwi_concat'),
+                             manifest=manifest.stage(entry, 'eddy1_concat_gradients', bvallist + bveclist + indexlist, outputs))
+
+  # merge all corrected images and average the masks (in process, one volume in memory at a time)...
+  images = [entry.wd + '/dwi_concat/' + f for f in ('dataout' + x, 'brain_mask' + x)]
+  image_stage = graph.add('eddy1_concat_images', deps=deps, target=concat_images, args=(imglist,masklist,entry.wd + '/dwi_concat','dataout' + x,'brain_mask' + x,entry.ncpus), ncpus=entry.ncpus,
+                          manifest=manifest.stage(entry, 'eddy1_concat_images', imglist + masklist, images))
+  deps = [gradient_stage, image_stage]
+  outputs = outputs + images
+
+  # save outputs (images compressed on the way), the first reference image is the reference
+  cmd += 'mkdir -p $(dirname "' + entry.outputs + '/FDT/' + outfile + '") \n'
+  cmd += scheduler.publish('dataout' + x, entry.outputs + '/FDT/' + outfile, threads=entry.ncpus)
+  cmd += scheduler.publish('bvals', entry.outputs + '/FDT/' + outbval)
+  cmd += scheduler.publish('bvecs', entry.outputs + '/FDT/' + outbvec)
+  cmd += scheduler.publish('brain_mask' + x, entry.outputs + '/FDT/' + outmask, threads=entry.ncpus)
+  cmd += scheduler.publish('../eddy_dwi_0/ref_brain' + x, entry.outputs + '/FDT/' + outref, threads=entry.ncpus)
+
+  inputs = outputs + [entry.wd + '/eddy_dwi_0/ref_brain' + x]
+  outputs = [entry.outputs + '/FDT/' + f for f in (outfile, outbval, outbvec, outmask, outref)]
+  concat = graph.add('eddy1_concat', scheduler.script(entry, 'eddy1_concat', cmd), deps, ncpus=entry.ncpus,  # gzip threads
+                     manifest=manifest.stage(entry, 'eddy1_concat', inputs, outputs, cmd))
+
+  # confounds table of all scans (every eddy text output read once)
+  inputs = [b + f for b in eddylist for f in confounds.OUTPUTS]
+  outputs = confounds.outputs(entry.outputs + '/FDT/' + outbase, entry.confounds_format)
+  graph.add('eddy1_confounds', deps=[concat], target=confounds.generate, args=(eddylist,entry.outputs + '/FDT/' + outbase,entry.confounds_format),
+            manifest=manifest.stage(entry, 'eddy1_confounds', inputs, outputs, entry.confounds_format))
+
+  return [concat], [entry.outputs + '/FDT/' + outfile]
+
+  #END plan_concat_eddy_results
+
+def concat_gradients(bvallist,bveclist,indexlist,outdir):
+  """Merges the gradient tables and eddy index files of each scan (in acquisition order)"""
+  tables = [gradients.GradientTable.load(bval, bvec) for bval, bvec in zip(bvallist, bveclist)]
+  os.makedirs(outdir, exist_ok=True)
+  gradients.merge(tables).save(outdir + '/bvals', outdir + '/bvecs')
+
+  index = []
+  for f in indexlist:
+    with open(f) as fid:
+      index += fid.read().split()
+  gradients.write_index(outdir + '/index.txt', index)
+
+def concat_images(imglist,masklist,outdir,data='dataout.nii',mask='brain_mask.nii',threads=1):
+  """Merges the images (data) and averages the brain masks of each scan (mask)"""
+  os.makedirs(outdir, exist_ok=True)
+  nifti.concat(imglist, outdir + '/' + data, threads)
+  nifti.average_mask(masklist, outdir + '/' + mask)
 
-    # do some fancy bash tricks to get a single line fslmaths command to get average mask
-    cmd += 'echo "fslmaths ">tmp ; for i in $images; do echo "$i -add"; done >> tmp ; \n'  # print all individual masks to command
-    cmd += "sed -i '$ s/.....$//' tmp; \n"                                                 # remove extra -add tag
-    cmd += 'echo "-div $nscans avg_brain_mask" >> tmp; \n'                                 # add rest of command
-    cmd += "a=`sed ':a;N;$!ba;s/" + "\\" + "n" + "/ /g' tmp`; \n"                          # make command single line
-    cmd += "$a ; \n"                                                                       # run command
-    cmd += 'fslmaths avg_brain_mask -thr 0.5 -bin brain_mask ; \n '
-    cmd += 'rm avg_brain_mask.nii.gz ; \n'
-
-    # write bash script for execution
-    original_stdout = sys.stdout # Save a reference to the original standard output
-    sys.stdout.flush()
+def concat_eddy_results(layout,entry):
 
-    with open(entry.wd + '/cmd_eddy2_concat.sh', 'w') as fid:
-      sys.stdout = fid # Change the standard output to the file we created.
+  graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+  plan_concat_eddy_results(graph,layout,entry)
+  graph.run(strict=True)
 
-      print('#!/usr/bin/bash')
-      print(cmd)
+  #END concat_eddy1_results
 
-      sys.stdout = original_stdout # Reset the standard output to its original value
+# (Option 2) run eddy on concatenated dwi scans (consistent to MRN, HCP pipelines (pairs))
+def plan_concat_inputs(graph,layout,entry,deps=()):
+  # get links to all input data...
+  imglist=[]; masklist=[]; tables=[]; index=[]; refs=[];
+  x = scheduler.ext(entry)
+  d = entry.wd + '/eddy_dwi_concat'
+  cd = 'cd ' + d + ' ; \n'
+  os.makedirs(d, exist_ok=True)
+
+  cc=0
+  table = scans.table(layout, entry)
+  for scan in table:
+    img = scan.path
+    print(img)
+    imglist.append(img)
+    tables.append(scan.gradients)
+
+    topup_img = '../topup/topup_b0'
+    acqparams = '../acqparams.txt'
+
+    inindex = table.row(scan)  # acqparams row of the phase encoding direction (AP: 1, PA: 2)
+    index += [inindex] * len(tables[-1])
+
+    # reference b0: average of all b0 volumes
+    b0 = d + '/b0_' + str(cc) + x
+    vols = [int(v) for v in tables[-1].b0s()]
+    name = 'eddy2_concat_b0_' + str(cc)
+    last = graph.add(name, target=nifti.extract, args=(img,b0,vols,True),
+                     manifest=manifest.stage(entry, name, [img], [b0], str(vols)))
+
+    # distortion corrected reference and brain mask
+    cmd = cd + 'applytopup --imain=b0_' + str(cc) + ' --topup=' + topup_img + ' --datain=' + acqparams + ' --inindex=' + str(inindex) + ' --method=jac --out=ref_' + str(cc) + ' ; \n'
+    cmd += 'bet ref_' + str(cc) + ' ref_brain_' + str(cc) + ' -m -f 0.2 ; \n'
+    name = 'eddy2_concat_ref_' + str(cc)
+    outputs = [d + '/ref_brain_' + str(cc) + x, d + '/ref_brain_' + str(cc) + '_mask' + x]
+    refs.append(graph.add(name, scheduler.script(entry, name, cmd), [last] + list(deps),
+                          manifest=manifest.stage(entry, name, [b0] + topup_outputs(entry), outputs, cmd)))
+    masklist.append(outputs[1])
+
+    cc=cc+1
+
+  # join bvals, bvecs and index files from all scans
+  gradients.merge(tables).save(d + '/bvals', d + '/bvecs')
+  gradients.write_index(d + '/index_all.txt', index)
+
+  # merge all raw images and average the masks (in process, one volume in memory at a time)...
+  outputs = [d + '/data' + x, d + '/brain_mask' + x]
+  return [graph.add('eddy2_concat_images', deps=refs, target=concat_images, args=(imglist,masklist,d,'data' + x,'brain_mask' + x,entry.ncpus), ncpus=entry.ncpus,
+                    manifest=manifest.stage(entry, 'eddy2_concat_images', imglist + masklist, outputs))]
 
-    # change permissions to make sure file is executable 
-    os.chmod(entry.wd + '/cmd_eddy2_concat.sh', 0o774)
+def run_concat_inputs(layout,entry):
 
-    # run script
-    cmd = "bash " + entry.wd + "/cmd_eddy2_concat.sh"
-    name = 'eddy'
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    p.start()
+  graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+  plan_concat_inputs(graph,layout,entry)
+  graph.run(strict=True)
 
 
-def run_eddy_opt2(layout,entry):
+def plan_eddy_opt2(graph,layout,entry,deps=()):
 
-    itr=0; s=', ';
-    nfiles = len(layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'))
+    itr=0; s=', '; x = scheduler.ext(entry);
+    table = scans.table(layout, entry)
+    nfiles = len(table)
 
     # output filename...
-    dwi = layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi')[0]
-    ent = layout.parse_file_entities(dwi.path)
+    ent = layout.parse_file_entities(table[0].path)
 
     # Define the pattern to build out of the components passed in the dictionary
     pattern = "sub-{subject}/[ses-{session}/]sub-{subject}[_ses-{session}][_task-{task}][_acq-{acquisition}][_rec-{reconstruction}][_run-{run}][_echo-{echo}][_dir-{direction}][_space-{space}][_desc-{desc}]_{suffix}.nii.gz",
@@ -371,32 +341,21 @@ def run_eddy_opt2(layout,entry):
       use_repol="--repol"  # option in eddy to replace outliers with gaussian estimate
     else:
       use_repol=""
-    
-    if os.path.exists(entry.outputs + '/FDT/' + outfile):
-      print('Eddy output exists...skipping')
-    else:
-      print('Concatenating dwi images...')
-
-      run_concat_inputs(layout,entry)
 
-      print('Running Eddy...')
-
-      jobs=[];
-
-      # write bash script for execution
-      original_stdout = sys.stdout # Save a reference to the original standard output
-      sys.stdout.flush()
+    print('Concatenating dwi images...')
 
-      with open(entry.wd + '/cmd_eddy_opt2.sh', 'w') as fid:
-        sys.stdout = fid # Change the standard output to the file we created.
+    deps = plan_concat_inputs(graph,layout,entry,deps)
 
-        print('#!/usr/bin/bash')
-        print('cd ' + entry.wd + '/eddy_dwi_concat ; ')
+    print('Running Eddy...')
 
-        topup_img = '../topup/topup_b0'
-        acqparams = '../acqparams.txt'
+    d = entry.wd + '/eddy_dwi_concat'
+    cd = 'cd ' + d + ' ; \n'
+    topup_files = topup_outputs(entry)
+    eddy_files = eddy_outputs(entry, d + '/eddy_unwarped_images')
+    topup_img = '../topup/topup_b0'
+    acqparams = '../acqparams.txt'
 
-        print("""eddy_openmp --imain=data.nii.gz \
+    cmd = cd + """eddy_openmp --imain=data \
           --mask=brain_mask \
           --index=index_all.txt \
           --acqp=""" + acqparams + """ \
@@ -408,74 +367,51 @@ def run_eddy_opt2(layout,entry):
           --out=eddy_unwarped_images \
           """ + use_repol + """ \
           --cnr_maps   \
-          --data_is_shelled""")
-
-        if entry.eddy_QC == True:
-          print("""eddy_quad eddy_unwarped_images  \
+          --data_is_shelled"""
+    inputs = [d + f for f in ('/data' + x, '/bvals', '/bvecs', '/index_all.txt', '/brain_mask' + x)] + topup_files
+    last = graph.add('eddy_opt2_eddy', scheduler.script(entry, 'eddy_opt2_eddy', cmd), deps, ncpus=scheduler.eddy_threads(entry,1),
+                     mem=memory.Model([sum(scan.nvols for scan in table) * table.volume_mb()], memory.EDDY), manifest=manifest.stage(entry, 'eddy_opt2_eddy', inputs, eddy_files, cmd))
+
+    if entry.eddy_QC == True:
+      cmd = cd + 'rm -rf eddy_unwarped_images.qc\n'  # eddy_quad fails if the report folder exists
+      cmd += """eddy_quad eddy_unwarped_images  \
             -idx index_all.txt \
             -par """ + acqparams + """ \
             -m brain_mask \
             -b bvals \
             -g bvecs \
-            -f """ + topup_img + '_fout')
-
-        print('mkdir -p $(dirname "' + entry.outputs + '/FDT/' + outfile + '")' )
-        print('${FSLDIR}/bin/imcp eddy_unwarped_images.nii.gz ' + entry.outputs + '/FDT/' + outfile)
-        print('cp -p bvals ' + entry.outputs + '/FDT/' + outbval)
-        print('cp -p eddy_unwarped_images.eddy_rotated_bvecs ' + entry.outputs + '/FDT/' + outbvec)
-        print('cp -p brain_mask.nii.gz ' + entry.outputs + '/FDT/' + outmask)
-        print('cp -p ref_brain_0.nii.gz ' + entry.outputs + '/FDT/' + outref)
-        print('cp -rp eddy_unwarped_images.qc/ ' + entry.outputs + '/FDT/' + outqc)
+            -f """ + topup_img + '_fout'
+      last = graph.add('eddy_opt2_quad', scheduler.script(entry, 'eddy_opt2_quad', cmd), [last],
+                       manifest=manifest.stage(entry, 'eddy_opt2_quad', eddy_files + [d + '/brain_mask' + x], [d + '/eddy_unwarped_images.qc'], cmd))
+
+    cmd = cd + 'mkdir -p $(dirname "' + entry.outputs + '/FDT/' + outfile + '")\n'
+    cmd += scheduler.publish('eddy_unwarped_images' + x, entry.outputs + '/FDT/' + outfile, threads=entry.ncpus)
+    cmd += scheduler.publish('bvals', entry.outputs + '/FDT/' + outbval)
+    cmd += scheduler.publish('eddy_unwarped_images.eddy_rotated_bvecs', entry.outputs + '/FDT/' + outbvec)
+    cmd += scheduler.publish('brain_mask' + x, entry.outputs + '/FDT/' + outmask, threads=entry.ncpus)
+    cmd += scheduler.publish('ref_brain_0' + x, entry.outputs + '/FDT/' + outref, threads=entry.ncpus)
+    inputs = eddy_files + [d + f for f in ('/bvals', '/brain_mask' + x, '/ref_brain_0' + x)]
+    outputs = [entry.outputs + '/FDT/' + f for f in (outfile, outbval, outbvec, outmask, outref)]
+    if entry.eddy_QC == True:
+      cmd += scheduler.publish('eddy_unwarped_images.qc', entry.outputs + '/FDT/' + outqc)
+      inputs.append(d + '/eddy_unwarped_images.qc')
+      outputs.append(entry.outputs + '/FDT/' + outqc)
+    publish = graph.add('eddy_opt2_publish', scheduler.script(entry, 'eddy_opt2_publish', cmd), [last], ncpus=entry.ncpus,  # gzip threads
+                        manifest=manifest.stage(entry, 'eddy_opt2_publish', inputs, outputs, cmd))
+
+    inputs = [d + '/eddy_unwarped_images' + f for f in confounds.OUTPUTS]
+    outputs = confounds.outputs(entry.outputs + '/FDT/' + outbase, entry.confounds_format)
+    graph.add('eddy2_confounds', deps=[publish], target=confounds.generate, args=([d + '/eddy_unwarped_images'],entry.outputs + '/FDT/' + outbase,entry.confounds_format),
+              manifest=manifest.stage(entry, 'eddy2_confounds', inputs, outputs, entry.confounds_format))
+
+    return [publish], [entry.outputs + '/FDT/' + outfile]
+
+    ## end plan_eddy_opt2
 
-        sys.stdout = original_stdout # Reset the standard output to its original value
-
-      # change permissions to make sure file is executable 
-      os.chmod(entry.wd + '/cmd_eddy_opt2.sh', 0o774)
-
-      # run script
-      cmd = "bash " + entry.wd + "/cmd_eddy_opt2.sh"
-      name = 'eddy'
-      p = multiprocessing.Process(target=worker, args=(name,cmd))
-      jobs.append(p)
-      p.start()
-
-      print(p)
-
-      for job in jobs:
-        job.join()  #wait for all eddy commands to finish
-
-      generate_confounds_file(entry,entry.outputs + '/FDT/' + outbase)
+def run_eddy_opt2(layout,entry):
 
+    graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+    plan_eddy_opt2(graph,layout,entry)
+    graph.run(strict=True)
 
     ## end run_eddy_opt2
-
-
-def generate_confounds_file(entry,outbase):
-
-  # after running fsl outliers - put all coundounds into one file
-  
-  df=pd.DataFrame()
-
-  # read in RMS motion data from eddy (detailed description on eddy user guide)
-
-  for f in sorted(glob.glob(entry.wd + '/eddy_dwi*/eddy_unwarped_images.eddy_movement_rms')):
-    d=pd.read_csv(f,sep="\s+")  
-    colnames=["eddy_movement_rms_abs","eddy_movement_rms_disp"]
-    d.columns = colnames
-
-    df = pd.concat([df,d],axis=0)
-
-  # output a single confounds file
-  df.to_csv(outbase + "_confounds.tsv",sep="\t")
-
-  df=pd.DataFrame()
-  for f in sorted(glob.glob(entry.wd + '/eddy_dwi*/eddy_unwarped_images.eddy_outlier_report')):
-    d2=pd.read_csv(f,header=None,sep="\t")  
-    d1=pd.DataFrame([f])
-    d = pd.concat([d1,d2],axis=0)
-    df = pd.concat([df,d],axis=0)
-
-  # output a single outlier file
-  df.to_csv(outbase + "_outlier_log.txt",sep="\t",index=False)
-
-  # END GENERATE_CONFOUNDS_FILE
@@ -0,0 +1,91 @@
+# FDT utility functions for diffusion gradient tables (bvals / bvecs / eddy index / acqparams)
+# inputs: bval, bvec --> fsl formatted gradient files (one row of bvals, three rows of bvecs)
+#
+# Replaces the text munging done in the generated bash scripts (grep / paste / seq / fslval):
+# tables are parsed with numpy, b0 volumes and shells are detected with a tolerance and the
+# eddy index / acqparams files are written directly by python.
+
+import os
+import numpy as np
+
+B0_TOL = 50      # volumes with bval <= B0_TOL are treated as b0
+SHELL_TOL = 100  # bvals within SHELL_TOL of each other belong to the same shell
+
+
+class GradientTable:
+    """bvals (n,) and bvecs (3, n) of one dwi scan (or of several merged scans)"""
+    def __init__(self, bvals, bvecs):
+        self.bvals = np.asarray(bvals, dtype=float).ravel()
+        self.bvecs = np.asarray(bvecs, dtype=float).reshape(3, -1)
+        if self.bvals.size != self.bvecs.shape[1]:
+          raise Exception("Gradient table mismatch: " + str(self.bvals.size) + " bvals and " + str(self.bvecs.shape[1]) + " bvecs")
+
+    @classmethod
+    def load(cls, bval, bvec):
+        bvals = np.loadtxt(bval, ndmin=1)
+        bvecs = np.loadtxt(bvec, ndmin=2)
+        if bvecs.shape[0] != 3 and bvecs.shape[1] == 3:
+          bvecs = bvecs.T  # one vector per row
+        try:
+          return cls(bvals, bvecs)
+        except Exception as err:
+          raise Exception(str(err) + " (" + bval + ", " + bvec + ")")
+
+    def __len__(self):
+        return self.bvals.size
+
+    def b0s(self, tol=B0_TOL):
+        """Indices of the b0 volumes"""
+        return np.flatnonzero(self.bvals <= tol)
+
+    def shells(self, tol=SHELL_TOL):
+        """b-value of every shell (including b0), sorted"""
+        shells = []; members = []
+        for b in np.sort(self.bvals):
+          if members and b - members[0] <= tol:
+            members.append(b)
+          else:
+            if members:
+              shells.append(int(round(np.mean(members))))
+            members = [b]
+        if members:
+          shells.append(int(round(np.mean(members))))
+        return shells
+
+    def validate(self, img):
+        """Checks the number of gradients against the number of volumes in the nifti header"""
+        nvols = volumes(img)
+        if nvols != len(self):
+          raise Exception("Gradient table has " + str(len(self)) + " entries but " + img + " has " + str(nvols) + " volumes")
+        return self
+
+    def save(self, bval, bvec):
+        with open(bval, 'w') as fid:
+          fid.write(' '.join('%g' % b for b in self.bvals) + '\n')
+        with open(bvec, 'w') as fid:
+          for row in self.bvecs:
+            fid.write(' '.join('%.10g' % v for v in row) + '\n')
+
+
+def merge(tables):
+    """Concatenates the gradient tables of several scans (in acquisition order)"""
+    return GradientTable(np.concatenate([t.bvals for t in tables]), np.hstack([t.bvecs for t in tables]))
+
+def volumes(img):
+    """Number of volumes (dim4) from the nifti header, without reading the image data"""
+    from . import nifti
+    shape = nifti.header(img)[0]
+    return shape[3] if len(shape) > 3 else 1
+
+def write_index(path, inindex):
+    """eddy --index file: acqparams row used by every volume (inindex is one row per volume)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fid:
+      fid.write('\n'.join(str(i) for i in inindex) + '\n')
+
+def write_acqparams(path, rows):
+    """topup / eddy --acqp file: rows of (phase encoding vector, total readout time)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fid:
+      for pe, readout in rows:
+        fid.write(' '.join(str(v) for v in pe) + ' ' + str(readout) + '\n')
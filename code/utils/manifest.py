@@ -0,0 +1,189 @@
+# FDT utility functions for tracking stage inputs and outputs (incremental recomputation)
+# inputs: entry  --> structure with all the user defined inputs
+#
+# Each stage writes a manifest (<work-dir>/manifest/<stage>.json) after it finishes successfully,
+# recording the content hash of every input, the fsl version and the stage command (option set).
+# A stage is only re-run when one of those changes or when any of its outputs is missing.
+#
+# Stage starts, completions and failures are also appended to a journal (<work-dir>/journal.jsonl,
+# fsynced), so after an interruption (e.g. preempted node) the stages that were running are known:
+# their partial outputs are removed before they are redone. With --resume, stages the journal lists as
+# completed (with all outputs present) are skipped without re-hashing their inputs, as long as the
+# size and modification time of every input and the options still match their manifest (an upstream
+# stage redone since, or changed options, fall back to the full check).
+
+import os, json, time, shutil, hashlib
+
+def fsl_version():
+    """Version of the fsl installation used to run the pipeline"""
+    try:
+      with open(os.environ.get('FSLDIR', '') + '/etc/fslversion') as fid:
+        return fid.read().strip()
+    except OSError:
+      return 'unknown'
+
+def stat(path):
+    """Size and modification time, used to avoid re-hashing unchanged files"""
+    if os.path.isdir(path):
+      return [stat(os.path.join(path, f)) for f in sorted(os.listdir(path))]
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+def filehash(path):
+    """Content hash of a file (or of every file in a directory)"""
+    h = hashlib.sha1()
+    if os.path.isdir(path):
+      for f in sorted(os.listdir(path)):
+        h.update((f + ' ' + filehash(os.path.join(path, f)) + '\n').encode())
+    else:
+      with open(path, 'rb') as fid:
+        for block in iter(lambda: fid.read(1 << 20), b''):
+          h.update(block)
+    return h.hexdigest()
+
+
+class Journal:
+    """Append only log of stage starts / completions of one working directory"""
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, stage, event):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a') as fid:
+          fid.write(json.dumps({'stage': stage, 'event': event, 'time': time.time()}) + '\n')
+          fid.flush()
+          os.fsync(fid.fileno())  # survives the node going away right after
+
+    def last(self, stage):
+        """Last event recorded for a stage (None if never started)"""
+        event = None
+        if os.path.exists(self.path):
+          with open(self.path) as fid:
+            for line in fid:
+              try:
+                rec = json.loads(line)
+              except ValueError:
+                continue  # line cut short by an interruption
+              if rec['stage'] == stage:
+                event = rec['event']
+        return event
+
+
+class Manifest:
+    """Inputs, outputs and options of a single stage"""
+    def __init__(self, path, inputs, outputs, options='', journal=None, resume=False):
+        self.path = path
+        self.name = os.path.basename(path)[:-len('.json')]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.options = options
+        self.journal = journal
+        self.resume = resume
+        self.record = None
+
+    def hash_inputs(self):
+        """Hashes the current inputs, reusing the recorded hash when size and mtime are unchanged"""
+        old = {}
+        if os.path.exists(self.path):
+          with open(self.path) as fid:
+            old = json.load(fid).get('inputs', {})
+
+        inputs = {}
+        for f in self.inputs:
+          if not os.path.exists(f):
+            inputs[f] = None
+            continue
+          st = stat(f)
+          if f in old and old[f] is not None and old[f]['stat'] == st:
+            inputs[f] = old[f]
+          else:
+            inputs[f] = {'stat': st, 'sha1': filehash(f)}
+
+        return {'inputs': inputs,
+                'options': hashlib.sha1(self.options.encode()).hexdigest(),
+                'fsl_version': fsl_version(),
+                'outputs': self.outputs}
+
+    def unchanged(self):
+        """True if the inputs (size and modification time) and options recorded in the manifest still hold"""
+        with open(self.path) as fid:
+          old = json.load(fid)
+        if old.get('options') != hashlib.sha1(self.options.encode()).hexdigest() or set(old['inputs']) != set(self.inputs):
+          return False
+        for f, i in old['inputs'].items():
+          if (i is None) != (not os.path.exists(f)) or (i is not None and i['stat'] != stat(f)):
+            return False
+        return True
+
+    def current(self):
+        """True if the stage finished before with the same inputs, options and tool version, and all outputs exist"""
+        if self.resume and self.journal is not None and os.path.exists(self.path) and all(os.path.exists(f) for f in self.outputs):
+          if self.journal.last(self.name) == 'done' and self.unchanged():
+            return True   # completed before the interruption (inputs not re-hashed)
+
+        self.record = self.hash_inputs()
+
+        if not os.path.exists(self.path):
+          return False
+        if not all(os.path.exists(f) for f in self.outputs):
+          return False   # partial outputs (e.g. crashed or removed)
+
+        with open(self.path) as fid:
+          old = json.load(fid)
+
+        key = lambda r: (dict((f, i and i['sha1']) for f, i in r['inputs'].items()), r['options'], r['fsl_version'], r['outputs'])
+        return key(old) == key(self.record)
+
+    def invalidate(self):
+        """Removes the manifest before the stage runs, so an interrupted stage is always redone.
+        Outputs left by an interrupted run of the stage are removed first"""
+        if os.path.exists(self.path):
+          os.remove(self.path)
+        if self.journal is not None:
+          last = self.journal.last(self.name)
+          if last in ('start', 'failed'):
+            if last == 'start':
+              print('Stage interrupted in a previous run (preempted or stopped), removing partial outputs: ' + self.name)
+            else:
+              print('Stage failed in a previous run, removing its outputs: ' + self.name)
+            for f in self.outputs:
+              for p in (f, f + '.part'):
+                if os.path.isdir(p) and not os.path.islink(p):
+                  shutil.rmtree(p)
+                elif os.path.lexists(p):
+                  os.remove(p)
+          self.journal.append(self.name, 'start')
+        # outputs hard linked to published derivatives (see publish.py): unlinked so a tool rewriting
+        # them in place can not change the derivatives
+        for f in self.outputs:
+          if os.path.isfile(f) and not os.path.islink(f) and os.stat(f).st_nlink > 1:
+            os.remove(f)
+        # image written by a run with the other intermediate format (--compress-intermediates): fsl
+        # refuses to pick between img.nii and img.nii.gz
+        for f in self.outputs:
+          twin = f[:-3] if f.endswith('.nii.gz') else f + '.gz' if f.endswith('.nii') else None
+          if twin is not None and os.path.isfile(twin):
+            os.remove(twin)
+
+    def commit(self):
+        """Writes the manifest once the stage finished and all outputs exist"""
+        if not all(os.path.exists(f) for f in self.outputs):
+          print('Stage outputs missing, not recording manifest: ' + self.path)
+          return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.tmp', 'w') as fid:
+          json.dump(self.record, fid, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+        if self.journal is not None:
+          self.journal.append(self.name, 'done')
+
+    def fail(self):
+        """Records in the journal that the stage command failed (told apart from an interruption on resume)"""
+        if self.journal is not None:
+          self.journal.append(self.name, 'failed')
+
+
+def stage(entry,name,inputs,outputs,options=''):
+    """Manifest for a pipeline stage (saved in the working directory), journaled in <work-dir>/journal.jsonl"""
+    return Manifest(entry.wd + '/manifest/' + name + '.json', inputs, outputs, options,
+                    Journal(entry.wd + '/journal.jsonl'), entry.resume)
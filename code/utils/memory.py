@@ -0,0 +1,111 @@
+# FDT utility functions for memory aware scheduling of pipeline stages
+# inputs: node   --> scheduler.Node (stage) to estimate
+#         images --> nifti images (.nii or .nii.gz) read by a stage
+#
+# A stage is only started while the memory estimated for it fits in the budget next to the stages
+# already running (--mem-gb, otherwise 90% of the cgroup memory limit or of the physical memory),
+# extra stages are queued like stages waiting for cpus. The estimate of a stage is the largest max rss
+# of its previous runs (metrics file) + 50%, or without history a model of the tool: the float32 size
+# of its input images (from the nifti headers, read once the inputs exist) x a per tool factor + a
+# fixed overhead. A stage killed by the kernel out of memory killer is queued again with twice the
+# memory reserved, so fewer stages run next to it; the last retry runs alone.
+
+import os, math
+from . import metrics, nifti
+
+BASE_MB = 256     # overhead of every stage (tool binaries, libraries, small files)
+FACTOR = 2.       # default: input images plus one output of the same size
+MARGIN = 1.5      # margin on the max rss of previous runs
+RESERVE = 0.9     # fraction of the detected limit used as budget (the scheduler, page cache)
+OOM_RETRIES = 2   # runs of a stage after it was killed out of memory (the last one alone)
+
+# per tool models (factor on the float32 size of the input images)
+EDDY = 8.         # eddy_openmp: input, predictions, corrected series and resampling buffers
+TOPUP = 40.       # topup: warps and hessian at the finest level, on a small b0 series
+TENSOR = 4.       # dtifit / native fit: input as float plus the fitted maps (see dtifit.SLAB_BYTES)
+SLICES = 0.25     # bedpostx slice fits: one slice of the series at a time per task
+
+def physical():
+    """Physical memory (bytes)"""
+    try:
+      with open('/proc/meminfo') as fid:
+        for line in fid:
+          if line.startswith('MemTotal:'):
+            return int(line.split()[1]) * 1024
+    except OSError:
+      pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def cgroup_limit():
+    """Memory limit of the cgroup of this process (bytes, v2 or v1), None without limit"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+      try:
+        with open(path) as fid:
+          value = fid.read().strip()
+      except OSError:
+        continue
+      if value != 'max' and int(value) < physical():  # v1 reports a huge number without limit
+        return int(value)
+    return None
+
+def budget(mem_gb=None):
+    """Memory (MB) shared by the running stages: mem_gb, or the cgroup limit / physical memory less a reserve"""
+    if mem_gb:
+      return mem_gb * 1024.
+    return (cgroup_limit() or physical()) * RESERVE / 2.**20
+
+def image_mb(path):
+    """Size (MB) of an image as float32, from its nifti header (0 if missing or not an image)"""
+    if not path.endswith(('.nii', '.nii.gz')) or not os.path.exists(path):
+      return 0.
+    hdr = nifti.header(path)
+    return float(math.prod(max(d, 1) for d in hdr[0])) * 4 / 2.**20 if hdr else 0.
+
+class Model:
+    """Memory (MB) of a tool from its input images: base + factor x float32 size of the images.
+    Evaluated when the stage is ready to start (its inputs written by earlier stages). Images may
+    also be given by their size in MB (known at planning, see scans.py)"""
+    def __init__(self, images, factor=FACTOR, base=BASE_MB):
+        self.images = list(images)
+        self.factor = factor
+        self.base = base
+
+    def __call__(self):
+        return self.base + self.factor * sum(f if isinstance(f, (int, float)) else image_mb(f) for f in self.images)
+
+def history(path,name):
+    """Largest max rss (MB) of the previous runs of a stage + margin, None without history"""
+    if path is None or not os.path.exists(path):
+      return None
+    rss = [r['maxrss_mb'] for r in metrics.load(path) if r.get('stage') == name and r.get('maxrss_mb')]
+    return max(rss) * MARGIN if rss else None
+
+def estimate(node):
+    """Memory (MB) expected for a stage: its history, else its model (node.mem, a number or a Model),
+    else the default model on the images of its manifest"""
+    mb = history(node.metrics, node.name)
+    if mb is not None:
+      return mb
+    if node.mem is not None:
+      return node.mem() if callable(node.mem) else float(node.mem)
+    return Model(node.manifest.inputs if node.manifest is not None else [])()
+
+def oom_kills():
+    """Processes of this cgroup killed by the out of memory killer so far (None if not reported)"""
+    for path, field in (('/sys/fs/cgroup/memory.events', 'oom_kill'), ('/sys/fs/cgroup/memory/memory.oom_control', 'oom_kill')):
+      try:
+        with open(path) as fid:
+          for line in fid:
+            if line.split()[0] == field:
+              return int(line.split()[1])
+      except (OSError, IndexError, ValueError):
+        continue
+    return None
+
+def killed(code,before):
+    """Stage exit code from a SIGKILL (python stage: -9, bash script: 137) counted by the oom killer
+    since before (oom_kills() when the stage started; any SIGKILL when the kernel does not report it)"""
+    if code not in (-9, 128 + 9):
+      return False
+    after = oom_kills()
+    return before is None or after is None or after > before
@@ -0,0 +1,87 @@
+# FDT utility functions for recording the resources used by each pipeline stage
+# inputs: path --> metrics file (<work-dir>/logs/metrics.jsonl), one json record per stage
+#
+# Every stage records start / stop time, cpu time and peak memory (rusage of the stage process and
+# of the commands it waited on), bytes read / written (/proc/<pid>/io, includes reaped children) and
+# the exit code: commands through runner.run (wait4), python stages through measure(). export() converts the records
+# to the chrome trace format (chrome://tracing or https://ui.perfetto.dev) to show concurrency.
+
+import os, sys, json, time, resource, traceback
+
+def io_counters(pid='self'):
+    """Bytes read / written by a process and its reaped children (linux only)"""
+    try:
+      with open('/proc/' + str(pid) + '/io') as fid:
+        return dict((k, int(v)) for k, v in (line.split(':') for line in fid))
+    except OSError:
+      return None
+
+def record(path,rec):
+    """Appends one record to the metrics file (single write, safe with concurrent stages)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as fid:
+      fid.write(json.dumps(rec) + '\n')
+
+def stage(name,start,end,ncpus,usages,io,code):
+    """Record of a finished stage, usages: rusage of the stage processes (each including the commands it waited on)"""
+    rec = {'stage': name, 'start': start, 'end': end, 'wall': end - start, 'ncpus': ncpus,
+           'user': sum(u.ru_utime for u in usages), 'sys': sum(u.ru_stime for u in usages),
+           'maxrss_mb': max(u.ru_maxrss for u in usages) / 1024.,  # largest single process (kB on linux)
+           'read_bytes': io['read_bytes'] if io else sum(u.ru_inblock for u in usages) * 512,
+           'write_bytes': io['write_bytes'] if io else sum(u.ru_oublock for u in usages) * 512,
+           'exitcode': code}
+    if io:
+      rec['rchar'] = io['rchar']; rec['wchar'] = io['wchar']
+    return rec
+
+def measure(path,name,ncpus,target,args):
+    """Runs a stage (in the stage process) and records its resource usage, keeps the exit code"""
+    start = time.time()
+    code = 0
+    try:
+      target(*args)
+    except SystemExit as err:
+      code = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+    except BaseException:
+      traceback.print_exc()
+      code = 1
+    finally:
+      usages = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+      record(path, stage(name, start, time.time(), ncpus, usages, io_counters(), code))
+    sys.exit(code)
+
+def logfile(entry):
+    """Metrics file of a participant (in the working directory logs)"""
+    return entry.wd + '/logs/metrics.jsonl'
+
+def load(path):
+    with open(path) as fid:
+      return [json.loads(line) for line in fid if line.strip()]
+
+def export(path,out=None):
+    """Writes the records of a metrics file as a chrome trace (one row per concurrently running stage)"""
+    recs = load(path)
+    runs = [i for i, r in enumerate(recs) if 'run' in r]
+    recs = recs[runs[-1] if runs else 0:]  # latest run only
+    recs = sorted((r for r in recs if 'start' in r), key=lambda r: r['start'])
+    out = out or os.path.join(os.path.dirname(path), 'trace.json')
+    t0 = recs[0]['start'] if recs else 0
+
+    events = []; lanes = []
+    for r in recs:
+      # first lane free at the start of the stage, so overlapping stages are drawn on separate rows
+      lane = next((i for i, end in enumerate(lanes) if end <= r['start']), len(lanes))
+      if lane == len(lanes):
+        lanes.append(0)
+      lanes[lane] = r['end']
+      events.append({'name': r['stage'], 'ph': 'X', 'pid': 1, 'tid': lane,
+                     'ts': (r['start'] - t0) * 1e6, 'dur': r['wall'] * 1e6,
+                     'args': dict((k, v) for k, v in r.items() if k not in ('stage', 'start', 'end'))})
+
+    with open(out, 'w') as fid:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fid)
+    return out
+
+# python utils/metrics.py <work-dir>/logs/metrics.jsonl [trace.json]
+if __name__ == "__main__":
+    print(export(*sys.argv[1:3]))
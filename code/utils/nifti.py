@@ -0,0 +1,199 @@
+# FDT utility functions for in-process nifti operations (replaces fslroi / fslselectvols / fslmerge / fslmaths glue)
+# inputs: nifti image paths (.nii or .nii.gz)
+#
+# Images are read one volume at a time (memory mapped for uncompressed files) and outputs are
+# streamed to disk in blocks of volumes, so peak memory stays at a few blocks instead of the
+# full 4d series.
+
+import os, io, gzip, struct, collections, concurrent.futures
+import numpy as np
+
+COMPRESSLEVEL = 6  # same default as fsl (zlib)
+NIFTI_OFFSET = 352  # single file nifti-1: 348 byte header + 4 byte extension flag
+BLOCKSIZE = 16 * 1024**2  # bytes of image data compressed / written at a time
+
+def header(path):
+    """Image dims and voxel sizes from the nifti-1 / nifti-2 header only (no data read, no nibabel):
+    (shape, pixdims), None if the file is not a nifti image"""
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as fid:
+      hdr = fid.read(540)
+    for endian in '<>':
+      sizeof = struct.unpack(endian + 'i', hdr[:4])[0]
+      if sizeof == 348:
+        dims = struct.unpack(endian + '8h', hdr[40:56]); pixdims = struct.unpack(endian + '8f', hdr[76:108])
+        break
+      if sizeof == 540 and len(hdr) == 540:
+        dims = struct.unpack(endian + '8q', hdr[16:80]); pixdims = struct.unpack(endian + '8d', hdr[104:168])
+        break
+    else:
+      return None
+    n = min(max(dims[0], 0), 7)
+    return tuple(dims[1:1 + n]), tuple(pixdims[1:1 + n])
+
+def load(path):
+    import nibabel
+    return nibabel.load(path, mmap=True)
+
+def nvols(img):
+    return img.shape[3] if len(img.shape) > 3 else 1
+
+def volume(img,v):
+    """Single volume of a (3d or 4d) image"""
+    if len(img.shape) < 4:
+      return np.asanyarray(img.dataobj)
+    return np.asanyarray(img.dataobj[..., v])
+
+def volumes(img,vols=None):
+    """Iterates over volumes of an image (all by default). Compressed images are decompressed once,
+    in order, instead of once for every volume read through the array proxy"""
+    vols = list(range(nvols(img)) if vols is None else vols)
+    path = img.get_filename()
+    if not path.endswith('.gz') or vols != sorted(vols):
+      for v in vols:
+        yield volume(img, v)
+      return
+
+    dtype = img.get_data_dtype()
+    shape = img.shape[:3]
+    size = int(np.prod(shape)) * dtype.itemsize
+    offset = img.dataobj.offset
+    with gzip.open(path, 'rb') as fid:
+      for v in vols:
+        fid.seek(offset + v * size)  # forward seeks only
+        data = np.frombuffer(fid.read(size), dtype).reshape(shape, order='F')
+        if scaled(img):
+          data = data * img.dataobj.slope + img.dataobj.inter
+        yield data
+
+def scaled(img):
+    # nibabel moves scl_slope / scl_inter from the header of loaded images to the array proxy
+    return getattr(img.dataobj, 'slope', 1) != 1 or getattr(img.dataobj, 'inter', 0) != 0
+
+def blocks(volumes,dtype,blocksize=BLOCKSIZE):
+    """Groups the raw bytes of consecutive volumes into blocks of about blocksize bytes"""
+    buf = []; size = 0
+    for vol in volumes:
+      buf.append(np.asarray(vol, dtype=dtype).tobytes(order='F'))
+      size += len(buf[-1])
+      if size >= blocksize:
+        yield len(buf), b''.join(buf)
+        buf = []; size = 0
+    if buf:
+      yield len(buf), b''.join(buf)
+
+def compress(data):
+    """Independent gzip member (members can be compressed in parallel and concatenated)"""
+    return gzip.compress(data, compresslevel=COMPRESSLEVEL, mtime=0)
+
+def write(out,ref,nvols,volumes,dtype=None,threads=1):
+    """Streams 3d volumes (an iterator) into a new 4d nifti with the geometry of ref.
+
+    The header (dim4 = nvols) is written first and volume blocks are appended as they are read,
+    so memory stays at a few blocks. .nii.gz outputs are written as a series of gzip members
+    compressed by up to threads workers (zlib releases the GIL); .nii outputs are written
+    uncompressed. The file is written to a temporary name and renamed once complete"""
+    hdr = ref.header.copy()
+    hdr.extensions.clear()
+    hdr.set_data_shape(ref.shape[:3] + ((nvols,) if nvols > 1 else ()))  # single volumes are written as 3d images
+    hdr.set_data_dtype(dtype or ref.get_data_dtype())
+    hdr.set_slope_inter(1, 0)
+    hdr.set_data_offset(NIFTI_OFFSET)
+    dtype = hdr.get_data_dtype().newbyteorder(hdr.endianness)
+
+    header = io.BytesIO()
+    hdr.write_to(header)
+    header = header.getvalue().ljust(NIFTI_OFFSET, b'\0')
+
+    tmp = out + '.part'
+    n = 0
+    with open(tmp, 'wb') as fid:
+      if not out.endswith('.gz'):
+        fid.write(header)
+        for count, data in blocks(volumes, dtype):
+          fid.write(data)
+          n = n + count
+      else:
+        fid.write(compress(header))
+        with concurrent.futures.ThreadPoolExecutor(max(threads,1)) as pool:
+          queue = collections.deque()
+          for count, data in blocks(volumes, dtype):
+            queue.append(pool.submit(compress, data))
+            n = n + count
+            while len(queue) > threads:  # bounded number of blocks in memory
+              fid.write(queue.popleft().result())
+          while queue:
+            fid.write(queue.popleft().result())
+    if n != nvols:
+      os.remove(tmp)
+      raise Exception("Expected " + str(nvols) + " volumes for " + out + ", got " + str(n))
+    os.replace(tmp, out)
+    return out
+
+def output_dtype(imgs):
+    """On-disk type of the inputs if they all agree (and are unscaled), otherwise float32"""
+    dtypes = set(img.get_data_dtype() for img in imgs)
+    if len(dtypes) == 1 and not any(scaled(img) for img in imgs):
+      return dtypes.pop()
+    return np.float32
+
+def extract(path,out,vols,mean=False):
+    """Selected volumes of an image (fslroi / fslselectvols), or their mean (fslselectvols -m)"""
+    img = load(path)
+    if not mean:
+      return write(out, img, len(vols), volumes(img, vols), output_dtype([img]))
+
+    total = np.zeros(img.shape[:3])
+    for vol in volumes(img, vols):
+      total += vol
+    return write(out, img, 1, [total / len(vols)], np.float32)
+
+def select(sources,out,threads=1):
+    """Volumes from one or more images stacked along time, sources is a list of (path, volume index)"""
+    imgs = {}
+    for p, v in sources:
+      if p not in imgs:
+        imgs[p] = load(p)
+    paths = list(imgs)
+    for p in paths:
+      if imgs[p].shape[:3] != imgs[paths[0]].shape[:3]:
+        raise Exception("Image dimensions do not match: " + p + " " + str(imgs[p].shape[:3]) + " / " + paths[0] + " " + str(imgs[paths[0]].shape[:3]))
+    # consecutive volumes of the same image are streamed in one pass (each .nii.gz decompressed once)
+    runs = []
+    for p, v in sources:
+      if runs and runs[-1][0] == p:
+        runs[-1][1].append(v)
+      else:
+        runs.append((p, [v]))
+    vols = (vol for p, vs in runs for vol in volumes(imgs[p], vs))
+    return write(out, imgs[paths[0]], len(sources), vols, output_dtype(list(imgs.values())), threads)
+
+def concat(paths,out,threads=1):
+    """Concatenates images along time (fslmerge -t), output dim4 is the sum of the inputs"""
+    return select([(p, v) for p in paths for v in range(nvols(load(p)))], out, threads)
+
+def slices(path,zs,outs):
+    """Single z slices of an image (fslslice), one output per slice, all read in one pass"""
+    img = load(path)
+    data = dict((z, []) for z in zs)
+    for vol in volumes(img):
+      for z in zs:
+        data[z].append(np.array(vol[:, :, z:z + 1]))
+    return [write(out, img.slicer[:, :, z:z + 1], len(data[z]), data[z], output_dtype([img])) for z, out in zip(zs, outs)]
+
+def slabs(path,bounds,outs):
+    """z slabs [(z0, z1), ...] of an uncompressed image, one output per slab, read from the memory map
+    (only the slab of each volume is paged in)"""
+    img = load(path)
+    if path.endswith('.gz'):
+      raise Exception("Memory mapped slabs need an uncompressed image: " + path)
+    part = lambda z0, z1, v: np.asanyarray(img.dataobj[:, :, z0:z1, v] if len(img.shape) > 3 else img.dataobj[:, :, z0:z1])
+    return [write(out, img.slicer[:, :, z0:z1], nvols(img), (part(z0, z1, v) for v in range(nvols(img))), output_dtype([img]))
+            for (z0, z1), out in zip(bounds, outs)]
+
+def average_mask(paths,out,thr=0.5):
+    """Mask covering the voxels inside at least a fraction thr of the input masks (fslmaths -add ... -div n -thr thr -bin)"""
+    imgs = [load(p) for p in paths]
+    total = np.zeros(imgs[0].shape[:3])
+    for img in imgs:
+      total += volume(img, 0) > 0
+    return write(out, imgs[0], 1, [(total / len(imgs)) >= thr], np.float32)
@@ -0,0 +1,179 @@
+# FDT utility functions for publishing derivatives without copying the data
+# usage: python publish.py [--mode=link|copy|move] [--verify=size|checksum] [--threads=N] <src> <dst>
+#
+# Files (or every file of a folder) are placed next to dst as dst.part, verified, then renamed to dst,
+# so an interrupted stage never leaves a partial derivative behind. On the same filesystem nothing is
+# copied: link mode uses a hard link, or a reflink (FICLONE, copy on write on btrfs / xfs) where hard
+# links are not possible, move mode renames. Otherwise the file is streamed to the destination.
+# Verification compares sizes (or sha1 checksums) of the streamed and cloned files, and the member
+# sizes recorded in the gzip trailers (or the decompressed sha1) of compressed files.
+# Intermediate images are uncompressed (.nii): published as .nii.gz (src .nii to dst .nii.gz, and every
+# .nii file of a folder) they are compressed on the way, as independent gzip members of GZBLOCK bytes
+# compressed in parallel (pigz style, readable by any gzip reader), so compression uses all the cores.
+# Standalone (standard library only): called from the stage bash scripts, see scheduler.publish.
+
+import os, sys, zlib, fcntl, shutil, getopt, hashlib, concurrent.futures
+
+FICLONE = 0x40049409  # linux ioctl: share the extents of another file (reflink)
+BLOCK = 1 << 20
+GZBLOCK = 4 << 20  # uncompressed bytes per gzip member
+COMPRESSLEVEL = 6  # same default as fsl (zlib)
+
+def sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fid:
+      for block in iter(lambda: fid.read(BLOCK), b''):
+        h.update(block)
+    return h.hexdigest()
+
+def reflink(src,dst):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+      fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+      shutil.rmtree(path)
+    elif os.path.lexists(path):
+      os.remove(path)
+
+def member(data):
+    """Independent gzip member (header without name or time: identical outputs for identical inputs)"""
+    z = zlib.compressobj(COMPRESSLEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff' + z.compress(data) + z.flush() +
+            (zlib.crc32(data) & 0xffffffff).to_bytes(4, 'little') + (len(data) & 0xffffffff).to_bytes(4, 'little'))
+
+def gzip(src,dst,threads=1,verify='size'):
+    """Compresses src to dst, GZBLOCK members compressed by threads workers (at most 2 blocks
+    per worker in memory). Verified from dst: the header and size trailer (ISIZE) of every member add
+    up to the size of src, or by decompressing with verify=checksum"""
+    members = []  # (compressed, uncompressed) bytes of every member written
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst, concurrent.futures.ThreadPoolExecutor(threads) as pool:
+      pending = []
+      def write(f):
+        data, n = f.result()
+        fdst.write(data)
+        members.append((len(data), n))
+      for block in iter(lambda: fsrc.read(GZBLOCK), b''):
+        pending.append(pool.submit(lambda b: (member(b), len(b)), block))  # zlib releases the gil
+        if len(pending) >= 2 * threads:
+          write(pending.pop(0))
+      for f in pending:
+        write(f)
+    shutil.copystat(src, dst)
+
+    ok = os.path.getsize(dst) == sum(c for c, n in members) and sum(n for c, n in members) == os.path.getsize(src)
+    with open(dst, 'rb') as fid:
+      offset = 0
+      for c, n in members:
+        if not ok:
+          break
+        fid.seek(offset)
+        magic = fid.read(2)
+        fid.seek(offset + c - 4)
+        ok = magic == b'\x1f\x8b' and int.from_bytes(fid.read(4), 'little') == n & 0xffffffff
+        offset += c
+    if ok and verify == 'checksum':
+      h = hashlib.sha1()
+      with open(dst, 'rb') as fid:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        for block in iter(lambda: fid.read(BLOCK), b''):
+          while block:
+            h.update(d.decompress(block))
+            if not d.eof:
+              break
+            block = d.unused_data  # next member
+            d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+      ok = h.hexdigest() == sha1(src)
+    return ok
+
+def place(src,dst,mode='link',verify='size',threads=1,compress=False):
+    """Places one file at dst (which must not exist), gzipped if compress, returns the method used"""
+    if compress:
+      if not gzip(src, dst, threads, verify):
+        remove(dst)
+        raise Exception("Publish verification failed: " + src + " -> " + dst)
+      if mode == 'move':
+        os.remove(src)
+      return 'gzip'
+
+    if mode == 'move':
+      try:
+        os.rename(src, dst)
+        return 'rename'
+      except OSError:
+        pass  # other filesystem: streamed copy, src removed once verified
+    elif mode == 'link':
+      try:
+        os.link(src, dst)
+        return 'hardlink'
+      except OSError:
+        pass
+    try:
+      reflink(src, dst)
+      method = 'reflink'
+    except OSError:
+      remove(dst)
+      shutil.copy2(src, dst)  # streamed (sendfile) copy
+      method = 'copy'
+
+    if os.path.getsize(src) != os.path.getsize(dst) or (verify == 'checksum' and sha1(src) != sha1(dst)):
+      remove(dst)
+      raise Exception("Publish verification failed: " + src + " -> " + dst)
+    if mode == 'move':
+      os.remove(src)
+    return method
+
+def publish(src,dst,mode='link',verify='size',threads=1):
+    """Publishes a file or folder at dst (replacing it), returns {method: number of files}"""
+    if not os.path.lexists(src):
+      raise Exception("Nothing to publish: " + src)
+    part = dst + '.part'
+    remove(part)
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    methods = {}
+
+    nii = lambda f: f.endswith('.nii') and not os.path.islink(f)
+    if os.path.isdir(src) and mode == 'move' and not any(nii(f) for b, d, names in os.walk(src) for f in names):
+      try:
+        os.rename(src, part)  # whole folder at once
+        methods['rename'] = 1
+      except OSError:
+        pass
+    if not methods:
+      if os.path.isdir(src):
+        for base, dirs, files in os.walk(src):
+          out = part + base[len(src):]
+          os.makedirs(out, exist_ok=True)
+          for f in files:
+            path = os.path.join(base, f)
+            m = place(path, os.path.join(out, f + '.gz' if nii(path) else f), mode, verify, threads, nii(path))
+            methods[m] = methods.get(m, 0) + 1
+        if mode == 'move':
+          shutil.rmtree(src)
+      else:
+        m = place(src, part, mode, verify, threads, src.endswith('.nii') and dst.endswith('.nii.gz'))
+        methods[m] = 1
+
+    remove(dst)
+    os.rename(part, dst)
+    return methods
+
+def main(argv):
+    mode = 'link'; verify = 'size'; threads = 1
+    opts, args = getopt.getopt(argv, "", ["mode=", "verify=", "threads="])
+    for opt, arg in opts:
+      if opt == "--mode":
+        mode = arg
+      elif opt == "--verify":
+        verify = arg
+      elif opt == "--threads":
+        threads = max(1, int(arg))
+    if len(args) != 2 or mode not in ('link', 'copy', 'move') or verify not in ('size', 'checksum'):
+      print('usage: python publish.py [--mode=link|copy|move] [--verify=size|checksum] [--threads=N] <src> <dst>')
+      sys.exit(2)
+    methods = publish(args[0], args[1], mode, verify, threads)
+    print('Published ' + args[1] + ' (' + ', '.join(str(n) + ' ' + m for m, n in sorted(methods.items())) + ')')
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,9 +2,7 @@
 # inputs: layout --> BIDSLayout object loaded from study directory
 #         entry  --> structure with all the user defined inputs 
 
-import os, sys, subprocess, multiprocessing, glob, getopt, bids, json, re, warnings
-from subprocess import PIPE
-import pandas as pd
+from . import scheduler
 
 # add report functions here...
 
@@ -22,35 +20,12 @@ def run(entry):
                                               
 def cleanup(entry):
 
-  jobs=[];
   if entry.cleandir == True:
-    # write bash script for execution
-    original_stdout = sys.stdout # Save a reference to the original standard output
-    sys.stdout.flush()
+    # add commands here...
+    cmd = 'rm -Rf ' + entry.wd
 
-    with open(entry.wd + '/cmd_cleanup.sh', 'w') as fid:
-      sys.stdout = fid # Change the standard output to the file we created.
-
-      print('#!/usr/bin/bash')
-
-      # add commands here...
-      print('rm -Rf ' + entry.wd)
-
-      sys.stdout = original_stdout # Reset the standard output to its original value
-
-    # change permissions to make sure file is executable 
-    os.chmod(entry.wd + '/cmd_cleanup.sh', 0o774)
-
-    # run script
-    cmd = 'bash ' + entry.wd + '/cmd_cleanup.sh'
-    name = 'cleanup'
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    jobs.append(p)
-    p.start()
-
-    print(p)
-
-    for job in jobs:
-      job.join()  #wait for all eddy commands to finish
+    graph = scheduler.Graph(entry.ncpus)
+    graph.add('cleanup', scheduler.script(entry, 'cleanup', cmd))
+    graph.run()
 
   ## end run_cleanup
@@ -0,0 +1,129 @@
+# FDT utility functions for running pipeline commands from a single asyncio event loop
+# inputs: name   --> stage name (used for the log files)
+#         cmd    --> command line (bash script written by scheduler.script)
+#
+# Commands are started directly by the scheduler process (no python child per command). stdout and
+# stderr are streamed line by line to <logdir>/<name>.stdout.log / .stderr.log while the command runs,
+# so memory stays flat for verbose tools (eddy, bedpostx) and progress can be followed with tail -f.
+# Each command runs in its own process group: on timeout (or cancellation) the whole group is killed.
+# Exit is detected through a pidfd (linux >= 5.3, polling otherwise) and the process is reaped with
+# wait4, which gives the resource usage of the command and of everything it waited on.
+
+import os, time, signal, asyncio, subprocess
+from subprocess import PIPE
+from . import metrics
+
+POLL = 0.5   # seconds between exit checks when pidfd is not available
+GRACE = 10   # seconds between SIGTERM and SIGKILL
+DRAIN = 5    # seconds to finish reading the logs after exit (pipes held open by left over processes)
+TAIL = 20    # stderr lines printed when a command fails
+
+async def stream(pipe,log):
+    """Copies a pipe to a log file line by line (flushed, so the log is live)"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=2**20)
+    transport, protocol = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+      while True:
+        try:
+          line = await reader.readline()
+        except ValueError:  # line longer than the buffer limit
+          line = await reader.read(2**20)
+        if not line:
+          break
+        log.write(line)
+        log.flush()
+    finally:
+      transport.close()
+
+async def wait(proc):
+    """Waits for the process to exit without blocking the event loop.
+    Returns (rusage, io counters) and sets proc.returncode"""
+    loop = asyncio.get_running_loop()
+    try:
+      fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+      fd = None
+    try:
+      while True:
+        io = metrics.io_counters(proc.pid)  # still readable while the process is a zombie
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+          proc.returncode = os.waitstatus_to_exitcode(status)
+          return usage, io
+        if fd is None:
+          await asyncio.sleep(POLL)
+          continue
+        ready = loop.create_future()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+          await ready
+        finally:
+          loop.remove_reader(fd)
+    finally:
+      if fd is not None:
+        os.close(fd)
+
+def kill(proc,sig):
+    try:
+      os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+      pass
+
+def tail(path,n=TAIL):
+    with open(path, errors='replace') as fid:
+      return ''.join(fid.readlines()[-n:])
+
+async def run(name,cmd,logdir=None,nthreads=1,timeout=None,metricsfile=None,ncpus=1):
+    """Runs a command and returns its exit code (negative: killed by a signal).
+    Output goes to <logdir>/<name>.stdout.log / .stderr.log (or to the console without logdir).
+    timeout (seconds) kills the command's process group, resource usage is recorded in metricsfile"""
+    env = dict(os.environ, OMP_NUM_THREADS=str(nthreads))  # per-job thread count for openmp tools (eddy_openmp)
+    logs = []
+    if logdir is not None:
+      os.makedirs(logdir, exist_ok=True)
+      logs = [open(logdir + '/' + name + '.stdout.log', 'wb'), open(logdir + '/' + name + '.stderr.log', 'wb')]
+
+    start = time.time()
+    timed_out = False
+    proc = subprocess.Popen(cmd.split(), stdout=PIPE if logs else None, stderr=PIPE if logs else None,
+                            env=env, start_new_session=True)
+    readers = [asyncio.ensure_future(stream(pipe, log)) for pipe, log in zip((proc.stdout, proc.stderr), logs)]
+    try:
+      try:
+        usage, io = await asyncio.wait_for(wait(proc), timeout)
+      except asyncio.TimeoutError:
+        timed_out = True
+        print('Worker: ' + name + ' timed out after ' + str(timeout) + ' s, stopping')
+        kill(proc, signal.SIGTERM)
+        try:
+          usage, io = await asyncio.wait_for(wait(proc), GRACE)
+        except asyncio.TimeoutError:
+          kill(proc, signal.SIGKILL)
+          usage, io = await wait(proc)
+      if readers:
+        done, left = await asyncio.wait(readers, timeout=DRAIN)
+        for r in left:
+          r.cancel()
+    except asyncio.CancelledError:
+      # scheduler shutting down: stop the command and everything it started
+      kill(proc, signal.SIGKILL)
+      if proc.returncode is None:
+        await asyncio.shield(wait(proc))
+      raise
+    finally:
+      for log in logs:
+        log.close()
+    end = time.time()
+
+    code = proc.returncode
+    if metricsfile is not None:
+      rec = metrics.stage(name, start, end, ncpus, [usage], io, code)
+      if timed_out:
+        rec['timeout'] = True
+      metrics.record(metricsfile, rec)
+
+    print('Worker: ' + name + ' finished (exit code ' + str(code) + ', ' + '%.1f' % (end - start) + ' s)')
+    if code != 0 and logs and tail(logs[1].name):
+      print(tail(logs[1].name))
+    return code
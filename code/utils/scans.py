@@ -0,0 +1,127 @@
+# FDT utility functions for the scan metadata table used to plan a participant
+# inputs: layout --> BIDSLayout object loaded from study directory
+#         entry  --> structure with all the user defined inputs
+#
+# Every dwi scan of the participant is read once, before any stage is planned: nifti header only
+# (dims, voxel size, volumes), json sidecar (phase encoding direction, total readout time) and the
+# gradient table (b0 volumes, shells). Stage planning, the topup acqparams / eddy index files and the
+# input checks read from this table instead of calling fslval or parsing file names, so planning a
+# participant reads a few kB per scan and starts no process. Problems with the inputs (volumes not
+# matching the gradients, unknown phase encoding, missing readout time, scans on different grids)
+# are reported when the participant is planned.
+
+import os, math, collections
+from . import gradients, nifti
+
+# phase encoding direction (bids PhaseEncodingDirection) of the dir- labels, and its acqparams vector
+DIRECTIONS = collections.OrderedDict((('AP', 'j-'), ('PA', 'j'), ('LR', 'i'), ('RL', 'i-'), ('IS', 'k-'), ('SI', 'k')))
+VECTORS = {'i': (1, 0, 0), 'i-': (-1, 0, 0), 'j': (0, 1, 0), 'j-': (0, -1, 0), 'k': (0, 0, 1), 'k-': (0, 0, -1)}
+
+Scan = collections.namedtuple('Scan', ['path', 'bval', 'bvec', 'shape', 'voxel', 'nvols', 'direction', 'pe', 'readout', 'gradients', 'shells'])
+
+def label(pe):
+    """dir- label of a phase encoding direction (AP for j-, ...)"""
+    return next(d for d, p in DIRECTIONS.items() if p == pe)
+
+def sidecar(layout,path,ext):
+    """bval / bvec file of a scan: next to the image, otherwise inherited (bids index query)"""
+    own = path[:-len('.nii.gz')] + '.' + ext
+    if os.path.exists(own):
+      return own
+    return layout.get_bval(path) if ext == 'bval' else layout.get_bvec(path)
+
+def scan(layout,dwi):
+    """Table row of one dwi scan (BIDSFile)"""
+    path = dwi.path
+    hdr = nifti.header(path)
+    if hdr is None:
+      raise Exception("Unable to read the nifti header of " + path)
+    shape, voxel = hdr
+    meta = dwi.get_metadata()
+
+    # phase encoding: sidecar, otherwise the dir- entity of the file name
+    direction = dwi.get_entities().get('direction')
+    pe = meta.get('PhaseEncodingDirection') or DIRECTIONS.get(direction)
+    if pe not in VECTORS:
+      raise Exception("Unable to determine the phase encoding direction of " + path + " (PhaseEncodingDirection or dir- AP / PA)")
+    direction = label(pe)
+
+    bval = sidecar(layout, path, 'bval')
+    bvec = sidecar(layout, path, 'bvec')
+    gt = gradients.GradientTable.load(bval, bvec)
+    nvols = shape[3] if len(shape) > 3 else 1
+    if nvols != len(gt):
+      raise Exception("Gradient table has " + str(len(gt)) + " entries but " + path + " has " + str(nvols) + " volumes")
+    if len(gt.b0s()) == 0:
+      raise Exception("No b0 volume (bval <= " + str(gradients.B0_TOL) + ") in " + bval)
+
+    return Scan(path, bval, bvec, tuple(shape[:3]), tuple(round(v, 4) for v in voxel[:3]), nvols, direction, pe,
+                meta.get('TotalReadoutTime'), gt, gt.shells())
+
+
+class ScanTable:
+    """dwi scans of one participant (in bids order) with their header / sidecar / gradient metadata"""
+    def __init__(self, pid, scans):
+        self.pid = pid
+        self.scans = list(scans)
+
+    @classmethod
+    def load(cls, layout, pid):
+        table = cls(pid, [scan(layout, dwi) for dwi in layout.get(subject=pid, extension='nii.gz', suffix='dwi')])
+        return table.validate()
+
+    def __len__(self):
+        return len(self.scans)
+
+    def __iter__(self):
+        return iter(self.scans)
+
+    def __getitem__(self, i):
+        return self.scans[i]
+
+    def validate(self):
+        if not self.scans:
+          raise Exception("No dwi scans found for participant " + str(self.pid))
+        grids = set((s.shape, s.voxel) for s in self.scans)
+        if len(grids) > 1:
+          raise Exception("dwi scans of participant " + str(self.pid) + " are on different grids (topup / eddy need one grid): " +
+                          ', '.join(str(s.shape) + ' ' + str(s.voxel) + ' mm' for s in self.scans))
+        missing = [s.path for s in self.topup_scans() if s.readout is None]
+        if missing:
+          raise Exception("TotalReadoutTime missing from the json sidecar of " + ', '.join(missing))
+        return self
+
+    def topup_scans(self):
+        """First scan of each phase encoding direction (AP first, then PA, ...): one acqparams row each"""
+        first = collections.OrderedDict((d, None) for d in DIRECTIONS)
+        for s in self.scans:
+          if first[s.direction] is None:
+            first[s.direction] = s
+        return [s for s in first.values() if s is not None]
+
+    def acqparams(self):
+        """topup / eddy --acqp rows: (phase encoding vector, total readout time) of each direction"""
+        return [(VECTORS[s.pe], s.readout) for s in self.topup_scans()]
+
+    def row(self, s):
+        """acqparams row (eddy --inindex / --index, from 1) of a scan"""
+        return [t.direction for t in self.topup_scans()].index(s.direction) + 1
+
+    def volume_mb(self):
+        """Size (MB) of one volume as float32 (all scans share the grid)"""
+        return math.prod(self.scans[0].shape) * 4 / 2.**20
+
+    def summary(self):
+        lines = []
+        for s in self.scans:
+          lines.append('%s: %s x %d vols, %s mm, %s (%s), readout %s s, shells %s' % (
+                       s.path, 'x'.join(str(n) for n in s.shape), s.nvols, 'x'.join('%g' % v for v in s.voxel),
+                       s.direction, s.pe, s.readout, ','.join(str(b) for b in s.shells)))
+        return '\n'.join(lines)
+
+def table(layout,entry):
+    """Scan table of the participant (entry.pid), read once and kept on the entry"""
+    if entry.scans is None or entry.scans.pid != entry.pid:
+      entry.scans = ScanTable.load(layout, entry.pid)
+      print('dwi scans of sub-' + str(entry.pid) + ':\n' + entry.scans.summary())
+    return entry.scans
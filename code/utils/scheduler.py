@@ -0,0 +1,298 @@
+# FDT utility functions for scheduling pipeline stages as a dependency graph
+# inputs: graph  --> Graph object collecting every stage (node) of the pipeline
+#         entry  --> structure with all the user defined inputs
+
+import os, sys, time, signal, asyncio, multiprocessing
+from . import metrics, runner, memory
+
+def script(entry,name,cmd):
+    """Writes a bash script to the working directory and returns the command used to run it"""
+
+    # write bash script for execution
+    cmdfile = entry.wd + '/cmd_' + name + '.sh'
+    with open(cmdfile, 'w') as fid:
+      fid.write('#!/usr/bin/bash\n')
+      fid.write('set -e\n')  # any failing command fails the stage (not only the last one)
+      fid.write('export FSLOUTPUTTYPE=' + ('NIFTI_GZ' if entry.compress_intermediates else 'NIFTI') + '\n')  # see ext
+      fid.write(cmd + '\n')
+
+    # change permissions to make sure file is executable
+    os.chmod(cmdfile, 0o774)
+
+    return 'bash ' + cmdfile
+
+def ext(entry):
+    """Extension of intermediate images in the working directory: uncompressed .nii (written and read
+    several times per participant), .nii.gz with --compress-intermediates. Derivatives are always .nii.gz"""
+    return '.nii.gz' if entry.compress_intermediates else '.nii'
+
+def publish(src,dst,mode='link',verify='size',threads=1):
+    """bash command publishing a file or folder (see publish.py): hard linked / reflinked (link, copy) or
+    renamed (move) when possible, streamed otherwise, placed next to dst, verified, then renamed,
+    so an interrupted stage never leaves a partial derivative behind. Uncompressed .nii images are
+    gzipped on the way (block parallel over threads)"""
+    return (sys.executable + ' ' + os.path.dirname(os.path.abspath(__file__)) + '/publish.py --mode=' + mode +
+            ' --verify=' + verify + ' --threads=' + str(threads) + ' "' + src + '" "' + dst + '"\n')
+
+def cached(cache,size_gb,keys,outputs,cmd):
+    """bash command running cmd through the content addressed cache (see cache.py): outputs linked from
+    <cache>/<hash of the keys and cmd> when it ran before (in any working directory), stored there otherwise"""
+    return (sys.executable + ' ' + os.path.dirname(os.path.abspath(__file__)) + '/cache.py --cache="' + cache + '" --size-gb=' + str(size_gb) +
+            ''.join(' --key="' + f + '"' for f in keys) + ''.join(' --output="' + f + '"' for f in outputs) + ' -- ' + cmd + '\n')
+
+def eddy_threads(entry,njobs):
+    """Threads given to each eddy_openmp job: --omp-nthreads if set, otherwise the core budget is
+    divided between the concurrent jobs using at least 4 cpus for each dwi scan"""
+    if entry.omp_nthreads:
+      return min(entry.omp_nthreads, entry.ncpus)
+    return min(entry.ncpus, max(4, entry.ncpus // max(njobs,1)))
+
+
+class Node:
+    """Single pipeline stage: a bash command (or python function), the stages it waits on and the cpus it uses.
+    Stages with a manifest (see manifest.py) are skipped when their outputs are up to date, stages with a
+    metrics file record their resource usage (see metrics.py) and log their output next to it (see runner.py).
+    Stages running longer than timeout (seconds) are stopped. When a stage fails, the other stages of its
+    group (participant) are cancelled. mem is the memory model of the stage (MB, or a memory.Model)"""
+    def __init__(self, name, cmd=None, deps=(), target=None, args=(), ncpus=1, manifest=None, metrics=None, timeout=None, group=None, mem=None):
+        self.name = name
+        self.ncpus = ncpus
+        self.mem = mem
+        self.reserved = None  # memory (MB) held while running, see memory.estimate
+        self.attempts = 0  # reruns after out of memory kills
+        self.manifest = manifest
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.target = target
+        self.args = args
+        self.metrics = metrics
+        self.timeout = timeout
+        self.group = group
+        self.exitcode = None
+        self.timed_out = False
+        self.oom_kills = None
+
+    async def run(self):
+        """Runs the stage from the event loop and returns its exit code. Manifest file work (partial
+        outputs removed before, manifest or failure written after) runs in a thread, off the event loop"""
+        try:
+          if self.manifest is not None:
+            await asyncio.to_thread(self.manifest.invalidate)
+          code = await self.execute()
+          if self.manifest is not None:
+            await asyncio.to_thread(self.manifest.commit if code == 0 else self.manifest.fail)
+          return code
+        except asyncio.CancelledError:
+          print('Worker: ' + self.name + ' cancelled')
+          if self.metrics is not None:
+            metrics.record(self.metrics, {'stage': self.name, 'end': time.time(), 'cancelled': True})
+          raise
+
+    async def execute(self):
+        start = time.time()
+        self.oom_kills = memory.oom_kills()
+        try:
+          return await self.launch()
+        finally:
+          self.timed_out = self.timeout is not None and time.time() - start >= self.timeout
+
+    async def launch(self):
+        if self.target is None:
+          logdir = os.path.dirname(self.metrics) if self.metrics is not None else None
+          self.exitcode = await runner.run(self.name, self.cmd, logdir, self.ncpus, self.timeout, self.metrics, self.ncpus)
+          return self.exitcode
+
+        # python stages run in their own process (cpu bound, and isolated from the scheduler)
+        target, args = self.target, self.args
+        if self.metrics is not None:
+          target, args = metrics.measure, (self.metrics,self.name,self.ncpus,target,args)
+        process = multiprocessing.Process(target=target, args=args)
+        process.start()
+        try:
+          await asyncio.wait_for(exited(process), self.timeout)
+        except asyncio.TimeoutError:
+          print('Worker: ' + self.name + ' timed out after ' + str(self.timeout) + ' s, stopping')
+          process.terminate()
+          await exited(process)
+        except asyncio.CancelledError:
+          process.kill()
+          process.join()
+          raise
+        process.join()
+        self.exitcode = process.exitcode
+        if self.metrics is not None and self.exitcode < 0:
+          # killed by a signal (e.g. out of memory or timeout), the stage process could not record itself
+          metrics.record(self.metrics, {'stage': self.name, 'end': time.time(), 'exitcode': self.exitcode})
+        print('Worker: ' + self.name + ' finished (exit code ' + str(self.exitcode) + ')')
+        return self.exitcode
+
+
+async def exited(process):
+    """Waits (without blocking the event loop) until a multiprocessing process exits"""
+    loop = asyncio.get_running_loop()
+    while process.is_alive():
+      ready = loop.create_future()
+      loop.add_reader(process.sentinel, lambda: ready.done() or ready.set_result(None))
+      try:
+        await ready
+      finally:
+        loop.remove_reader(process.sentinel)
+
+
+class Graph:
+    """Dependency graph of pipeline stages.
+
+    Each node is started as soon as all of its dependencies have finished, so
+    independent chains (e.g. the eddy chain of each dwi scan) never wait on each other.
+    Running nodes never use more than ncpus cores together, nor more than the memory budget
+    (mem_gb, or the detected limit, see memory.py) as estimated, extra nodes are queued.
+    """
+    def __init__(self, ncpus=None, metrics=None, timeout=None, on_done=None, mem_gb=None):
+        self.nodes = {}
+        self.ncpus = ncpus or multiprocessing.cpu_count()
+        self.mem = memory.budget(mem_gb)  # MB
+        self.metrics = metrics  # default metrics file of the stages (None: not recorded, output to the console)
+        self.timeout = timeout  # default stage timeout in seconds (None: no limit)
+        self.on_done = on_done  # called with each node completed successfully (e.g. staging.Copier.stage_done), must not block
+
+    def add(self, name, cmd=None, deps=(), target=None, args=(), ncpus=1, manifest=None, metrics=None, timeout=None, group=None, mem=None):
+        """Adds a stage to the graph and returns its name (used as a dependency by later stages)"""
+        if name in self.nodes:
+          raise Exception("Duplicate pipeline stage: " + name)
+        self.nodes[name] = Node(name, cmd, [d for d in deps if d is not None], target, args, min(ncpus, self.ncpus), manifest,
+                                metrics or self.metrics, timeout or self.timeout, group, mem)
+        return name
+
+    def subject(self, pid, metrics=None):
+        """View of the graph for one participant: stage names are prefixed with the participant label,
+        stage resources are recorded in the participant's metrics file"""
+        return SubjectGraph(self, 'sub-' + pid + '_', metrics)
+
+    def run(self, strict=False):
+        """Runs all stages, blocking until the whole graph is finished.
+        Returns the failed stage of each failed group ({} if all succeeded), strict raises instead"""
+        try:
+          failed = asyncio.run(self.supervise())
+        except asyncio.CancelledError:
+          print('Pipeline interrupted, running stages stopped (rerun with --resume to continue)')
+          sys.exit(1)
+        if strict and failed:
+          raise Exception("Pipeline stage failed: " + ', '.join(failed.values()))
+        return failed
+
+    async def supervise(self):
+        """Starts every stage once its dependencies are done and cpus and memory are free, from one event loop.
+        A failing stage stops its group straight away (fail fast): running stages of the group are
+        cancelled (their process groups killed) and its pending stages are dropped. A stage killed out
+        of memory is queued again instead, with twice the memory reserved (the last time all of it).
+        Manifests are checked (input hashes, multi-GB images) in threads as soon as the dependencies
+        of a stage are done, so the event loop keeps serving the running stages meanwhile"""
+
+        done = set()
+        pending = list(self.nodes)
+        running = {}
+        checking = {}  # manifest checks (thread) -> node
+        checked = set()  # stages found out of date, waiting for cpus / memory
+        failed = {}
+        used = 0
+        usedmem = 0.
+
+        # preemption / ctrl-c: cancel the running stages (killing their process groups) before exiting,
+        # their journal entries stay 'start' so the next run redoes them from scratch
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+          loop.add_signal_handler(sig, asyncio.current_task().cancel)
+
+        while pending or running or checking:
+          for name in list(pending):
+            node = self.nodes[name]
+            if not all(d in done for d in node.deps):
+              continue
+            if node.manifest is not None and name not in checked:
+              pending.remove(name)
+              checking[asyncio.ensure_future(asyncio.to_thread(node.manifest.current))] = node
+              continue
+            if used + node.ncpus <= self.ncpus:
+              if node.reserved is None:
+                node.reserved = min(memory.estimate(node), self.mem)
+              if running and usedmem + node.reserved > self.mem:
+                continue  # queued until running stages free enough memory
+              pending.remove(name)
+              running[asyncio.ensure_future(node.run())] = node
+              used += node.ncpus
+              usedmem += node.reserved
+
+          if not running and not checking:
+            if not pending:
+              break
+            raise Exception("Unable to schedule pipeline stages (missing or circular dependency): " + ', '.join(pending))
+
+          finished, left = await asyncio.wait(list(running) + list(checking), return_when=asyncio.FIRST_COMPLETED)
+          for task in finished:
+            if task in checking:
+              node = checking.pop(task)
+              if node.group in failed:
+                continue  # participant stopped while its manifest was checked
+              if task.result():
+                print('Stage outputs up to date...skipping: ' + node.name)
+                if node.metrics is not None:
+                  metrics.record(node.metrics, {'stage': node.name, 'skipped': True, 'time': time.time()})
+                done.add(node.name)
+              else:
+                checked.add(node.name)
+                pending.insert(0, node.name)
+              continue
+
+            node = running.pop(task)
+            used -= node.ncpus
+            usedmem -= node.reserved
+            task.result()  # scheduler errors (e.g. command not found) are raised here
+            if node.exitcode == 0:
+              done.add(node.name)
+              if self.on_done is not None:
+                self.on_done(node)
+              continue
+
+            if memory.killed(node.exitcode, node.oom_kills) and not node.timed_out and node.attempts < memory.OOM_RETRIES:
+              # out of memory: run again with fewer stages next to it (partial outputs removed by the manifest)
+              node.attempts += 1
+              node.reserved = self.mem if node.attempts == memory.OOM_RETRIES else min(2 * node.reserved, self.mem)
+              pending.insert(0, node.name)
+              print('Stage killed out of memory: ' + node.name + ', queued again with ' + '%.0f' % node.reserved + ' MB reserved' +
+                    (' (running alone)' if node.reserved >= self.mem else ''))
+              if node.metrics is not None:
+                metrics.record(node.metrics, {'stage': node.name, 'oom': True, 'attempt': node.attempts, 'mem_mb': node.reserved, 'time': time.time()})
+              continue
+
+            # fail fast: free the cpus held by the rest of the group and skip its later stages
+            failed[node.group] = node.name
+            pending = [n for n in pending if self.nodes[n].group != node.group]
+            siblings = [t for t, n in running.items() if n.group == node.group and not t.done()]
+            cancelled = [running[t].name for t in siblings]
+            for t in siblings:
+              t.cancel()
+            await asyncio.gather(*siblings, return_exceptions=True)
+            for t in siblings:
+              usedmem -= running[t].reserved
+              used -= running.pop(t).ncpus
+            print('Stage failed: ' + node.name + ' (exit code ' + str(node.exitcode) + '), cancelled: ' + (', '.join(cancelled) or 'none'))
+            if node.metrics is not None:
+              metrics.record(node.metrics, {'failed_stage': node.name, 'exitcode': node.exitcode, 'cancelled': cancelled, 'time': time.time()})
+
+        return failed
+
+        ## end run
+
+
+class SubjectGraph:
+    """Adds the stages of one participant to a shared Graph (batch mode)"""
+    def __init__(self, graph, prefix, metrics=None):
+        self.graph = graph
+        self.prefix = prefix
+        self.ncpus = graph.ncpus
+        self.metrics = metrics
+
+    def add(self, name, cmd=None, deps=(), target=None, args=(), ncpus=1, manifest=None, metrics=None, timeout=None, mem=None):
+        """Adds a stage to the shared graph, dependencies are names returned by this view.
+        The participant's stages form one group: a failing stage only stops this participant"""
+        return self.graph.add(self.prefix + name, cmd, deps, target, args, ncpus, manifest, metrics or self.metrics, timeout, self.prefix, mem)
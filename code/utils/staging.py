@@ -0,0 +1,150 @@
+# FDT utility functions for running the pipeline on node-local scratch (--scratch)
+# inputs: entry  --> structure with all the user defined inputs
+#
+# The dwi data of the participants (and the bids sidecars at every level) are copied to
+# <scratch>/fdt-<id>/bids before indexing, the working directory is <scratch>/fdt-<id>/work and the
+# derivatives are written to <scratch>/fdt-<id>/derivatives, so eddy's intermediate reads and writes and
+# the publish stages never touch the network filesystem. Each finished stage hands its outputs to a
+# background Copier which copies them to the real output directory while later stages run; the pipeline
+# waits for outstanding copies (and copies anything left over) only at exit.
+# The scratch directory is named after the output directory and the participant labels, so --resume
+# works on the same node and runs of other participants on the node (same --out and --scratch, e.g. one
+# container per participant) get their own tree. Copying out at exit and --clean-work-dir only touch
+# the sub-<label> folders of the run's participants: with --clean-work-dir they are removed once every
+# participant succeeded and the derivatives are copied out (tmpfs holds memory), and the
+# <scratch>/fdt-<id> tree goes once no participant folder is left in it.
+# The topup cache stays next to the final outputs (shared by jobs on every node, see cache.py).
+
+import os, time, shutil, hashlib, threading, concurrent.futures
+
+# bids datatype folders never read by the pipeline (only dwi is staged)
+DATATYPES = ('anat', 'func', 'fmap', 'perf', 'meg', 'eeg', 'ieeg', 'beh', 'pet', 'micr', 'nirs', 'motion')
+IGNORE = ('code', 'derivatives', 'models', 'sourcedata', 'stimuli')
+THREADS = 4  # parallel copies (network filesystems reward a few concurrent streams)
+
+def root(scratch,outputs,pids):
+    """Staging directory of a run (output directory and participant labels) on the scratch disk"""
+    key = os.path.abspath(outputs) + '\n' + ' '.join(sorted(pids))
+    return scratch + '/fdt-' + hashlib.sha1(key.encode()).hexdigest()[:8]
+
+def copy(src,dst):
+    """Copies a file (times preserved) through dst.part + rename, skipped when dst has the same size
+    and modification time. Returns the bytes copied"""
+    st = os.stat(src)
+    try:
+      old = os.stat(dst)
+      if old.st_size == st.st_size and old.st_mtime_ns == st.st_mtime_ns:
+        return 0
+    except FileNotFoundError:
+      pass
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    shutil.copy2(src, dst + '.part')
+    os.replace(dst + '.part', dst)
+    return st.st_size
+
+def files(src,pids=None):
+    """Files of a bids tree used by the pipeline: top level files, and the participants' folders
+    without the datatypes other than dwi"""
+    for base, dirs, names in os.walk(src):
+      rel = os.path.relpath(base, src)
+      if rel == '.':
+        dirs[:] = [d for d in dirs if d.startswith('sub-') and (pids is None or d[4:] in pids)]
+      else:
+        dirs[:] = [d for d in dirs if d not in DATATYPES and not d.startswith('.')]
+      for n in names:
+        if not n.startswith('.') and not n.endswith('.part'):
+          yield os.path.join(base, n)
+
+def walk(top,pids=None):
+    """Files under top, leaving out the sub-<label> folders of participants other than pids"""
+    for base, dirs, names in os.walk(top):
+      if pids is not None:
+        dirs[:] = [d for d in dirs if not d.startswith('sub-') or d[4:] in pids]
+      for n in names:
+        yield os.path.join(base, n)
+
+def mirror(src,dst,pids=None):
+    """Copies the files of src used by the pipeline to dst (in parallel), returns (files, bytes)"""
+    paths = list(files(src, pids))
+    with concurrent.futures.ThreadPoolExecutor(THREADS) as pool:
+      sizes = list(pool.map(lambda p: copy(p, dst + p[len(src):]), paths))
+    return len(paths), sum(sizes)
+
+def setup(entry):
+    """Stages the inputs on scratch and points the entry at the local copies.
+    Returns the Copier publishing the local derivatives to the real output directory"""
+    local = root(entry.scratch, entry.outputs, entry.pids)
+    pids = None if entry.pids == ['all'] else entry.pids
+    t = time.time()
+    n, size = mirror(entry.inputs, local + '/bids', pids)
+    if entry.ignore_preproc and os.path.isdir(entry.outputs + '/FDT'):
+      m, s = mirror(entry.outputs + '/FDT', local + '/derivatives/FDT', pids)  # preprocessed derivatives read by the fit stages
+      n += m; size += s
+    print('Staged ' + str(n) + ' input files (' + '%.1f' % (size / 2.**20) + ' MB copied) to ' + local + ' in ' + '%.1f' % (time.time() - t) + ' s')
+
+    copier = Copier(local + '/derivatives', entry.outputs)
+    entry.final_outputs = entry.outputs
+    entry.inputs = local + '/bids'
+    entry.outputs = local + '/derivatives'
+    return copier
+
+
+def cleanup(entry,pids):
+    """Removes the staged files of the participants pids (sub-<label> folders of the inputs, work and
+    derivative copies) from the scratch disk, and the staging directory once no participant is left in it"""
+    local = root(entry.scratch, entry.final_outputs, entry.pids)
+    if not os.path.isdir(local):
+      return
+    for base, dirs, names in os.walk(local):
+      for d in [d for d in dirs if d.startswith('sub-') and d[4:] in pids]:
+        shutil.rmtree(os.path.join(base, d))
+        dirs.remove(d)
+    if not any(d.startswith('sub-') for base, dirs, names in os.walk(local) for d in dirs):
+      shutil.rmtree(local)
+    print('Removed staged files of sub-' + ', sub-'.join(pids) + ': ' + local)
+
+
+class Copier:
+    """Background copy of finished derivatives from the local output directory to the final one"""
+    def __init__(self, local, final, threads=2):
+        self.local = local
+        self.final = final
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.futures = []
+        self.errors = []
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, paths):
+        """Queues files or folders (under the local output directory) for copying, returns straight away"""
+        for p in paths:
+          if p.startswith(self.local + '/'):
+            self.futures.append(self.pool.submit(self.publish, p))
+
+    def stage_done(self, node):
+        """Scheduler callback: the outputs of a finished stage (from its manifest) are copied out"""
+        if node.manifest is not None:
+          self.add(node.manifest.outputs)
+
+    def publish(self, path):
+        try:
+          paths = [path] if not os.path.isdir(path) else [os.path.join(b, n) for b, d, names in os.walk(path) for n in names]
+          size = sum(copy(p, self.final + p[len(self.local):]) for p in paths if not p.endswith('.part'))
+          with self.lock:
+            self.bytes += size
+        except OSError as err:
+          with self.lock:
+            self.errors.append(path + ': ' + str(err))
+
+    def close(self, pids=None):
+        """Waits for the outstanding copies, then copies anything not published yet (stages without manifest)
+        from the folders of the participants pids (all by default)"""
+        t = time.time()
+        concurrent.futures.wait(self.futures)
+        if os.path.isdir(self.local):
+          self.add(list(walk(self.local, pids)))
+          concurrent.futures.wait(self.futures)
+        self.pool.shutdown()
+        print('Derivatives copied to ' + self.final + ': ' + '%.1f' % (self.bytes / 2.**20) + ' MB (' + '%.1f' % (time.time() - t) + ' s waiting at exit)')
+        if self.errors:
+          raise Exception("Unable to copy derivatives: " + '; '.join(self.errors))
@@ -0,0 +1,95 @@
+# FDT utility functions for native (numpy) diffusion tensor fitting, alternative backend to fsl dtifit
+# inputs: preprocessed dwi image, bval, bvec and brain mask
+#
+# The tensor is fit by weighted least squares on the log signal (weights from an ordinary least
+# squares first pass), batched over chunks of masked voxels. Chunks are spread over a process pool.
+# Outputs use the dtifit names: <out>_FA, _MD, _MO, _S0, _L1-3 and _V1-3 (.nii.gz).
+
+import os, concurrent.futures
+import numpy as np
+from . import gradients, nifti
+
+CHUNK = 20000  # voxels fit per batch
+MIN_SIGNAL = 1e-6
+MAX_LOG = np.log(np.finfo(np.float32).max)  # largest log S0 written (float32 outputs)
+
+def design(gt):
+    """Design matrix of the log-linear tensor model: [log S0, Dxx, Dyy, Dzz, Dxy, Dxz, Dyz]"""
+    b = gt.bvals
+    x, y, z = gt.bvecs
+    return np.stack([np.ones_like(b), -b*x*x, -b*y*y, -b*z*z, -2*b*x*y, -2*b*x*z, -2*b*y*z], axis=1)
+
+def solve(X, w, y):
+    """Batched weighted least squares: one (n, 7) design, per voxel weights w and data y (v, n)"""
+    A = np.einsum('vn,ni,nj->vij', w, X, X)
+    r = np.einsum('vn,ni,vn->vi', w, X, y)
+    return np.linalg.solve(A, r[..., None])[..., 0]
+
+def fit_chunk(X, signal):
+    """Fits the tensor for a chunk of voxels (v, n), returns the dtifit maps of the chunk"""
+    # non-positive samples (noise, background) are left out of the fit, voxels with too few samples
+    # left to fit the 7 parameters keep them all (at MIN_SIGNAL)
+    valid = signal > 0
+    valid[valid.sum(axis=1) < X.shape[1]] = True
+    y = np.log(np.maximum(signal, MIN_SIGNAL))
+    beta = solve(X, valid.astype(float), y)                    # ordinary least squares
+    # weighted by predicted signal^2, computed in log space relative to the largest prediction of the
+    # voxel (the solution does not depend on the scale of its weights, exp can not overflow)
+    pred = np.einsum('ni,vi->vn', X, beta)
+    beta = solve(X, valid * np.exp(2 * (pred - pred.max(axis=1, keepdims=True))), y)
+
+    D = np.empty((len(beta), 3, 3))
+    D[:, 0, 0] = beta[:, 1]; D[:, 1, 1] = beta[:, 2]; D[:, 2, 2] = beta[:, 3]
+    D[:, 0, 1] = D[:, 1, 0] = beta[:, 4]
+    D[:, 0, 2] = D[:, 2, 0] = beta[:, 5]
+    D[:, 1, 2] = D[:, 2, 1] = beta[:, 6]
+
+    evals, evecs = np.linalg.eigh(D)
+    evals = evals[:, ::-1]; evecs = evecs[:, :, ::-1]  # L1 >= L2 >= L3
+
+    md = evals.mean(axis=1)
+    dev = evals - md[:, None]
+    norm = np.sqrt((evals ** 2).sum(axis=1))
+    fa = np.sqrt(1.5) * np.sqrt((dev ** 2).sum(axis=1)) / np.where(norm > 0, norm, 1)
+
+    A = D - md[:, None, None] * np.eye(3)
+    anorm = np.sqrt((A ** 2).sum(axis=(1, 2)))
+    mo = 3 * np.sqrt(6) * np.linalg.det(A / np.where(anorm > 0, anorm, 1)[:, None, None])
+
+    return {'FA': fa, 'MD': md, 'MO': np.clip(mo, -1, 1), 'S0': np.exp(np.minimum(beta[:, 0], MAX_LOG)),
+            'L1': evals[:, 0], 'L2': evals[:, 1], 'L3': evals[:, 2],
+            'V1': evecs[:, :, 0], 'V2': evecs[:, :, 1], 'V3': evecs[:, :, 2]}
+
+def fit(data,bval,bvec,mask,out,threads=1):
+    """Fits the tensor in every mask voxel and writes <out>_FA.nii.gz, ... (same naming as dtifit --out)"""
+    gt = gradients.GradientTable.load(bval, bvec).validate(data)
+    X = design(gt)
+
+    img = nifti.load(data)
+    inside = np.asanyarray(nifti.load(mask).dataobj).reshape(img.shape[:3]) > 0
+    index = np.flatnonzero(inside.ravel(order='F'))
+    if index.size == 0:
+      raise Exception("Empty brain mask: " + mask)
+
+    # masked voxels x volumes, read one volume at a time
+    signal = np.empty((index.size, len(gt)), dtype=np.float32)
+    for v, vol in enumerate(nifti.volumes(img)):
+      signal[:, v] = vol.ravel(order='F')[index]
+
+    chunks = [signal[i:i + CHUNK] for i in range(0, index.size, CHUNK)]
+    if threads > 1 and len(chunks) > 1:
+      with concurrent.futures.ProcessPoolExecutor(threads) as pool:
+        results = list(pool.map(fit_chunk, [X] * len(chunks), chunks))
+    else:
+      results = [fit_chunk(X, c) for c in chunks]
+
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    nvox = int(np.prod(img.shape[:3]))
+    outputs = []
+    for name in results[0]:
+      ncomp = 3 if name[0] == 'V' else 1
+      vol = np.zeros((nvox, ncomp), dtype=np.float32)
+      vol[index] = np.concatenate([r[name] for r in results]).reshape(index.size, ncomp)
+      vols = [vol[:, c].reshape(img.shape[:3], order='F') for c in range(ncomp)]
+      outputs.append(nifti.write(out + '_' + name + '.nii.gz', img, ncomp, vols, np.float32, threads))
+    return outputs
@@ -2,87 +2,60 @@
 # inputs: layout --> BIDSLayout object loaded from study directory
 #         entry  --> structure with all the user defined inputs 
 
-import os, sys, subprocess, multiprocessing, glob, getopt, bids, json, re, warnings
-from subprocess import PIPE
-import pandas as pd
+import os
+from . import scheduler, metrics, manifest, gradients, nifti, memory, scans
 
-def worker(name,cmdfile):
-    """Executes the bash script"""
-    process = subprocess.Popen(cmdfile.split(), stdout=PIPE, stderr=PIPE, universal_newlines=True)
-    output, error = process.communicate()
-    print(error)
-    print('Worker: ' + name + ' finished')
-    return
-
-def run(layout,entry):
+# add topup (field estimation) stage to the pipeline graph, returns the stage name
+def plan(graph,layout,entry,deps=()):
         
-    # check if blip-up blip-down aquisition (ie dwi collected in opposing phase encoding directions)
-    for dwi in layout.get(subject=entry.pid, extension='nii.gz', suffix='dwi'):
-        ent = dwi.get_entities()
-        if 'AP' in ent['direction']:
-            if 'img1' not in locals():
-                img1=dwi.path
-                meta=dwi.get_metadata()
-        elif 'PA' in ent['direction']:
-            if 'img2' not in locals():
-                img2=dwi.path
+    # blip-up blip-down acquisition (dwi collected in opposing phase encoding directions): the first
+    # b0 volume of the first scan in each direction is merged for topup, one acqparams row each
+    table = scans.table(layout, entry)
 
-    # if blip-up blip-down is used: pull b0 from both images and merge for topup
-    
     print('Applying topup: ')
-    cmd='rm ' + entry.wd + '/acqparams.txt ; touch ' + entry.wd + '/acqparams.txt ;'
-    if 'img1' in locals():
-        cmd += 'fslroi ' + img1 + ' b0_AP 0 1; '  # takes the first volume of dwi image as b0
-        cmd += 'echo "0 -1 0 ' + str(meta['TotalReadoutTime']) + '" >> ' + entry.wd + '/acqparams.txt ; ' # acqparameters for A -> P
-        
-        refimg = 'b0_AP'
-        print('AP acquisition Using: ' + img1)
-
-    if 'img2' in locals():
-        cmd += 'fslroi ' + img2 + ' b0_PA 0 1; '  # takes the first volume of dwi image as b0  
-        cmd += 'echo "0 1 0 ' + str(meta['TotalReadoutTime']) + '" >> ' + entry.wd + '/acqparams.txt ; ' # acqparameters for P -> A
-
-        refimg = 'b0_AP'
-        print('PA acquisition Using: ' + img2)
-
-    if ('img1' in locals()) and ('img2' in locals()):
-        cmd += 'fslmerge -t b0_APPA b0_AP b0_PA'
-        refimg = 'b0_APPA'
+    sources = []
+    for scan in table.topup_scans():
+        sources.append((scan.path, int(scan.gradients.b0s()[0])))
+        print(scan.direction + ' acquisition Using: ' + scan.path)
+    acqparams = table.acqparams()
+    refimg = 'b0_' + ''.join(scan.direction for scan in table.topup_scans())
+
+    gradients.write_acqparams(entry.wd + '/acqparams.txt', acqparams)
+    os.makedirs(entry.wd + '/topup', exist_ok=True)
+
+    # merge b0 volumes in process (no fslroi / fslmerge)
+    b0 = entry.wd + '/topup/' + refimg + scheduler.ext(entry)
+    inputs = [img for img, vol in sources]
+    b0 = graph.add('topup_b0', deps=deps, target=nifti.select, args=(sources,b0),
+                   manifest=manifest.stage(entry, 'topup_b0', inputs, [b0], str(sources)))
 
-    
     # write bash script for execution
-    original_stdout = sys.stdout # Save a reference to the original standard output
-    sys.stdout.flush()
-    jid=[]
-
-    with open(entry.wd + '/cmd_topup.sh', 'w') as fid:
-      sys.stdout = fid # Change the standard output to the file we created.
-      
-      print('#!/usr/bin/bash')
-      print('mkdir -p ' + entry.wd + '/topup')
-      print('cd ' + entry.wd + '/topup')
-      print(cmd)
-
-      print("""topup --imain=""" + refimg + """ \
+    cmd = """topup --imain=""" + refimg + """ \
         --datain=../acqparams.txt \
         --config=b02b0.cnf \
         --out=topup_b0 \
         --iout=topup_b0_iout \
         --fout=topup_b0_fout  \
-        --logout=topup""")
+        --logout=topup"""
+
+    inputs = [entry.wd + '/topup/' + refimg + scheduler.ext(entry), entry.wd + '/acqparams.txt']
+    outputs = [entry.wd + '/topup/topup_b0' + f for f in ('_iout', '_fout', '_fieldcoef')] + [entry.wd + '/topup/topup_b0_movpar.txt']
+    outputs = [f if f.endswith('.txt') else f + scheduler.ext(entry) for f in outputs]
 
-      sys.stdout = original_stdout # Reset the standard output to its original value
+    # field cached by the b0 voxels, acquisition parameters and configuration: a new working directory,
+    # the other --concat-before-preproc mode or a rerun of the participant links the field instead
+    if entry.topup_cache is not None:
+        cmd = scheduler.cached(entry.topup_cache, entry.topup_cache_size, inputs + ['${FSLDIR}/etc/flirtsch/b02b0.cnf'], outputs, cmd)
+    cmd = 'cd ' + entry.wd + '/topup \n' + cmd
 
-    # change permissions to make sure file is executable 
-    os.chmod(entry.wd + '/cmd_topup.sh', 0o774)
+    return graph.add('topup', scheduler.script(entry, 'topup', cmd), [b0], mem=memory.Model([len(sources) * table.volume_mb()], memory.TOPUP), manifest=manifest.stage(entry, 'topup', inputs, outputs, cmd))
 
-    # run script
-    cmd = "bash " + entry.wd + "/cmd_topup.sh"
-    name = "topup"
-    p = multiprocessing.Process(target=worker, args=(name,cmd))
-    p.start()
-    print(p)
+    ## end plan
+
+def run(layout,entry):
 
-    p.join()  # blocks further execution until job is finished
+    graph = scheduler.Graph(entry.ncpus, metrics.logfile(entry), entry.stage_timeout, mem_gb=entry.mem_gb)
+    plan(graph,layout,entry)
+    graph.run(strict=True)  # blocks further execution until job is finished
 
     ## end run_topup